@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Write make_json rows as Avro, with a schema derived from schema.json.
+
+Load the output with `bq load --source_format=AVRO --use_avro_logical_types`.
+"""
+
+import json
+import os
+
+SCHEMA_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.json')
+
+AVRO_TYPES = {
+    'BOOLEAN': 'boolean',
+    'FLOAT': 'double',
+    'INTEGER': 'long',
+    'STRING': 'string',
+    'TIMESTAMP': {'type': 'long', 'logicalType': 'timestamp-micros'},
+}
+
+# Uncompressed bytes buffered per Avro block. Blocks are compressed and
+# written as they fill, so memory is bounded by this plus the largest row.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def load_schema(path=SCHEMA_JSON):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def _avro_field(field, namespace):
+    if field['type'] == 'RECORD':
+        name = namespace + '_' + field['name']
+        ftype = {'type': 'record', 'name': name,
+                 'fields': [_avro_field(f, name) for f in field['fields']]}
+    else:
+        ftype = AVRO_TYPES[field['type']]
+    if field.get('mode') == 'REPEATED':
+        return {'name': field['name'], 'type': {'type': 'array', 'items': ftype}, 'default': []}
+    if field.get('mode') == 'REQUIRED':
+        return {'name': field['name'], 'type': ftype}
+    return {'name': field['name'], 'type': ['null', ftype], 'default': None}
+
+
+def avro_schema(fields, name='build'):
+    """Convert a BigQuery JSON schema into an Avro record schema."""
+    return {'type': 'record', 'name': name,
+            'fields': [_avro_field(f, name) for f in fields]}
+
+
+def timestamp_fields(fields):
+    """Return the names of top-level TIMESTAMP fields, whose rows hold epoch seconds."""
+    return [f['name'] for f in fields if f['type'] == 'TIMESTAMP' and f.get('mode') != 'REPEATED']
+
+
+class AvroRowWriter:
+    """
+    Write rows to a binary file as deflated Avro blocks.
+
+    Rows are the dicts make_json.row_for_build returns: missing fields are
+    written as null, and timestamps (epoch seconds) as microseconds.
+    """
+
+    def __init__(self, fp, compress_level=6, fields=None, block_size=BLOCK_SIZE):
+        # pylint: disable=import-outside-toplevel
+        import fastavro  # only needed for --format=avro, and not available under pypy
+        fields = fields if fields is not None else load_schema()
+        self.timestamps = timestamp_fields(fields)
+        self.writer = fastavro.write.Writer(
+            fp, fastavro.parse_schema(avro_schema(fields)), codec='deflate',
+            sync_interval=block_size, compression_level=compress_level)
+
+    def write(self, row):
+        for name in self.timestamps:
+            if row.get(name) is not None:
+                row = dict(row, **{name: int(row[name] * 1000000)})
+        self.writer.write(row)
+
+    def close(self):
+        self.writer.flush()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import datetime
+import io
+import json
+import unittest
+
+import fastavro
+
+import columnar
+import make_json
+import model
+
+
+def strip_nulls(value):
+    """Drop None fields, which JSON rows leave out and Avro rows fill in."""
+    if isinstance(value, dict):
+        return {k: strip_nulls(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [strip_nulls(v) for v in value]
+    return value
+
+
+class ColumnarTest(unittest.TestCase):
+    def test_avro_schema(self):
+        schema = columnar.avro_schema(columnar.load_schema())
+        fields = {f['name']: f for f in schema['fields']}
+        self.assertEqual(fields['elapsed']['type'], ['null', 'double'])
+        self.assertEqual(fields['started']['type'],
+                         ['null', {'type': 'long', 'logicalType': 'timestamp-micros'}])
+        self.assertEqual(fields['metadata']['type']['type'], 'array')
+        self.assertEqual([f['name'] for f in fields['test']['type']['items']['fields']],
+                         ['name', 'time', 'failed', 'failure_text'])
+        self.assertEqual(columnar.timestamp_fields(columnar.load_schema()),
+                         ['started', 'finished'])
+
+    def test_round_trip(self):
+        db = model.Database(':memory:')
+        for n in range(20):
+            path = 'gs://kubernetes-jenkins/logs/some-job/%d' % n
+            db.insert_build(
+                path, {'timestamp': 1600000000 + n, 'node': 'node-%d' % n},
+                {'timestamp': 1600000100 + n, 'result': 'SUCCESS' if n % 3 else 'FAILURE',
+                 'metadata': {'pod': 'p%d' % n, 'repos': {'k8s': 'master'}}})
+            db.insert_build_junits(n + 1, {
+                path + '/artifacts/junit.xml':
+                '<testsuite><testcase name="t%d" time="1.5"/>'
+                '<testcase name="ué"><failure>boom %d</failure></testcase></testsuite>'
+                % (n, n)})
+        db.commit()
+
+        def run(args):
+            buf = io.BytesIO()
+            make_json.main(db, make_json.parse_args(['--reset-emitted'] + args), buf)
+            return buf.getvalue()
+
+        expected = [json.loads(line) for line in run([]).splitlines()]
+        self.assertEqual(len(expected), 20)
+        for args in [['--format=avro'], ['--format=avro', '--compress-level=0']]:
+            got = []
+            for row in fastavro.reader(io.BytesIO(run(args))):
+                for key in ['started', 'finished']:
+                    row[key] = int(row[key].replace(tzinfo=datetime.timezone.utc).timestamp())
+                got.append(strip_nulls(row))
+            self.assertEqual(got, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Delete old junits that every table has emitted, and shrink the database file.
+
+Only make_json reads junits, and only for builds it hasn't emitted yet, so
+once every incremental table has emitted a build (or moved its window past
+it) the junits are dead weight. This deletes them in short transactions,
+optionally archiving them first, then returns the freed pages to the
+filesystem with incremental vacuum steps until --time-limit runs out.
+"""
+
+import argparse
+import sys
+import time
+
+import model
+
+SECONDS_PER_DAY = 86400
+# Longer than the 30 day window of the largest table, so a reset re-emits tests.
+RETAIN_DAYS = 45
+# Seconds to sleep between vacuum steps, letting make_db and stream write.
+VACUUM_PAUSE = 0.05
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=float, default=RETAIN_DAYS,
+                        help='Keep junits of builds that finished in the last N days.')
+    parser.add_argument('--table', action='append', default=None,
+                        help='Incremental table that must have emitted a build before its'
+                        ' junits are deleted. May be repeated. (default: every table)')
+    parser.add_argument('--archive',
+                        help='Copy junits to this SQLite file before deleting them.')
+    parser.add_argument('--time-limit', type=float, default=300,
+                        help='Stop compacting and vacuuming after N seconds.')
+    parser.add_argument('--vacuum-pages', type=int, default=model.VACUUM_PAGES,
+                        help='Free pages to release per vacuum step.')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='Rewrite a database made before incremental vacuum so it can'
+                        ' shrink. Slow, and blocks writers while it runs; needed once.')
+    return parser.parse_args(args)
+
+
+def main(db, opts):
+    start = time.time()
+    deadline = start + opts.time_limit
+    if opts.enable_incremental_vacuum and db.enable_incremental_vacuum():
+        print('enabled incremental vacuum in %.1fs' % (time.time() - start), file=sys.stderr)
+
+    builds, files, blobs = db.compact_junits(
+        time.time() - opts.days * SECONDS_PER_DAY, tables=opts.table,
+        archive=opts.archive, deadline=deadline)
+    print('compacted %d builds: deleted %d junits, %d blobs' % (builds, files, blobs),
+          file=sys.stderr)
+
+    free = db.vacuum_step(opts.vacuum_pages)
+    while free and time.time() < deadline:
+        time.sleep(VACUUM_PAUSE)
+        free = db.vacuum_step(opts.vacuum_pages)
+    db.checkpoint()
+    print('vacuumed in %.1fs, %d free pages left' % (time.time() - start, free), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    DB = model.connect()
+    OPTIONS = parse_args(sys.argv[1:])
+    sys.exit(main(DB, OPTIONS))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import compact
+import model
+
+
+class CompactTest(unittest.TestCase):
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'build.db')
+            sqlite3.connect(path).execute('create table file(path string primary key, data)')
+            db = model.Database(path)
+            self.assertEqual(db.db.execute('pragma auto_vacuum').fetchone(), (0,))
+            old = time.time() - 50 * compact.SECONDS_PER_DAY
+            for num, finished in enumerate([old, old + 1, time.time()], 1):
+                build = '/some/dir/%d' % num
+                db.insert_build(build, {'timestamp': finished - 10}, {'timestamp': finished})
+                db.insert_build_junits(num, {build + '/junit.xml': os.urandom(50000).hex()})
+            db.insert_emitted([1, 2, 3])
+            size = os.path.getsize(path) + os.path.getsize(path + '-wal')
+
+            self.assertEqual(compact.main(db, compact.parse_args(
+                ['--enable-incremental-vacuum', '--vacuum-pages=10'])), 0)
+            self.assertEqual(db.db.execute('pragma auto_vacuum').fetchone(), (2,))
+            self.assertEqual([bool(db.test_results_for_build('/some/dir/%d/' % num))
+                              for num in (1, 2, 3)], [False, False, True])
+            self.assertEqual(db.db.execute('pragma freelist_count').fetchone(), (0,))
+            self.assertLess(os.path.getsize(path), size / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process stand-ins for Pub/Sub, BigQuery and GCS, for running stream.py offline."""
+
+import collections
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+import make_db
+
+
+PubSubMessage = collections.namedtuple('PubSubMessage', 'data attributes')
+ReceivedMessage = collections.namedtuple('ReceivedMessage', 'ack_id message')
+PullResponse = collections.namedtuple('PullResponse', 'received_messages')
+
+
+class FakeSubscriber:
+    """
+    A Pub/Sub subscriber client serving published messages from memory.
+
+    Messages are delivered once their publish time comes, and redelivered with
+    a new ack_id if they aren't acknowledged before their ack deadline. Every
+    call takes latency seconds, and a pull that isn't return_immediately waits
+    up to pull_timeout seconds for a message.
+    """
+
+    def __init__(self, latency=0, ack_deadline=10, pull_timeout=1):
+        self.latency = latency
+        self.ack_deadline = ack_deadline
+        self.pull_timeout = pull_timeout
+        self.lock = threading.Lock()
+        self.messages = []  # [message id, PubSubMessage, publish time], in publish order
+        self.available = collections.deque()  # ready to deliver, but not yet pulled
+        self.next_message = 0  # index of the first message not yet in available
+        self.outstanding = {}  # ack_id: [message id, deadline]
+        self.deliveries = 0
+        self.published = {}  # message id: publish time
+        self.acked = {}  # message id: first ack time
+
+    def publish(self, attributes, data='', publish_time=None):
+        """Queue a message for delivery at publish_time (default now)."""
+        with self.lock:
+            message_id = len(self.messages)
+            publish_time = time.time() if publish_time is None else publish_time
+            self.messages.append((message_id, PubSubMessage(data, attributes), publish_time))
+            self.published[message_id] = publish_time
+            return message_id
+
+    def pending(self):
+        """Return the number of published messages not acknowledged yet."""
+        with self.lock:
+            return len(self.published) - len(self.acked)
+
+    def _ready(self, now):
+        while self.next_message < len(self.messages):
+            if self.messages[self.next_message][2] > now:
+                break
+            self.available.append(self.messages[self.next_message])
+            self.next_message += 1
+        for ack_id, (message_id, deadline) in list(self.outstanding.items()):
+            if deadline < now:
+                del self.outstanding[ack_id]
+                self.available.append(self.messages[message_id])
+        return bool(self.available)
+
+    def pull(self, subscription, max_messages=1000, return_immediately=False):
+        # pylint: disable=unused-argument
+        time.sleep(self.latency)
+        deadline = time.time() + (0 if return_immediately else self.pull_timeout)
+        while True:
+            now = time.time()
+            with self.lock:
+                if self._ready(now) or now >= deadline:
+                    received = []
+                    while self.available and len(received) < max_messages:
+                        message_id, message, _ = self.available.popleft()
+                        if message_id in self.acked:
+                            continue
+                        self.deliveries += 1
+                        ack_id = '%d-%d' % (message_id, self.deliveries)
+                        self.outstanding[ack_id] = [message_id, now + self.ack_deadline]
+                        received.append(ReceivedMessage(ack_id, message))
+                    return PullResponse(received)
+            time.sleep(min(0.01, max(0, deadline - now)))
+
+    def acknowledge(self, subscription, ack_ids):
+        # pylint: disable=unused-argument
+        time.sleep(self.latency)
+        now = time.time()
+        with self.lock:
+            for ack_id in ack_ids:
+                message_id, _ = self.outstanding.pop(ack_id, (None, None))
+                if message_id is not None:
+                    self.acked.setdefault(message_id, now)
+
+    def modify_ack_deadline(self, subscription, ack_ids, ack_deadline_seconds):
+        # pylint: disable=unused-argument
+        time.sleep(self.latency)
+        deadline = time.time() + ack_deadline_seconds
+        with self.lock:
+            for ack_id in ack_ids:
+                if ack_id in self.outstanding:
+                    self.outstanding[ack_id][1] = deadline
+
+
+class FakeTable:
+    def __init__(self, name, schema=None):
+        self.full_table_id = f'fake.build.{name}'
+        self.schema = schema or []
+
+
+class RequestEntityTooLarge(Exception):
+    code = 413
+
+
+class FakeBigQueryClient:
+    """
+    A BigQuery client accepting streaming inserts into memory.
+
+    Each insert takes latency seconds, and raises RequestEntityTooLarge if its
+    rows serialise to more than max_request_bytes.
+    """
+
+    def __init__(self, latency=0, max_request_bytes=10 * 1024 * 1024):
+        self.latency = latency
+        self.max_request_bytes = max_request_bytes
+        self.lock = threading.Lock()
+        self.rows = collections.defaultdict(list)  # full_table_id: [row]
+        self.requests = 0
+
+    def insert_rows(self, table, rows, skip_invalid_rows=False):
+        # pylint: disable=unused-argument
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+        if len(json.dumps(rows)) > self.max_request_bytes:
+            raise RequestEntityTooLarge('Request Entity Too Large')
+        with self.lock:
+            self.rows[table.full_table_id].extend(rows)
+        return []
+
+
+class FakeResponse:
+    """The part of a streaming requests.Response that GCSClient uses."""
+
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+        self.headers = {'x-goog-generation': '1'}
+
+    @property
+    def text(self):
+        return self.data.decode('utf-8')
+
+    def iter_content(self, chunk_size):
+        return (self.data[n:n + chunk_size] for n in range(0, len(self.data), chunk_size))
+
+    def close(self):
+        pass
+
+
+class SyntheticGCSClient(make_db.GCSClient):
+    """
+    A GCSClient serving generated builds for every <bucket>/<dir>/<job>/<number>/.
+
+    Each build has a started.json, a finished.json and one junit with the given
+    number of tests, generated deterministically from its path. Every request
+    takes latency seconds.
+    """
+
+    def __init__(self, jobs_dir, metadata=None, listing_cache=None, latency=0, tests=20):
+        super().__init__(jobs_dir, metadata, listing_cache)
+        self.latency = latency
+        self.tests = tests
+
+    def build_object(self, name):
+        """Return the contents of the named object, or None if there isn't one."""
+        build_dir, _, basename = name.rpartition('/')
+        if basename.startswith('junit') and build_dir.endswith('/artifacts'):
+            build_dir = build_dir[:-len('/artifacts')]
+        try:
+            number = int(build_dir.rpartition('/')[2])
+        except ValueError:
+            return None
+        rand = random.Random(build_dir)
+        started = 1600000000 + number * 60
+        failures = [n for n in range(self.tests) if rand.random() < 0.02]
+        if basename == 'started.json':
+            return {'timestamp': started, 'node': 'node-%d' % rand.randrange(100)}
+        if basename == 'finished.json':
+            return {'timestamp': started + rand.randrange(60, 3600),
+                    'result': 'FAILURE' if failures else 'SUCCESS',
+                    'passed': not failures}
+        if basename == 'junit_01.xml':
+            cases = []
+            for n in range(self.tests):
+                failure = '<failure>timed out waiting for %d</failure>' % n if n in failures else ''
+                cases.append('<testcase name="Test %d" time="%.2f">%s'
+                             '<system-out>log line\n</system-out></testcase>'
+                             % (n, rand.random() * 10, failure))
+            return '<testsuite>%s</testsuite>' % ''.join(cases)
+        return None
+
+    def _request(self, path, params, as_json=True):
+        time.sleep(self.latency)
+        bucket, _, name = path.partition('/o')
+        if not name:  # a listing
+            prefix = params['prefix']
+            if prefix.endswith('/artifacts/'):
+                return {'items': [{'name': prefix + 'junit_01.xml'}]}
+            return {}
+        data = self.build_object(urllib.parse.unquote(name[1:]))
+        if data is None:
+            return None
+        if as_json:
+            return data
+        return json.dumps(data) if isinstance(data, dict) else data
+
+    def _request_stream(self, path, params):
+        data = self._request(path, params, as_json=False)
+        if data is None:
+            return None
+        return FakeResponse(data.encode('utf-8'))
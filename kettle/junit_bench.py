@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark make_json's junit parser engines.
+
+Each engine's output is checked against the etree engine before it's timed.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import timeit
+
+import make_json
+
+
+def synthetic_junit(cases):
+    """Return a large e2e-style junit with the given number of testcases."""
+    lines = ['<testsuites>', '<testsuite name="Kubernetes e2e suite">']
+    for n in range(cases):
+        lines.append('<testcase name="[sig-node] Pods should run pod %d [Conformance]"'
+                     ' classname="Kubernetes e2e suite" time="%d.5">' % (n, n % 100))
+        if n % 50 == 0:
+            lines.append('<failure type="Failure">test/e2e/framework.go:%d: timed out'
+                         ' waiting for the condition</failure>' % n)
+        elif n % 3 == 0:
+            lines.append('<skipped></skipped>')
+        lines.append('<system-out>%s</system-out>' % ('I0101 log line\n' * 20))
+        lines.append('</testcase>')
+    lines += ['</testsuite>', '</testsuites>']
+    return '\n'.join(lines)
+
+
+def available_parsers():
+    parsers = []
+    for name, parse in sorted(make_json.JUNIT_PARSERS.items()):
+        try:
+            list(parse('<testsuite/>'))
+        except ImportError:
+            continue
+        parsers.append(name)
+    return parsers
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Parse each document this many times per engine.')
+    parser.add_argument('--cases', type=int, default=5000,
+                        help='Testcases in the synthetic junit, 0 to skip it.')
+    parser.add_argument('files', nargs='*',
+                        help='Junit files to parse (default: testdata/*.xml).')
+    opts = parser.parse_args(args)
+
+    files = opts.files or sorted(glob.glob(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', '*.xml')))
+    docs = []
+    for path in files:
+        with open(path) as fp:
+            docs.append((os.path.basename(path), fp.read()))
+    if opts.cases:
+        docs.append(('synthetic-%d' % opts.cases, synthetic_junit(opts.cases)))
+
+    parsers = available_parsers()
+    stdout = sys.stdout
+    sys.stdout = sys.stderr  # engines print on malformed input
+    try:
+        for name, xml in docs:
+            expected = list(make_json.parse_junit_etree(xml))
+            for engine in parsers:
+                parse = make_json.JUNIT_PARSERS[engine]
+                if list(parse(xml)) != expected:
+                    print('%s: %s output differs from etree' % (name, engine), file=stdout)
+                    return 1
+                # pylint: disable=cell-var-from-loop
+                seconds = timeit.timeit(lambda: list(parse(xml)), number=opts.repeat)
+                print('%-40s %-10s %10.3f ms %10.1f MB/s' % (
+                    name, engine, seconds / opts.repeat * 1000,
+                    len(xml) * opts.repeat / seconds / 1e6), file=stdout)
+    finally:
+        sys.stdout = stdout
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -16,22 +16,31 @@
 
 
 import argparse
+import asyncio
+import collections
+import functools
 import logging
 import json
 import os
+import queue
 import random
 import re
 import signal
+import sqlite3
 import sys
+import threading
 import time
 import urllib.parse
 from xml.etree import cElementTree as ET
+from xml.parsers import expat
 
 import multiprocessing
 import multiprocessing.pool
 import requests
 import ruamel.yaml as yaml
 
+import make_json
+import metrics
 import model
 
 
@@ -40,12 +49,369 @@ def pad_numbers(string):
     return re.sub(r'\d+', lambda m: m.group(0).rjust(16, '0'), string)
 
 WORKER_CLIENT = None  # used for multiprocessing
+THROTTLE = None  # a Throttle shared by every GCSClient, if set
+OBJECT_CACHE = None  # an ObjectCache for every GCSClient's small objects, if set
+
+# Builds fetched by get_all_builds are written to the database in batches of this size.
+INSERT_BATCH_SIZE = 1000
+# Fetched builds and junits are committed at least this often, in seconds, so
+# a restarted make_db loses little work.
+CHECKPOINT_INTERVAL = 30
+# A restarted make_db skips buckets and jobs finished by the interrupted pass
+# up to this many seconds ago.
+CHECKPOINT_MAX_AGE = 60 * 60 * 24
+
+# Streamed junit downloads are read in chunks of this many bytes.
+JUNIT_CHUNK_SIZE = 1 << 16
+
+# Non-sequential jobs are listed in full at most this often; in between only
+# builds sorting after the last one seen are listed.
+LISTING_MAX_AGE = 60 * 60 * 24 * 7
+
+# How many requests AsyncGCSClient keeps in flight, and over how many connections.
+# HTTP/2 multiplexes ~100 concurrent streams per connection to GCS.
+ASYNC_CONCURRENCY = 1000
+ASYNC_CONNECTIONS = 16
+
+# Default for --gcs-qps: the most GCS requests per second, across every worker.
+GCS_MAX_QPS = 1000
+
+
+GCS_REQUESTS = metrics.Counter(
+    'kettle_gcs_requests_total',
+    'GCS requests by HTTP status code, or "error" if no response arrived.', ['code'])
+GCS_REQUEST_SECONDS = metrics.Histogram(
+    'kettle_gcs_request_seconds', 'Time taken by each GCS request attempt.')
+GCS_RETRIES = metrics.Counter(
+    'kettle_gcs_request_retries_total', 'GCS requests retried after a failed attempt.')
+JUNIT_BYTES = metrics.Counter(
+    'kettle_junit_downloaded_bytes_total', 'Bytes of junit XML downloaded from GCS.')
+
+
+class Throttle:
+    """A GCS request rate limit and retry budget shared by every process using it.
+
+    Requests take tokens from a bucket refilled at an adaptive rate. Each
+    success raises the rate by RATE_INCREASE/rate, about RATE_INCREASE per
+    second at full speed, up to max_rate. A 429 or 5xx halves it, at most once
+    per DECREASE_INTERVAL, since concurrent requests tend to fail together.
+
+    Retries spend from a budget that successes add RETRY_RATIO to. While it
+    lasts, a failed request retries as soon as the bucket allows; once it's
+    spent, retries fall back to exponential backoff, so a struggling GCS
+    isn't sent a storm of retries on top of the usual load.
+
+    The state lives in shared memory, so pass a Throttle to worker processes
+    when they're created, e.g. as a Pool initializer argument.
+    """
+
+    RATE_INCREASE = 10
+    DECREASE_INTERVAL = 1
+    RETRY_RATIO = 0.1
+    RETRY_BUDGET = 100
+
+    TOKENS, UPDATED, RATE, DECREASED, RETRIES = range(5)
+
+    def __init__(self, max_rate, min_rate=1):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.state = multiprocessing.Array('d', 5)
+        self.state[:] = [max_rate, time.monotonic(), max_rate, 0, self.RETRY_BUDGET]
+
+    @property
+    def rate(self):
+        return self.state[self.RATE]
+
+    def acquire(self):
+        """Wait until a request may be sent."""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """Take a token and return 0 if a request may be sent, else how long to wait for one.
+
+        For callers that can't block, e.g. coroutines, which sleep and try again.
+        """
+        state = self.state
+        with state.get_lock():
+            now = time.monotonic()
+            # At most a second's worth of tokens accumulate while idle.
+            state[self.TOKENS] = min(
+                max(1, state[self.RATE]),
+                state[self.TOKENS] + (now - state[self.UPDATED]) * state[self.RATE])
+            state[self.UPDATED] = now
+            if state[self.TOKENS] >= 1:
+                state[self.TOKENS] -= 1
+                return 0
+            return (1 - state[self.TOKENS]) / state[self.RATE]
+
+    def observe(self, code):
+        """Adapt the rate to a response's HTTP status code."""
+        state = self.state
+        with state.get_lock():
+            if code == 429 or code >= 500:
+                now = time.monotonic()
+                if now - state[self.DECREASED] >= self.DECREASE_INTERVAL:
+                    state[self.RATE] = max(self.min_rate, state[self.RATE] / 2)
+                    state[self.DECREASED] = now
+            else:
+                state[self.RATE] = min(
+                    self.max_rate, state[self.RATE] + self.RATE_INCREASE / state[self.RATE])
+                state[self.RETRIES] = min(
+                    self.RETRY_BUDGET, state[self.RETRIES] + self.RETRY_RATIO)
+
+    def spend_retry(self):
+        """Return whether the retry budget allows retrying right away, spending from it if so."""
+        state = self.state
+        with state.get_lock():
+            if state[self.RETRIES] >= 1:
+                state[self.RETRIES] -= 1
+                return True
+            return False
+
+
+def record_gcs_request(start, code):
+    GCS_REQUEST_SECONDS.observe(time.time() - start)
+    GCS_REQUESTS.inc(code=code)
+    if THROTTLE is not None and code != 'error':
+        THROTTLE.observe(code)
+
+
+def gcs_backoff_delay(retry):
+    """Return how long to wait before retrying a GCS request."""
+    if THROTTLE is not None and THROTTLE.spend_retry():
+        return 0  # THROTTLE.acquire paces the retry
+    return random.random() * min(60, 2 ** retry)
+
+
+def gcs_backoff(retry):
+    """Wait before retrying a GCS request."""
+    time.sleep(gcs_backoff_delay(retry))
+
+
+def count_junit_bytes(chunks):
+    for chunk in chunks:
+        JUNIT_BYTES.inc(len(chunk))
+        yield chunk
+
+
+class ListingCache:
+    """Build listings of one bucket's jobs, loaded from and saved to the database.
+
+    Bucket listing runs on whichever thread consumes GCSClient.get_builds, so the
+    cache is held in memory and saved by the thread that owns the database.
+    """
+
+    def __init__(self, db, jobs_dir):
+        self.db = db
+        self.listings = db.get_listings(jobs_dir)
+        self.updates = collections.deque()  # appended on the listing thread
+
+    def get_listing(self, job_dir):
+        return self.listings.get(job_dir, ([], None))
+
+    def set_listing(self, job_dir, builds, full):
+        self.updates.append((job_dir, builds, full))
+
+    def save(self):
+        while self.updates:
+            job_dir, builds, full = self.updates.popleft()
+            self.db.set_listing(job_dir, builds, full)
+
+
+class Checkpoint:
+    """Which jobs of a bucket have every build inserted, so a restarted make_db skips them.
+
+    GCSClient.get_builds reports each job it has finished listing from the
+    thread that feeds the workers. Results come back unordered on the thread
+    that owns the database, which calls save() after inserting them. A job is
+    done once every build listed for it has come back.
+    """
+
+    def __init__(self, db, jobs_dir, max_age=CHECKPOINT_MAX_AGE):
+        self.db = db
+        self.jobs_dir = jobs_dir
+        self.done = db.get_backfilled(jobs_dir, time.time() - max_age)
+        self.listed = collections.deque()  # (job, builds yielded), appended on the listing thread
+        self.waiting = []  # listed jobs with builds still to come back
+        self.returned = collections.Counter()
+
+    def listed_job(self, job, builds):
+        self.listed.append((job, builds))
+
+    def returned_build(self, build_dir):
+        self.returned[build_dir[len(self.jobs_dir):].partition('/')[0]] += 1
+
+    def save(self):
+        """Record the jobs whose builds have all come back. Call once they're inserted."""
+        while self.listed:
+            self.waiting.append(self.listed.popleft())
+        done = [job for job, builds in self.waiting if self.returned[job] >= builds]
+        self.waiting = [(job, builds) for job, builds in self.waiting
+                        if self.returned[job] < builds]
+        for job in done:
+            del self.returned[job]
+        self.db.set_backfilled(self.jobs_dir, done)
+
+
+# Default for --gcs-cache-size: the most bytes of small objects ObjectCache keeps.
+OBJECT_CACHE_BYTES = 256 << 20
+
+GCS_CACHE_REQUESTS = metrics.Counter(
+    'kettle_gcs_cache_requests_total',
+    'Small object reads by result: hit, revalidated (304), miss, or missing object.', ['result'])
+
+# Objects that don't change once written, so a cached copy is used without asking GCS.
+IMMUTABLE_OBJECT_RE = re.compile(r'/started\.json$|/directory/[^/]+/[^/]+\.txt$')
+# Objects that may be rewritten, so a cached copy is revalidated by its generation.
+MUTABLE_OBJECT_RE = re.compile(r'/finished\.json$|/latest-build\.txt$')
+NOT_MODIFIED = object()
+
+
+class ObjectCache:
+    """Small GCS objects, kept in an SQLite file by path and generation.
+
+    Used by GCSClient.get and AsyncGCSClient.get for started.json, PR directory
+    pointers (both used as cached), and finished.json and latest-build.txt
+    (revalidated with ifGenerationNotMatch, so unchanged objects come back as
+    an empty 304).
+    Least recently used objects are evicted once the data exceeds max_bytes.
+
+    Every process and thread gets its own connection, and concurrent reads
+    of a path within a process wait for the first one's request.
+    """
+
+    # A hit only updates an object's last use if it's older than this, to spare writes.
+    USED_RESOLUTION = 3600
+    # Total size is rechecked after this many writes by a process.
+    EVICT_CHECK_WRITES = 1000
+
+    def __init__(self, path, max_bytes=OBJECT_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.pid = None
+        self._db().executescript('''
+            create table if not exists object(
+                path text primary key, generation integer, data text, used real);
+            create index if not exists object_used_idx on object(used)
+            ''')
+
+    def __getstate__(self):
+        return {'path': self.path, 'max_bytes': self.max_bytes, 'pid': None}
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.inflight = {}  # path: [threading.Event, result, exception]
+        self.writes = 0
+
+    def _db(self):
+        if self.pid != os.getpid():
+            self._reset()  # nothing from before a fork is safe to use
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.execute('pragma journal_mode=wal')
+            db.execute('pragma synchronous=normal')
+        return db
+
+    def get(self, path):
+        """Return (generation, data) for a cached object, or None."""
+        db = self._db()
+        row = db.execute('select generation, data, used from object where path=?',
+                         (path,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if row[2] < now - self.USED_RESOLUTION:
+            db.execute('update object set used=? where path=?', (now, path))
+        return row[0], row[1]
+
+    def put(self, path, generation, data):
+        db = self._db()
+        db.execute('replace into object values(?,?,?,?)', (path, generation, data, time.time()))
+        self.writes += 1
+        if self.writes % self.EVICT_CHECK_WRITES == 0:
+            self.evict()
+
+    def evict(self):
+        """Delete the least recently used objects until the data fits in max_bytes."""
+        db = self._db()
+        count, size = db.execute('select count(*), sum(length(data)) from object').fetchone()
+        if not size or size <= self.max_bytes:
+            return
+        # Evict down to 90%, assuming objects are of average size.
+        excess = count * (size - self.max_bytes * 0.9) / size
+        db.execute('delete from object where path in'
+                   ' (select path from object order by used limit ?)', (int(excess) + 1,))
+
+    def fetch(self, path, fetch):
+        """
+        Return the data of an object, or None if it's missing.
+
+        fetch(generation) is called to get the object from GCS unless a cached
+        copy of an immutable object exists. generation is the cached copy's or
+        None. It returns (generation, data), NOT_MODIFIED, or None.
+        """
+        cached = self.get(path)
+        if cached is not None and IMMUTABLE_OBJECT_RE.search(path):
+            GCS_CACHE_REQUESTS.inc(result='hit')
+            return cached[1]
+        with self.lock:
+            pending = self.inflight.get(path)
+            leader = pending is None
+            if leader:
+                pending = self.inflight[path] = [threading.Event(), None, None]
+        if not leader:
+            pending[0].wait()
+            if pending[2] is not None:
+                raise pending[2]
+            return pending[1]
+        try:
+            pending[1] = self._store(path, cached, fetch(cached and cached[0]))
+        except Exception as err:
+            pending[2] = err
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[path]
+            pending[0].set()
+        return pending[1]
+
+    async def fetch_async(self, path, fetch):
+        """Like fetch, for a coroutine function fetch.
+
+        Concurrent reads of a path aren't merged, since the event loop can't
+        wait on another thread's request.
+        """
+        cached = self.get(path)
+        if cached is not None and IMMUTABLE_OBJECT_RE.search(path):
+            GCS_CACHE_REQUESTS.inc(result='hit')
+            return cached[1]
+        return self._store(path, cached, await fetch(cached and cached[0]))
+
+    def _store(self, path, cached, result):
+        """Cache the result of fetching path and return its data."""
+        if result is NOT_MODIFIED:
+            GCS_CACHE_REQUESTS.inc(result='revalidated')
+            return cached[1]
+        if result is None:
+            GCS_CACHE_REQUESTS.inc(result='missing')
+            return None
+        GCS_CACHE_REQUESTS.inc(result='miss')
+        self.put(path, *result)
+        return result[1]
 
 
 class GCSClient:
-    def __init__(self, jobs_dir, metadata=None):
+    def __init__(self, jobs_dir, metadata=None, listing_cache=None):
         self.jobs_dir = jobs_dir
         self.metadata = metadata or {}
+        self.listing_cache = listing_cache
         self.session = requests.Session()
 
     def _request(self, path, params, as_json=True):
@@ -57,8 +423,15 @@ class GCSClient:
         """
         url = f'https://www.googleapis.com/storage/v1/b/{path}'
         for retry in range(23):
+            if retry:
+                GCS_RETRIES.inc()
+            if THROTTLE is not None:
+                THROTTLE.acquire()
+            start = time.time()
+            resp = None
             try:
                 resp = self.session.get(url, params=params, stream=False)
+                record_gcs_request(start, resp.status_code)
                 if 400 <= resp.status_code < 500 and resp.status_code != 429:
                     return None
                 resp.raise_for_status()
@@ -71,8 +444,38 @@ class GCSClient:
                         return None
                 return resp.text
             except requests.exceptions.RequestException:
+                if resp is None:
+                    record_gcs_request(start, 'error')
                 logging.exception('request failed %s', url)
-            time.sleep(random.random() * min(60, 2 ** retry))
+            gcs_backoff(retry)
+
+    def _request_stream(self, path, params):
+        """GETs a resource from GCS as a streaming response, with retries on failure.
+
+        Only establishing the response is retried; see _request.
+        """
+        url = f'https://www.googleapis.com/storage/v1/b/{path}'
+        for retry in range(23):
+            if retry:
+                GCS_RETRIES.inc()
+            if THROTTLE is not None:
+                THROTTLE.acquire()
+            start = time.time()
+            resp = None
+            try:
+                resp = self.session.get(url, params=params, stream=True)
+                record_gcs_request(start, resp.status_code)
+                if 400 <= resp.status_code < 500 and resp.status_code != 429:
+                    resp.close()
+                    return None
+                resp.raise_for_status()
+                return resp
+            except requests.exceptions.RequestException:
+                if resp is None:
+                    record_gcs_request(start, 'error')
+                logging.exception('request failed %s', url)
+            gcs_backoff(retry)
+        return None
 
     @staticmethod
     def _parse_uri(path):
@@ -83,22 +486,74 @@ class GCSClient:
 
     def get(self, path, as_json=False):
         """Get an object from GCS."""
+        if OBJECT_CACHE is not None and (
+                IMMUTABLE_OBJECT_RE.search(path) or MUTABLE_OBJECT_RE.search(path)):
+            data = OBJECT_CACHE.fetch(path, functools.partial(self._fetch_object, path))
+            if data is None or not as_json:
+                return data
+            try:
+                return json.loads(data)
+            except ValueError:
+                logging.error('Failed to decode %s', path)
+                return None
         bucket, prefix = self._parse_uri(path)
         return self._request(f'{bucket}/o/{urllib.parse.quote(prefix, "")}',
                              {'alt': 'media'}, as_json=as_json)
 
+    def _fetch_object(self, path, generation=None):
+        """Get (generation, text) of an object, NOT_MODIFIED if it's still at generation,
+        or None if it's missing."""
+        bucket, prefix = self._parse_uri(path)
+        params = {'alt': 'media'}
+        if generation:
+            params['ifGenerationNotMatch'] = generation
+        resp = self._request_stream(f'{bucket}/o/{urllib.parse.quote(prefix, "")}', params)
+        if resp is None:
+            return None
+        try:
+            if resp.status_code == 304:
+                return NOT_MODIFIED
+            return int(resp.headers.get('x-goog-generation') or 0), resp.text
+        finally:
+            resp.close()
+
+    def get_chunks(self, path, chunk_size=JUNIT_CHUNK_SIZE):
+        """Get an object from GCS as a generator of bytes, or None if it's missing.
+
+        Close the generator if it isn't exhausted, to return its connection to the pool.
+        """
+        bucket, prefix = self._parse_uri(path)
+        resp = self._request_stream(f'{bucket}/o/{urllib.parse.quote(prefix, "")}',
+                                    {'alt': 'media'})
+        if resp is None:
+            return None
+        return self._iter_content(resp, chunk_size)
+
+    @staticmethod
+    def _iter_content(resp, chunk_size):
+        try:
+            yield from resp.iter_content(chunk_size)
+        finally:
+            resp.close()
+
     def ls(self,
            path,
            dirs=True,
            files=True,
            delim=True,
            item_field='name',
-           build_limit=sys.maxsize,):
-        """Lists objects under a path on gcs."""
+           build_limit=sys.maxsize,
+           start_offset=None,):
+        """Lists objects under a path on gcs.
+
+        If start_offset is a gs:// path, only objects sorting at or after it are listed.
+        """
         # pylint: disable=invalid-name
 
         bucket, prefix = self._parse_uri(path)
         params = {'prefix': prefix, 'fields': 'nextPageToken'}
+        if start_offset:
+            params['startOffset'] = self._parse_uri(start_offset)[1]
         if delim:
             params['delimiter'] = '/'
             if dirs:
@@ -141,6 +596,41 @@ class GCSClient:
             junit = self.get(junit_path)
             if junit is None:
                 continue
+            JUNIT_BYTES.inc(len(junit))
+            files[junit_path] = junit
+        return files
+
+    def get_compressed_junits_from_build(self, build_dir, junit_dict=None, parsers=None):
+        """Downloads a build's junits in chunks without holding any of them in memory.
+
+        Returns {path: model.JunitEncoder result for the junit without <system-out>}.
+        If parsers is a list, a make_json.JunitParser fed each well-formed junit
+        as it streams by is appended to it. Malformed junits have no tests.
+        """
+        files = {}
+        assert not build_dir.endswith('/')
+        for junit_path in self._ls_junit_paths(build_dir + '/'):
+            chunks = self.get_chunks(junit_path)
+            if chunks is None:
+                continue
+            parser = None if parsers is None else make_json.JunitParser()
+            try:
+                junit = compress_junit(count_junit_bytes(chunks), junit_dict=junit_dict,
+                                       parser=parser)
+            finally:
+                chunks.close()  # compress_junit stops early on malformed XML
+            if junit is None:
+                # Malformed XML is stored as-is, like remove_system_out does.
+                chunks = self.get_chunks(junit_path)
+                if chunks is None:
+                    continue
+                try:
+                    junit = compress_junit(count_junit_bytes(chunks), strip=False,
+                                           junit_dict=junit_dict)
+                finally:
+                    chunks.close()
+            elif parser is not None:
+                parsers.append(parser)
             files[junit_path] = junit
         return files
 
@@ -149,6 +639,33 @@ class GCSClient:
         for job_path in self.ls_dirs(self.jobs_dir):
             yield os.path.basename(os.path.dirname(job_path))
 
+    def _list_builds(self, job):
+        """Lists the build names under a job.
+
+        With a listing cache, a job listed in full within LISTING_MAX_AGE is only
+        listed from its newest known build onwards, so each run costs O(new
+        builds) requests. GCS lists names lexically, so a build that gained a
+        digit sorts before the offset (1000 < 999). The job is listed in full
+        when its names differ in length, or when the newest is close to gaining
+        a digit. The periodic full listing picks up other stragglers.
+        """
+        job_dir = f'{self.jobs_dir}{job}/'
+        known, listed_time = [], None
+        if self.listing_cache is not None:
+            known, listed_time = self.listing_cache.get_listing(job_dir)
+        full = not known or listed_time < time.time() - LISTING_MAX_AGE
+        if not full:
+            newest = max(known, key=pad_numbers)
+            full = len({len(build) for build in known}) > 1 or newest.startswith('9')
+        start_offset = None if full else job_dir + newest
+        builds = [os.path.basename(os.path.dirname(b))
+                  for b in self.ls(job_dir, dirs=True, files=False, start_offset=start_offset)]
+        if self.listing_cache is not None:
+            self.listing_cache.set_listing(job_dir, builds, full)
+        if full:
+            return builds
+        return set(known).union(builds)
+
     def _get_builds(self, job, build_limit=sys.maxsize):
         '''Returns whether builds are precise (guarantees existence)'''
         if self.metadata.get('sequential', True):
@@ -159,10 +676,7 @@ class GCSClient:
             else:
                 return False, (str(n) for n in range(latest_build, 0, -1)[:build_limit])
         # Invalid latest-build or bucket is using timestamps
-        build_paths = self.ls_dirs(f'{self.jobs_dir}{job}/')
-        return True, sorted(
-            (os.path.basename(os.path.dirname(b)) for b in build_paths),
-            key=pad_numbers, reverse=True)[:build_limit]
+        return True, sorted(self._list_builds(job), key=pad_numbers, reverse=True)[:build_limit]
 
     def get_started_finished(self, job, build):
         if self.metadata.get('pr'):
@@ -173,8 +687,12 @@ class GCSClient:
         finished = self.get(f'{build_dir}/finished.json', as_json=True)
         return build_dir, started, finished
 
-    def get_builds(self, builds_have, build_limit=sys.maxsize):
-        """Generates all (job, build) pairs ever."""
+    def get_builds(self, builds_have, build_limit=sys.maxsize, checkpoint=None):
+        """Generates all (job, build) pairs ever.
+
+        With a Checkpoint, jobs it has done are skipped, and each job is reported
+        to it once listed.
+        """
         if self.metadata.get('pr'):
             files = self.ls(self.jobs_dir + '/directory/', delim=False, build_limit=build_limit)
             for fname in files:
@@ -187,7 +705,10 @@ class GCSClient:
         for job in self._get_jobs():
             if job in self.metadata.get('exclude_jobs', []):
                 continue
+            if checkpoint is not None and job in checkpoint.done:
+                continue
             have = 0
+            yielded = 0
             precise, builds = self._get_builds(job, build_limit)
             for build in builds:
                 if (job, build) in builds_have:
@@ -195,10 +716,249 @@ class GCSClient:
                     if have > 40 and not precise:
                         break
                     continue
+                yielded += 1
                 yield job, build
+            if checkpoint is not None:
+                checkpoint.listed_job(job, yielded)
+
+
+class AsyncGCSClient:
+    """An asyncio counterpart to GCSClient for fetching many small objects.
+
+    Every request shares one pooled HTTP/2 session, so thousands of requests can
+    be in flight over a handful of connections instead of one socket per process.
+    Like GCSClient, requests are limited by THROTTLE and small objects are read
+    through OBJECT_CACHE.
+    """
+
+    def __init__(self, jobs_dir, metadata=None, concurrency=ASYNC_CONCURRENCY):
+        self.jobs_dir = jobs_dir
+        self.metadata = metadata or {}
+        self.concurrency = concurrency
+        self.session = None
+
+    def _make_session(self):
+        import httpx  # pylint: disable=import-outside-toplevel
+        return httpx.AsyncClient(
+            http2=True,
+            # requests wait on the semaphore, never on the connection pool
+            timeout=httpx.Timeout(60, pool=None),
+            limits=httpx.Limits(max_connections=ASYNC_CONNECTIONS,
+                                max_keepalive_connections=ASYNC_CONNECTIONS))
+
+    async def _request_response(self, path, params):
+        """GETs a resource from GCS, with retries on failure.
+
+        Returns the response, or None if the resource is missing. See
+        GCSClient._request for the retry strategy. Requests are paced by
+        THROTTLE without blocking the event loop.
+        """
+        import httpx  # pylint: disable=import-outside-toplevel
+        url = f'https://www.googleapis.com/storage/v1/b/{path}'
+        for retry in range(23):
+            if retry:
+                GCS_RETRIES.inc()
+            if THROTTLE is not None:
+                wait = THROTTLE.try_acquire()
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = THROTTLE.try_acquire()
+            start = time.time()
+            resp = None
+            try:
+                resp = await self.session.get(url, params=params)
+                record_gcs_request(start, resp.status_code)
+                if 400 <= resp.status_code < 500 and resp.status_code != 429:
+                    return None
+                if resp.status_code != 304:  # 304: ifGenerationNotMatch matched
+                    resp.raise_for_status()
+                return resp
+            except httpx.HTTPError:
+                if resp is None:
+                    record_gcs_request(start, 'error')
+                logging.exception('request failed %s', url)
+            await asyncio.sleep(gcs_backoff_delay(retry))
+        return None
+
+    async def _request(self, path, params, as_json=True):
+        """GETs a JSON resource from GCS, with retries on failure."""
+        resp = await self._request_response(path, params)
+        if resp is None:
+            return None
+        if as_json:
+            try:
+                return resp.json()
+            except json.decoder.JSONDecodeError:
+                logging.error('Failed to decode request for %s', urllib.parse.unquote(path))
+                return None
+        return resp.text
+
+    _parse_uri = staticmethod(GCSClient._parse_uri)  # pylint: disable=protected-access
+
+    async def get(self, path, as_json=False):
+        """Get an object from GCS, through OBJECT_CACHE like GCSClient.get."""
+        if OBJECT_CACHE is not None and (
+                IMMUTABLE_OBJECT_RE.search(path) or MUTABLE_OBJECT_RE.search(path)):
+            data = await OBJECT_CACHE.fetch_async(
+                path, functools.partial(self._fetch_object, path))
+            if data is None or not as_json:
+                return data
+            try:
+                return json.loads(data)
+            except ValueError:
+                logging.error('Failed to decode %s', path)
+                return None
+        bucket, prefix = self._parse_uri(path)
+        return await self._request(f'{bucket}/o/{urllib.parse.quote(prefix, "")}',
+                                   {'alt': 'media'}, as_json=as_json)
+
+    async def _fetch_object(self, path, generation=None):
+        """See GCSClient._fetch_object."""
+        bucket, prefix = self._parse_uri(path)
+        params = {'alt': 'media'}
+        if generation:
+            params['ifGenerationNotMatch'] = generation
+        resp = await self._request_response(
+            f'{bucket}/o/{urllib.parse.quote(prefix, "")}', params)
+        if resp is None:
+            return None
+        if resp.status_code == 304:
+            return NOT_MODIFIED
+        return int(resp.headers.get('x-goog-generation') or 0), resp.text
+
+    async def ls(self,
+                 path,
+                 dirs=True,
+                 files=True,
+                 delim=True,
+                 item_field='name',
+                 build_limit=sys.maxsize,):
+        """Lists objects under a path on gcs."""
+        # pylint: disable=invalid-name
+        bucket, prefix = self._parse_uri(path)
+        params = {'prefix': prefix, 'fields': 'nextPageToken'}
+        if delim:
+            params['delimiter'] = '/'
+            if dirs:
+                params['fields'] += ',prefixes'
+        if files:
+            params['fields'] += f',items({item_field})'
+        while build_limit > 0:
+            resp = await self._request(f'{bucket}/o', params)
+            if resp is None:  # nothing under path?
+                return
+            for prefix in resp.get('prefixes', []):
+                build_limit -= 1
+                yield f'gs://{bucket}/{prefix}'
+            for item in resp.get('items', []):
+                build_limit -= 1
+                if item_field == 'name':
+                    yield f'gs://{bucket}/{item["name"]}'
+                else:
+                    yield item[item_field]
+            if 'nextPageToken' not in resp:
+                break
+            params['pageToken'] = resp['nextPageToken']
 
+    async def get_started_finished(self, job, build):
+        if self.metadata.get('pr'):
+            build_dir = (await self.get(f'{self.jobs_dir}/directory/{job}/{build}.txt')).strip()
+        else:
+            build_dir = f'{self.jobs_dir}{job}/{build}'
+        started, finished = await asyncio.gather(
+            self.get(f'{build_dir}/started.json', as_json=True),
+            self.get(f'{build_dir}/finished.json', as_json=True))
+        return build_dir, started, finished
+
+    async def _fetch_one(self, job, build, semaphore, emit):
+        try:
+            result = await self.get_started_finished(job, build)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('failed to get tests for %s/%s', job, build)
+            result = None, None, None
+        finally:
+            semaphore.release()
+        emit(result)
 
-def mp_init_worker(jobs_dir, metadata, client_class, use_signal=True):
+    async def _fetch_all(self, inputs, emit, done):
+        loop = asyncio.get_event_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        self.session = self._make_session()
+        try:
+            while True:
+                job_build = await loop.run_in_executor(None, inputs.get)
+                if job_build is done:
+                    break
+                await semaphore.acquire()
+                task = asyncio.ensure_future(self._fetch_one(*job_build, semaphore, emit))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            await self.session.aclose()
+            self.session = None
+
+    def iter_started_finished(self, jobs_and_builds):
+        """Generates (build_dir, started, finished) for each (job, build), unordered.
+
+        The event loop runs on a background thread. jobs_and_builds is consumed
+        and results are yielded on the calling thread, so a sqlite connection
+        used by either stays on the thread that created it.
+        """
+        inputs = queue.Queue(maxsize=self.concurrency)
+        results = queue.Queue()  # bounded by inputs and the semaphore
+        done = object()
+        errors = []
+
+        def run():
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self._fetch_all(inputs, results.put, done))
+            except BaseException as e:  # pylint: disable=broad-except
+                errors.append(e)
+            finally:
+                loop.close()
+                results.put(done)
+
+        thread = threading.Thread(target=run, name='async-gcs', daemon=True)
+        thread.start()
+
+        def put(item):
+            while thread.is_alive():
+                try:
+                    inputs.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        for job_build in jobs_and_builds:
+            put(job_build)
+            if not thread.is_alive():
+                break
+            while True:
+                try:
+                    result = results.get_nowait()
+                except queue.Empty:
+                    break
+                if result is done:  # the event loop died early
+                    results.put(done)
+                    break
+                yield result
+        put(done)
+        while True:
+            result = results.get()
+            if result is done:
+                break
+            yield result
+        thread.join()
+        if errors:
+            raise errors[0]
+
+
+def mp_init_worker(jobs_dir, metadata, client_class, use_signal=True, throttle=None,
+                   object_cache=None):
     """
     Initialize the environment for multiprocessing-based multithreading.
     """
@@ -207,8 +967,10 @@ def mp_init_worker(jobs_dir, metadata, client_class, use_signal=True):
         signal.signal(signal.SIGINT, signal.SIG_IGN)
     # Multiprocessing doesn't allow local variables for each worker, so we need
     # to make a GCSClient global variable.
-    global WORKER_CLIENT  # pylint: disable=global-statement
+    global WORKER_CLIENT, THROTTLE, OBJECT_CACHE  # pylint: disable=global-statement
     WORKER_CLIENT = client_class(jobs_dir, metadata)
+    THROTTLE = throttle
+    OBJECT_CACHE = object_cache
 
 def get_started_finished(job_info):
     (job, build) = job_info
@@ -222,13 +984,25 @@ def get_junits(build_info):
     (build_id, gcs_path) = build_info
     try:
         junits = WORKER_CLIENT.get_junits_from_build(gcs_path)
-        return build_id, gcs_path, junits
+        junits = {k: remove_system_out(v) for k, v in junits.items()}
+        return build_id, gcs_path, junits, parse_junits(gcs_path, junits.values())
+    except:
+        logging.exception('failed to get junits for %s', gcs_path)
+        raise
+
+def get_compressed_junits(build_info, junit_dict=None):
+    (build_id, gcs_path) = build_info
+    try:
+        parsers = []
+        junits = WORKER_CLIENT.get_compressed_junits_from_build(gcs_path, junit_dict, parsers)
+        return build_id, gcs_path, junits, parse_junits(gcs_path, parsers)
     except:
         logging.exception('failed to get junits for %s', gcs_path)
         raise
 
 
-def get_all_builds(db, jobs_dir, metadata, threads, client_class, build_limit):
+def get_all_builds(db, jobs_dir, metadata, threads, client_class, build_limit,
+                   async_client_class=None):
     """
     Adds information about tests to a dictionary.
 
@@ -237,38 +1011,64 @@ def get_all_builds(db, jobs_dir, metadata, threads, client_class, build_limit):
         metadata: a dict of metadata about the jobs_dir.
         threads: how many threads to use to download build information.
         client_class: a constructor for a GCSClient (or a subclass).
+        async_client_class: if set, a constructor for an AsyncGCSClient used
+            to download build information instead of a process pool.
     """
-    gcs = client_class(jobs_dir, metadata)
+    checkpoint = Checkpoint(db, jobs_dir)
+    if '' in checkpoint.done:
+        print(f'Already loaded builds from {jobs_dir} in this pass')
+        return
+    listing_cache = ListingCache(db, jobs_dir)
+    gcs = client_class(jobs_dir, metadata, listing_cache=listing_cache)
 
     print(f'Loading builds from {jobs_dir}')
+    if checkpoint.done:
+        print(f'skipping {len(checkpoint.done)} jobs already loaded in this pass')
     sys.stdout.flush()
 
     builds_have = db.get_existing_builds(jobs_dir)
     print(f'already have {len(builds_have)} builds')
     sys.stdout.flush()
 
-    jobs_and_builds = gcs.get_builds(builds_have, build_limit)
+    jobs_and_builds = gcs.get_builds(builds_have, build_limit, checkpoint)
     pool = None
-    if threads > 1:
+    if async_client_class:
+        builds_iterator = async_client_class(jobs_dir, metadata).iter_started_finished(
+            jobs_and_builds)
+    elif threads > 1:
         pool = multiprocessing.Pool(threads, mp_init_worker,
-                                    (jobs_dir, metadata, client_class))
-        builds_iterator = pool.imap_unordered(
-            get_started_finished, jobs_and_builds)
+                                    (jobs_dir, metadata, client_class, True, THROTTLE,
+                                     OBJECT_CACHE))
+        builds_iterator = metrics.merging(pool.imap_unordered(
+            functools.partial(metrics.call_collecting, get_started_finished), jobs_and_builds))
     else:
         global WORKER_CLIENT  # pylint: disable=global-statement
         WORKER_CLIENT = gcs
         builds_iterator = (
             get_started_finished(job_build) for job_build in jobs_and_builds)
 
+    rows = []
+
+    def save():
+        """Insert the fetched builds, and record how far the listing has got."""
+        db.insert_builds_bulk(rows)
+        rows.clear()
+        listing_cache.save()
+        checkpoint.save()
+        db.commit()
+
+    saved = time.time()
     try:
-        for n, (build_dir, started, finished) in enumerate(builds_iterator):
+        for build_dir, started, finished in builds_iterator:
             if not build_dir:
                 continue # skip builds that raised exceptions
             print(f'inserting build: {build_dir}')
+            checkpoint.returned_build(build_dir)
             if started or finished:
-                db.insert_build(build_dir, started, finished)
-            if n % 200 == 0:
-                db.commit()
+                rows.append((build_dir, started, finished))
+            if len(rows) >= INSERT_BATCH_SIZE or time.time() - saved > CHECKPOINT_INTERVAL:
+                save()
+                saved = time.time()
     except KeyboardInterrupt:
         if pool:
             pool.terminate()
@@ -277,6 +1077,8 @@ def get_all_builds(db, jobs_dir, metadata, threads, client_class, build_limit):
         if pool:
             pool.close()
             pool.join()
+    save()
+    db.set_backfilled(jobs_dir, [''])
     db.commit()
 
 
@@ -294,46 +1096,218 @@ def remove_system_out(data):
     return data
 
 
-def download_junit(db, threads, client_class):
-    """Download junit results for builds without them."""
+class SystemOutFilter:
+    """
+    Incrementally re-serialises an XML document without its <system-out> elements.
+
+    This is the streaming equivalent of remove_system_out: feed() it the document
+    in chunks and it passes the output to write() as it goes.
+    """
+    # pylint: disable=invalid-name
+
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, write):
+        self.write = write
+        self.buf = []
+        self.buf_size = 0
+        self.depth = 0
+        self.skip_depth = None  # depth of the <system-out> being skipped
+        self.open_tag = False  # whether the last start tag still needs a '>'
+        self.parser = expat.ParserCreate()
+        self.parser.ordered_attributes = True
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.data
+
+    def _out(self, text):
+        self.buf.append(text)
+        self.buf_size += len(text)
+        if self.buf_size >= self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.write(''.join(self.buf))
+        self.buf = []
+        self.buf_size = 0
+
+    def start(self, tag, attrs):
+        self.depth += 1
+        if self.skip_depth is not None:
+            return
+        # Like remove_system_out, leave a <system-out> directly under the root.
+        if tag == 'system-out' and self.depth > 2:
+            self.skip_depth = self.depth
+            return
+        if self.open_tag:
+            self._out('>')
+        self._out('<' + tag)
+        for i in range(0, len(attrs), 2):
+            self._out(' %s="%s"' % (attrs[i], escape_attrib(attrs[i + 1])))
+        self.open_tag = True
+
+    def end(self, tag):
+        self.depth -= 1
+        if self.skip_depth is not None:
+            if self.depth < self.skip_depth:
+                self.skip_depth = None
+            return
+        if self.open_tag:
+            self._out(' />')
+            self.open_tag = False
+        else:
+            self._out('</%s>' % tag)
+
+    def data(self, text):
+        if self.skip_depth is not None:
+            return
+        if self.open_tag:
+            self._out('>')
+            self.open_tag = False
+        self._out(escape_cdata(text))
+
+    def feed(self, chunk):
+        self.parser.Parse(chunk, False)
+
+    def close(self):
+        self.parser.Parse(b'', True)
+        self.flush()
+
+
+def escape_cdata(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def escape_attrib(text):
+    return (escape_cdata(text).replace('"', '&quot;').replace('\r', '&#13;')
+            .replace('\n', '&#10;').replace('\t', '&#09;'))
+
+
+def compress_junit(chunks, strip=True, junit_dict=None, parser=None):
+    """
+    Compresses a junit from an iterator of bytes, removing <system-out> if strip is set.
+
+    Returns a model.JunitEncoder result, or None if the junit isn't well-formed XML.
+    If parser is set, it's fed the bytes compressed too, e.g. a make_json.JunitParser.
+    """
+    encoder = model.JunitEncoder(junit_dict)
+    write = encoder.write
+    if parser is not None:
+        def write(data):
+            parser.feed(data)
+            encoder.write(data)
+    if not strip:
+        for chunk in chunks:
+            write(chunk)
+        return encoder.finish()
+    xml_filter = SystemOutFilter(lambda data: write(data.encode('utf-8')))
+    try:
+        for chunk in chunks:
+            xml_filter.feed(chunk)
+        xml_filter.close()
+    except expat.ExpatError:
+        return None
+    return encoder.finish()
+
+
+def parse_junits(build_dir, junits):
+    """
+    Return the tests make_json will read from a build's junits.
+
+    junits are texts, or make_json.JunitParsers fed them as they streamed by.
+    Called by the download workers, to keep parsing off the thread writing the
+    database. Returns None if they fail to parse.
+    """
+    try:
+        return make_json.parse_tests(junit for junit in junits if junit)
+    except Exception:  # pylint: disable=broad-except
+        logging.exception('error parsing junits of %s', build_dir)
+        return None
+
+
+def insert_junits(db, build_id, junits, tests, encoded=False):
+    """
+    Insert a build's junits, along with the tests parse_junits found in them.
+
+    Junits that failed to parse (tests is None) are still inserted, for
+    make_json to try again.
+    """
+    db.insert_build_junits(build_id, junits, encoded)
+    if tests is not None:
+        db.insert_build_tests(build_id, tests, make_json.TESTS_VERSION)
+
+
+def download_junit(db, threads, client_class, stream=False):
+    """Download junit results for builds without them.
+
+    With stream set, junits are downloaded in chunks, and compressed and parsed
+    as they're stripped, so memory use per file is bounded by its largest test
+    rather than its size.
+    """
     logging.info('Downloading JUnit artifacts.')
     sys.stdout.flush()
     builds_to_grab = db.get_builds_missing_junit()
+    get = get_junits
+    if stream:
+        get = functools.partial(get_compressed_junits, junit_dict=db.junit_dict)
     pool = None
     if threads > 1:
         pool = multiprocessing.pool.ThreadPool(
-            threads, mp_init_worker, ('', {}, client_class, False))
+            threads, mp_init_worker, ('', {}, client_class, False, THROTTLE, OBJECT_CACHE))
         test_iterator = pool.imap_unordered(
-            get_junits, builds_to_grab)
+            get, builds_to_grab)
     else:
         global WORKER_CLIENT  # pylint: disable=global-statement
         WORKER_CLIENT = client_class('', {})
         test_iterator = (
-            get_junits(build_path) for build_path in builds_to_grab)
-    for n, (build_id, build_path, junits) in enumerate(test_iterator, 1):
+            get(build_path) for build_path in builds_to_grab)
+    committed = time.time()
+    for n, (build_id, build_path, junits, tests) in enumerate(test_iterator, 1):
         logging.info('%d/%d %s %d %d', n, len(builds_to_grab),
-                     build_path, len(junits), len(''.join(junits.values())))
-        junits = {k: remove_system_out(v) for k, v in junits.items()}
-
-        db.insert_build_junits(build_id, junits)
-        if n % 100 == 0:
+                     build_path, len(junits),
+                     sum(len(v[3] if stream else v) for v in junits.values()))
+        insert_junits(db, build_id, junits, tests, encoded=stream)
+        if n % 100 == 0 or time.time() - committed > CHECKPOINT_INTERVAL:
             db.commit()
+            committed = time.time()
     db.commit()
     if pool:
         pool.close()
         pool.join()
 
 
-def main(db, jobs_dirs, threads, get_junit, build_limit, client_class=GCSClient):
+def main(db, jobs_dirs, threads, get_junit, build_limit, client_class=GCSClient,
+         async_client_class=None, stream_junit=False):
     """Collect test info in matching jobs."""
     get_all_builds(db, 'gs://kubernetes-jenkins/pr-logs', {'pr': True},
-                   threads, client_class, build_limit)
+                   threads, client_class, build_limit, async_client_class)
     for bucket, metadata in jobs_dirs.items():
         if not bucket.endswith('/'):
             bucket += '/'
-        get_all_builds(db, bucket, metadata, threads, client_class, build_limit)
+        get_all_builds(db, bucket, metadata, threads, client_class, build_limit,
+                       async_client_class)
     if get_junit:
-        download_junit(db, threads, client_class)
+        download_junit(db, threads, client_class, stream_junit)
+    # Every bucket is done, so a restart begins the next pass.
+    db.reset_backfill()
+    db.commit()
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        '--gcs-cache',
+        help='SQLite file to cache small GCS objects in across runs, or empty for none',
+        default=os.getenv('KETTLE_GCS_CACHE') or os.path.join(
+            os.path.dirname(os.getenv('KETTLE_DB') or 'build.db'), 'gcs_cache.db'),
+    )
+    parser.add_argument(
+        '--gcs-cache-size',
+        help='most bytes of objects to keep in --gcs-cache',
+        default=OBJECT_CACHE_BYTES,
+        type=int,
+    )
 
 
 def get_options(argv):
@@ -355,6 +1329,11 @@ def get_options(argv):
         action='store_true',
         help='Download JUnit results from each build'
     )
+    parser.add_argument(
+        '--stream-junit',
+        action='store_true',
+        help='Download JUnit results in chunks, bounding memory use per file'
+    )
     parser.add_argument(
         '--buildlimit',
         help='maximum number of runs within each job to pull, \
@@ -362,16 +1341,47 @@ def get_options(argv):
         default=int(os.getenv('BUILD_LIMIT', '0')),
         type=int,
     )
+    parser.add_argument(
+        '--engine',
+        choices=['process', 'async'],
+        default='process',
+        help='fetch started/finished with a process pool or one asyncio event loop',
+    )
+    parser.add_argument(
+        '--concurrency',
+        help='number of requests to keep in flight with --engine=async',
+        default=ASYNC_CONCURRENCY,
+        type=int,
+    )
+    parser.add_argument(
+        '--gcs-qps',
+        help='most GCS requests per second across all threads, backing off on 429s and'
+        ' 5xxs; 0 for no limit',
+        default=GCS_MAX_QPS,
+        type=float,
+    )
+    add_cache_arguments(parser)
+    metrics.add_arguments(parser)
     return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
     OPTIONS = get_options(sys.argv[1:])
     OPTIONS.buildlimit = OPTIONS.buildlimit or sys.maxsize
+    metrics.setup(OPTIONS)
+    if OPTIONS.gcs_qps:
+        THROTTLE = Throttle(OPTIONS.gcs_qps)
+    if OPTIONS.gcs_cache:
+        OBJECT_CACHE = ObjectCache(OPTIONS.gcs_cache, OPTIONS.gcs_cache_size)
+    ASYNC_CLIENT = None
+    if OPTIONS.engine == 'async':
+        ASYNC_CLIENT = functools.partial(AsyncGCSClient, concurrency=OPTIONS.concurrency)
     main(
-        model.Database(),
+        model.connect(),
         yaml.safe_load(open(OPTIONS.buckets)),
         OPTIONS.threads,
         OPTIONS.junit,
         OPTIONS.buildlimit,
+        async_client_class=ASYNC_CLIENT,
+        stream_junit=OPTIONS.stream_junit,
         )
@@ -16,11 +16,19 @@
 
 """Tests for make_db."""
 
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import threading
 import time
 import sys
+import types
 import unittest
+import zlib
 
 import make_db
+import make_json
 import model
 
 
@@ -68,10 +76,36 @@ class MockedClient(make_db.GCSClient):
     def get(self, path, as_json=True):
         return self.gets.get(path)
 
+    def get_chunks(self, path, chunk_size=7):
+        data = self.gets.get(path)
+        if data is None:
+            return None
+        data = data.encode('utf-8')
+        return (data[n:n + chunk_size] for n in range(0, len(data), chunk_size))
+
     def ls(self, path, **_kwargs):  # pylint: disable=arguments-differ
         return self.lists[path]
 
 
+class MockedAsyncClient(make_db.AsyncGCSClient):
+    """An AsyncGCSClient serving MockedClient's objects."""
+    client_class = MockedClient
+
+    class Session:
+        async def aclose(self):
+            pass
+
+    def _make_session(self):
+        return self.Session()
+
+    async def get(self, path, as_json=True):
+        return self.client_class.gets.get(path)
+
+    async def ls(self, path, **_kwargs):  # pylint: disable=arguments-differ
+        for item in self.client_class.lists[path]:
+            yield item
+
+
 class GCSClientTest(unittest.TestCase):
     """Unit tests for GCSClient"""
 
@@ -88,6 +122,31 @@ class GCSClientTest(unittest.TestCase):
             sorted(junits),
             ['gs://kubernetes-jenkins/logs/fake/123/artifacts/junit_01.xml'])
 
+    def test_get_compressed_junits_closes_responses(self):
+        closed = []
+
+        class Response:
+            def __init__(self, data):
+                self.data = data
+
+            def iter_content(self, chunk_size):
+                return (self.data[n:n + chunk_size] for n in range(0, len(self.data), chunk_size))
+
+            def close(self):
+                closed.append(self)
+
+        class Client(make_db.GCSClient):
+            def _ls_junit_paths(self, build_dir):
+                return [build_dir + 'artifacts/junit_01.xml']
+
+            def _request_stream(self, path, params):
+                return Response(b'<testsuite><testcase name="a"></oops>' + b' ' * 1000)
+
+        junits = Client(self.JOBS_DIR).get_compressed_junits_from_build(self.JOBS_DIR + 'fake/1')
+        self.assertEqual(len(junits), 1)
+        # the malformed junit was fetched twice, and neither response was left open
+        self.assertEqual(len(closed), 2)
+
     def test_get_builds_normal_list(self):
         # normal case: lists a directory
         self.assertEqual((True, ['123', '122']), self.client._get_builds('fake'))
@@ -114,6 +173,62 @@ class GCSClientTest(unittest.TestCase):
         self.assertEqual((True, ['4', '3']),
                          self.client._get_builds('latest'))
 
+    def test_get_builds_listing_cache(self):
+        # optimization: after a full listing, only list builds after the newest known one
+        db = model.Database(':memory:')
+        calls = []
+
+        class RecordingClient(MockedClient):
+            def ls(self, path, **kwargs):
+                calls.append(kwargs.get('start_offset'))
+                return super().ls(path, **kwargs)
+
+        def get_builds():
+            cache = make_db.ListingCache(db, self.JOBS_DIR)
+            client = RecordingClient(self.JOBS_DIR, {'sequential': False}, cache)
+            builds = client._get_builds('fake')
+            cache.save()
+            return builds
+
+        self.assertEqual((True, ['123', '122']), get_builds())
+        self.assertEqual((True, ['123', '122']), get_builds())
+        self.assertEqual([None, self.JOBS_DIR + 'fake/123'], calls)
+
+        db.set_listing(self.JOBS_DIR + 'fake/', ['124'], False)
+        self.assertEqual((True, ['124', '123', '122']), get_builds())
+        self.assertEqual(self.JOBS_DIR + 'fake/124', calls[-1])
+
+    def test_get_builds_listing_rollover(self):
+        # a build number that gains a digit sorts before the others, so is listed in full
+        db = model.Database(':memory:')
+        job_dir = self.JOBS_DIR + 'rollover/'
+        names = ['898', '899']
+        calls = []
+
+        class RecordingClient(MockedClient):
+            def ls(self, path, **kwargs):
+                start_offset = kwargs.get('start_offset')
+                calls.append(start_offset)
+                return [path + name + '/' for name in sorted(names)
+                        if start_offset is None or path + name >= start_offset]
+
+        def get_builds():
+            cache = make_db.ListingCache(db, self.JOBS_DIR)
+            client = RecordingClient(self.JOBS_DIR, {'sequential': False}, cache)
+            builds = client._get_builds('rollover')
+            cache.save()
+            return builds
+
+        db.set_listing(job_dir, ['898'], True)
+        self.assertEqual((True, ['899', '898']), get_builds())
+        names.append('900')
+        self.assertEqual((True, ['900', '899', '898']), get_builds())
+        names.append('1000')
+        self.assertEqual((True, ['1000', '900', '899', '898']), get_builds())
+        names.append('1001')
+        self.assertEqual((True, ['1001', '1000', '900', '899', '898']), get_builds())
+        self.assertEqual([job_dir + '898', job_dir + '899', None, None], calls)
+
     def test_get_builds_exclude_list_no_match(self):
         # special case: job is not in excluded list
         self.client.metadata = {'exclude_jobs': ['notfake']}
@@ -124,16 +239,176 @@ class GCSClientTest(unittest.TestCase):
         self.client.metadata = {'exclude_jobs': ['fake']}
         self.assertEqual([], list(self.client.get_builds(set())))
 
+    def test_get_builds_checkpoint(self):
+        db = model.Database(':memory:')
+        checkpoint = make_db.Checkpoint(db, self.JOBS_DIR)
+        self.assertEqual([('fake', '123'), ('fake', '122')],
+                         list(self.client.get_builds(set(), checkpoint=checkpoint)))
+        checkpoint.returned_build(self.JOBS_DIR + 'fake/123')
+        checkpoint.save()
+        self.assertEqual(db.get_backfilled(self.JOBS_DIR), set())  # 122 is still being fetched
+        checkpoint.returned_build(self.JOBS_DIR + 'fake/122')
+        checkpoint.save()
+        self.assertEqual(db.get_backfilled(self.JOBS_DIR), {'fake'})
+
+        # a restart skips the job, unless it was done too long ago
+        checkpoint = make_db.Checkpoint(db, self.JOBS_DIR)
+        self.assertEqual([], list(self.client.get_builds(set(), checkpoint=checkpoint)))
+        checkpoint = make_db.Checkpoint(db, self.JOBS_DIR, max_age=-1)
+        self.assertEqual(2, len(list(self.client.get_builds(set(), checkpoint=checkpoint))))
+
+class AsyncGCSClientTest(unittest.TestCase):
+    """Unit tests for AsyncGCSClient's requests, against a stub HTTP session."""
+
+    URL = 'https://www.googleapis.com/storage/v1/b/bucket/o/some%2Fpath.json'
+
+    class Session:
+        def __init__(self, responses):
+            self.responses = list(responses)
+            self.urls = []
+
+        async def get(self, url, params=None):
+            self.urls.append(url)
+            resp = self.responses.pop(0)
+            if isinstance(resp, Exception):
+                raise resp
+            return resp
+
+    def setUp(self):
+        # retry without waiting
+        self.addCleanup(setattr, make_db, 'random', make_db.random)
+        make_db.random = types.SimpleNamespace(random=lambda: 0)
+
+    def get(self, responses, as_json=True):
+        import httpx  # pylint: disable=import-outside-toplevel
+        request = httpx.Request('GET', 'https://www.googleapis.com/')
+        client = make_db.AsyncGCSClient('gs://kubernetes-jenkins/logs/')
+        client.session = self.Session(
+            resp if isinstance(resp, Exception) else
+            httpx.Response(resp[0], content=resp[1], request=request)
+            for resp in responses)
+        result = asyncio.run(client.get('gs://bucket/some/path.json', as_json=as_json))
+        self.assertEqual(client.session.responses, [])  # every response was used
+        return result, client.session.urls
+
+    def test_request(self):
+        result, urls = self.get([(200, b'{"a": 1}')])
+        self.assertEqual(result, {'a': 1})
+        self.assertEqual(urls, [self.URL])
+        self.assertEqual(self.get([(200, b'text')], as_json=False)[0], 'text')
+        self.assertIsNone(self.get([(200, b'not json')])[0])
+
+    def test_request_retries(self):
+        import httpx  # pylint: disable=import-outside-toplevel
+        retries = make_db.GCS_RETRIES.value()
+        result, urls = self.get([(429, b''), (503, b''), httpx.ConnectError('boom'),
+                                 (200, b'{"a": 1}')])
+        self.assertEqual(result, {'a': 1})
+        self.assertEqual(len(urls), 4)
+        self.assertEqual(make_db.GCS_RETRIES.value(), retries + 3)
+
+    def test_request_not_found(self):
+        for code in [403, 404]:
+            self.assertEqual(self.get([(code, b'{"error": "nope"}')]), (None, [self.URL]))
+
+    def test_throttle(self):
+        self.addCleanup(setattr, make_db, 'THROTTLE', None)
+        make_db.THROTTLE = make_db.Throttle(2)
+        start = time.monotonic()
+        for _ in range(3):  # 2 tokens start in the bucket, the third takes half a second
+            self.assertEqual(self.get([(200, b'{"a": 1}')])[0], {'a': 1})
+        self.assertGreater(time.monotonic() - start, 0.4)
+
+        # retries spend from the budget instead of backing off
+        make_db.random = types.SimpleNamespace(random=lambda: 1)
+        make_db.THROTTLE = make_db.Throttle(100)
+        start = time.monotonic()
+        self.assertEqual(self.get([(503, b''), (503, b''), (200, b'{"a": 1}')])[0], {'a': 1})
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(make_db.THROTTLE.rate, 50 + make_db.Throttle.RATE_INCREASE / 50)
+
+    def test_object_cache(self):
+        import httpx  # pylint: disable=import-outside-toplevel
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.addCleanup(setattr, make_db, 'OBJECT_CACHE', None)
+        make_db.OBJECT_CACHE = make_db.ObjectCache(os.path.join(tmpdir.name, 'gcs_cache.db'))
+        request = httpx.Request('GET', 'https://www.googleapis.com/')
+        client = make_db.AsyncGCSClient('gs://b/logs/')
+        client.session = self.Session([
+            httpx.Response(200, content=b'{"timestamp": 1}', request=request,
+                           headers={'x-goog-generation': '5'}),
+            httpx.Response(200, content=b'{"timestamp": 2}', request=request,
+                           headers={'x-goog-generation': '6'}),
+            httpx.Response(304, request=request),
+        ])
+
+        async def get_all():
+            return await asyncio.gather(client.get('gs://b/logs/1/started.json', as_json=True),
+                                        client.get('gs://b/logs/1/finished.json', as_json=True))
+
+        self.assertEqual(asyncio.run(get_all()), [{'timestamp': 1}, {'timestamp': 2}])
+        # started.json is used as cached, and finished.json comes back as a 304
+        self.assertEqual(asyncio.run(get_all()), [{'timestamp': 1}, {'timestamp': 2}])
+        self.assertEqual(client.session.responses, [])
+        self.assertEqual(len(client.session.urls), 3)
+
+
 class MainTest(unittest.TestCase):
     """End-to-end test of the main function's output."""
     JOBS_DIR = GCSClientTest.JOBS_DIR
 
+    def test_checkpoint(self):
+        db = model.Database(':memory:')
+        calls = []
+
+        class RecordingClient(MockedClient):
+            def get(self, path, as_json=True):
+                calls.append(path)
+                return super().get(path, as_json)
+
+        make_db.get_all_builds(db, self.JOBS_DIR, {}, 1, RecordingClient, sys.maxsize)
+        self.assertTrue(calls)
+        self.assertEqual(db.get_backfilled(self.JOBS_DIR), {'', 'fake'})
+
+        # a restarted pass skips buckets it already loaded
+        del calls[:]
+        make_db.get_all_builds(db, self.JOBS_DIR, {}, 1, RecordingClient, sys.maxsize)
+        self.assertEqual(calls, [])
+
+        # once the pass completes, the next one starts over
+        make_db.main(db, {self.JOBS_DIR: {}}, 1, False, sys.maxsize, RecordingClient)
+        self.assertEqual(calls, [])
+        self.assertEqual(db.get_backfilled(self.JOBS_DIR), set())
+        make_db.main(db, {self.JOBS_DIR: {}}, 1, False, sys.maxsize, RecordingClient)
+        self.assertTrue(calls)
+
     def test_remove_system_out(self):
         self.assertEqual(make_db.remove_system_out('not<xml<lol'), 'not<xml<lol')
         self.assertEqual(
             make_db.remove_system_out('<a><b>c<system-out>bar</system-out></b></a>'),
             '<a><b>c</b></a>')
 
+    def test_compress_junit(self):
+        def compress(data):
+            chunks = (data[n:n + 3].encode('utf-8') for n in range(0, len(data), 3))
+            parser = make_json.JunitParser()
+            encoded = make_db.compress_junit(chunks, parser=parser)
+            if encoded:
+                self.assertEqual(parser.close(), list(make_json.parse_junit_etree(
+                    zlib.decompress(encoded[3]).decode('utf-8'))))
+            return encoded and zlib.decompress(encoded[3]).decode('utf-8')
+
+        self.assertIsNone(compress('not<xml<lol'))
+        for data in [
+                '<a><b>c<system-out>bar</system-out></b></a>',
+                '<a b="&quot;\n"><system-out>kept</system-out><c>&lt;&amp;</c><d /></a>',
+                '<?xml version="1.0"?>\n<a><b>\u00e9<system-out><x/></system-out></b></a>',
+                '<testsuite><testcase name="\u00e9" time="2"><failure>f</failure>'
+                '<system-out>noise</system-out></testcase></testsuite>',
+        ]:
+            self.assertEqual(compress(data), make_db.remove_system_out(data))
+
     @staticmethod
     def get_expected_builds():
         return {
@@ -146,23 +421,39 @@ class MainTest(unittest.TestCase):
         }
 
     def assert_main_output(self, threads, expected=None, db=None,
-                           client=MockedClient):
+                           client=MockedClient, async_client=None, stream_junit=False):
         if expected is None:
             expected = self.get_expected_builds()
         if db is None:
             db = model.Database(':memory:')
-        make_db.main(db, {self.JOBS_DIR: {}}, threads, True, sys.maxsize, client)
+        make_db.main(db, {self.JOBS_DIR: {}}, threads, True, sys.maxsize, client,
+                     async_client, stream_junit)
 
+        builds = list(db.get_builds())
         result = {path: (started, finished, db.test_results_for_build(path))
-                  for _rowid, path, started, finished in db.get_builds()}
+                  for _rowid, path, started, finished in builds}
 
         self.assertEqual(result, expected)
+        # make_json reads the tests parsed while downloading instead
+        for rowid, path, _started, _finished in builds:
+            self.assertEqual(db.get_build_tests(rowid, make_json.TESTS_VERSION),
+                             make_json.parse_tests(expected[path][2]))
         return db
 
     def test_clean(self):
         for threads in [1, 32]:
             self.assert_main_output(threads)
 
+    def test_clean_stream_junit(self):
+        expected = self.get_expected_builds()
+        for _started, _finished, junits in expected.values():
+            junits[:] = [junit.strip() for junit in junits]  # re-serialised by expat
+        for threads in [1, 32]:
+            self.assert_main_output(threads, expected, stream_junit=True)
+
+    def test_clean_async(self):
+        self.assert_main_output(1, async_client=MockedAsyncClient)
+
     def test_incremental_new(self):
         db = self.assert_main_output(1)
 
@@ -196,5 +487,162 @@ class MainTest(unittest.TestCase):
         self.assert_main_output(1, expected, db, MockedClientNewer)
 
 
+def acquire_tokens(count):
+    for _ in range(count):
+        make_db.THROTTLE.acquire()
+
+
+class ThrottleTest(unittest.TestCase):
+    """Tests for the GCS request Throttle."""
+
+    def tearDown(self):
+        make_db.THROTTLE = None
+
+    def test_rate(self):
+        throttle = make_db.Throttle(100)
+        throttle.observe(429)
+        throttle.observe(503)  # within DECREASE_INTERVAL of the last decrease
+        self.assertEqual(throttle.rate, 50)
+        throttle.observe(200)
+        self.assertEqual(throttle.rate, 50 + throttle.RATE_INCREASE / 50)
+        for _ in range(1000):
+            throttle.observe(404)
+        self.assertEqual(throttle.rate, 100)
+
+    def test_retry_budget(self):
+        throttle = make_db.Throttle(100)
+        spent = 0
+        while throttle.spend_retry():
+            spent += 1
+        self.assertEqual(spent, throttle.RETRY_BUDGET)
+        for _ in range(int(1 / throttle.RETRY_RATIO) + 1):
+            throttle.observe(200)
+        self.assertTrue(throttle.spend_retry())
+        self.assertFalse(throttle.spend_retry())
+
+    def test_shared_between_processes(self):
+        throttle = make_db.Throttle(200)
+        start = time.monotonic()
+        # 200 tokens start in the bucket, and the other 200 take a second to refill.
+        with multiprocessing.Pool(4, make_db.mp_init_worker,
+                                  ('', {}, MockedClient, False, throttle)) as pool:
+            pool.map(acquire_tokens, [100] * 4)
+        self.assertGreater(time.monotonic() - start, 0.9)
+
+    def test_request_retries(self):
+        class Response:
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+            def raise_for_status(self):
+                if self.status_code >= 400:
+                    raise make_db.requests.exceptions.HTTPError(self.status_code)
+
+            def json(self):
+                return {'ok': True}
+
+        class Session:
+            codes = [429, 429, 503, 200]
+
+            def get(self, url, params, stream):  # pylint: disable=unused-argument
+                return Response(self.codes.pop(0))
+
+        make_db.THROTTLE = make_db.Throttle(1000)
+        client = make_db.GCSClient('')
+        client.session = Session()
+        start = time.monotonic()
+        response = client._request('bucket/o/obj', {})  # pylint: disable=protected-access
+        self.assertEqual(response, {'ok': True})
+        self.assertLess(time.monotonic() - start, 1)  # no exponential backoff
+        self.assertLess(make_db.THROTTLE.rate, 501)
+
+
+class ObjectCacheTest(unittest.TestCase):
+    """Tests for the small object cache."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'gcs_cache.db')
+        self.addCleanup(setattr, make_db, 'OBJECT_CACHE', None)
+
+    def test_get(self):
+        objects = {'b/o/logs%2Fjob%2F1%2Fstarted.json': (5, '{"timestamp": 1}'),
+                   'b/o/logs%2Fjob%2F1%2Ffinished.json': (6, '{"timestamp": 2}'),
+                   'b/o/logs%2Fjob%2Flatest-build.txt': (7, '1')}
+        requests = []
+
+        class Response:
+            def __init__(self, status_code, generation=None, text=None):
+                self.status_code = status_code
+                self.headers = {'x-goog-generation': str(generation)}
+                self.text = text
+
+            def close(self):
+                pass
+
+        class Client(make_db.GCSClient):
+            def _request_stream(self, path, params):
+                requests.append((path, params.get('ifGenerationNotMatch')))
+                if path not in objects:
+                    return None
+                generation, text = objects[path]
+                if params.get('ifGenerationNotMatch') == generation:
+                    return Response(304)
+                return Response(200, generation, text)
+
+        def get_all():
+            client = Client('gs://b/logs/')
+            return [client.get('gs://b/logs/job/1/started.json', as_json=True),
+                    client.get('gs://b/logs/job/1/finished.json', as_json=True),
+                    client.get('gs://b/logs/job/latest-build.txt'),
+                    client.get('gs://b/logs/job/2/started.json')]
+
+        make_db.OBJECT_CACHE = make_db.ObjectCache(self.path)
+        self.assertEqual(get_all(), [{'timestamp': 1}, {'timestamp': 2}, '1', None])
+        self.assertEqual(len(requests), 4)
+        del requests[:]
+        objects['b/o/logs%2Fjob%2Flatest-build.txt'] = (8, '2')
+
+        make_db.OBJECT_CACHE = make_db.ObjectCache(self.path)  # persisted across runs
+        self.assertEqual(get_all(), [{'timestamp': 1}, {'timestamp': 2}, '2', None])
+        self.assertEqual(requests, [  # started.json isn't requested again
+            ('b/o/logs%2Fjob%2F1%2Ffinished.json', 6),
+            ('b/o/logs%2Fjob%2Flatest-build.txt', 7),
+            ('b/o/logs%2Fjob%2F2%2Fstarted.json', None)])
+
+    def test_evict(self):
+        cache = make_db.ObjectCache(self.path, max_bytes=1000)
+        for n in range(20):
+            cache.put('gs://b/%d/started.json' % n, n, 'x' * 100)
+        cache.get('gs://b/0/started.json')  # too recently used to update
+        cache.evict()
+        self.assertEqual(cache.get('gs://b/0/started.json'), None)
+        self.assertEqual(cache.get('gs://b/19/started.json'), (19, 'x' * 100))
+        size, = cache._db().execute(  # pylint: disable=protected-access
+            'select sum(length(data)) from object').fetchone()
+        self.assertLessEqual(size, 900)
+
+    def test_fetch_once(self):
+        cache = make_db.ObjectCache(self.path)
+        calls = []
+        results = []
+
+        def fetch(generation):
+            calls.append(generation)
+            time.sleep(0.1)
+            return 3, 'data'
+
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.fetch('gs://b/j/1/finished.json', fetch)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [None])
+        self.assertEqual(results, ['data'] * 5)
+
+
 if __name__ == '__main__':
     unittest.main()
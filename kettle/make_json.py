@@ -17,27 +17,58 @@
 """Generate JSON for BigQuery importing."""
 
 import argparse
+import gzip
+import hashlib
+import io
 import logging
 import json
+import multiprocessing
 import os
+import sqlite3
 import subprocess
 import sys
 import time
 import traceback
+from xml.etree.ElementTree import XMLPullParser
 
 try:
     import defusedxml.ElementTree as ET
 except ImportError:
     import xml.etree.cElementTree as ET
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import columnar
 import model
 
 MAX_ROW_SIZE = 104857600 # 100MB
+# Estimated JSON size a row's tests may take, leaving room for the rest of the row.
+MAX_TESTS_SIZE = MAX_ROW_SIZE * 9 // 10
+# Estimated JSON bytes in a test besides its name and failure text.
+TEST_OVERHEAD = 64
+# Failure texts aren't truncated below this many characters.
+MIN_FAILURE_TEXT = 1024
+TRUNCATED_TEXT = '\n... [%d characters truncated]'
 SECONDS_PER_DAY = 86400
+# Bump when parse_tests' output changes, so tests the database cached from
+# earlier versions are parsed again from the junits.
+TESTS_VERSION = 1
+# Builds per task handed to a --workers process.
+SHARD_SIZE = 200
+
+WORKER_DB = None  # used for multiprocessing
+WORKER_FORMAT = 'json'
+
+BUCKETS_YAML = os.path.dirname(os.path.abspath(__file__))+'/buckets.yaml'
+# JSON snapshot of BUCKETS_YAML, so most imports skip the yaml parse.
+BUCKETS_CACHE = BUCKETS_YAML + '.json'
 
 def buckets_yaml():
     import ruamel.yaml as yaml  # pylint: disable=import-outside-toplevel
-    with open(os.path.dirname(os.path.abspath(__file__))+'/buckets.yaml') as fp:
+    with open(BUCKETS_YAML) as fp:
         return yaml.safe_load(fp)
 
 # pypy compatibility hack
@@ -48,27 +79,94 @@ def python_buckets_yaml(python='python3'):
          ],
         cwd=os.path.dirname(os.path.abspath(__file__))).decode("utf-8"))
 
-for attempt in [python_buckets_yaml, buckets_yaml, lambda: python_buckets_yaml(python='python')]:
-    try:
-        BUCKETS = attempt()
-        break
-    except (ImportError, OSError):
-        traceback.print_exc()
-else:
+def load_buckets_yaml():
+    for attempt in [python_buckets_yaml, buckets_yaml,
+                    lambda: python_buckets_yaml(python='python')]:
+        try:
+            return attempt()
+        except (ImportError, OSError):
+            traceback.print_exc()
     # pylint: disable=misplaced-bare-raise
     # This is safe because the only way we get here is by faling all attempts
     raise
 
-# https://stackoverflow.com/questions/39047624/is-there-an-easy-way-to-estimate-size-of-a-json-object
-class MeterFile:
+
+def cached_buckets_yaml(path=BUCKETS_YAML, cache_path=BUCKETS_CACHE, load=load_buckets_yaml):
+    """Return the parsed buckets.yaml, reusing the JSON snapshot while it is current.
+
+    The snapshot is trusted when the yaml's mtime and size are unchanged, or
+    failing that when its sha256 still matches (e.g. after a fresh checkout).
     """
-    File-like object, throws away everything you write to it but keeps track of the size.
+    stat = os.stat(path)
+    try:
+        with open(cache_path) as fp:
+            cache = json.load(fp)
+        if [cache['mtime'], cache['size']] == [stat.st_mtime, stat.st_size]:
+            return cache['buckets']
+    except (OSError, ValueError, KeyError, TypeError):
+        cache = None
+    with open(path, 'rb') as fp:
+        digest = hashlib.sha256(fp.read()).hexdigest()
+    if cache and cache.get('sha256') == digest:
+        buckets = cache['buckets']
+    else:
+        buckets = load()
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as fp:
+            json.dump({'mtime': stat.st_mtime, 'size': stat.st_size, 'sha256': digest,
+                       'buckets': buckets}, fp)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        logging.warning('unable to write %s', cache_path, exc_info=True)
+    return buckets
+
+
+class BucketIndex:
+    """Map build paths to the first matching entry of an ordered bucket dict.
+
+    Bucket paths ending in '/' are looked up once per '/' in the build path,
+    instead of testing every bucket with startswith. Results are memoized per
+    job directory, since every build of a job resolves to the same bucket.
     """
-    def __init__(self, size=0):
-        self.size = size
 
-    def write(self, string):
-        self.size += len(string)
+    def __init__(self, buckets):
+        self.prefixes = {}  # bucket path -> (position in buckets, meta)
+        self.others = []  # (position, bucket path, meta) for paths without a trailing '/'
+        for pos, (bucket, meta) in enumerate(buckets.items()):
+            if bucket.endswith('/'):
+                self.prefixes[bucket] = (pos, meta)
+            else:
+                self.others.append((pos, bucket, meta))
+        self.job_dirs = {}
+
+    def _lookup_dir(self, job_dir):
+        best = None
+        end = job_dir.find('/')
+        while end >= 0:
+            found = self.prefixes.get(job_dir[:end+1])
+            if found and (best is None or found[0] < best[0]):
+                best = found
+            end = job_dir.find('/', end+1)
+        return best
+
+    def lookup(self, path):
+        """Return the meta of the first bucket path that prefixes path, or None."""
+        job_dir = path[:path.rfind('/')+1]
+        try:
+            best = self.job_dirs[job_dir]
+        except KeyError:
+            best = self.job_dirs[job_dir] = self._lookup_dir(job_dir)
+        for pos, bucket, meta in self.others:
+            if best is not None and pos > best[0]:
+                break
+            if path.startswith(bucket):
+                return meta
+        return best and best[1]
+
+
+BUCKETS = cached_buckets_yaml()
+BUCKETS_INDEX = BucketIndex(BUCKETS)
 
 class Build:
     """
@@ -98,6 +196,8 @@ class Build:
         self.repos = None
         self.metadata = None
         self.elapsed = None
+        #Set when tests were trimmed to fit in a BigQuery row
+        self.truncated = None
         self.populate_path_to_job_and_number()
 
     @classmethod
@@ -111,10 +211,9 @@ class Build:
 
     def populate_path_to_job_and_number(self):
         assert not self.path.endswith('/')
-        for bucket, meta in BUCKETS.items():
-            if self.path.startswith(bucket):
-                prefix = meta['prefix']
-                break
+        meta = BUCKETS_INDEX.lookup(self.path)
+        if meta is not None:
+            prefix = meta['prefix']
         #if job path not in buckets.yaml or gs://kubernetes-jenkins/pr-logs it is unmatched
         else:
             if self.path.startswith('gs://kubernetes-jenkins/pr-logs'):
@@ -159,7 +258,32 @@ class Build:
             self.elapsed = self.finished - self.started
 
 
-def parse_junit(xml):
+# pylint: disable=redefined-outer-name
+
+def _make_result(name, time, failure_text):
+    if failure_text:
+        if time is None:
+            return {'name': name, 'failed': True, 'failure_text': failure_text}
+        return {'name': name, 'time': time, 'failed': True, 'failure_text': failure_text}
+    if time is None:
+        return {'name': name}
+    return {'name': name, 'time': time}
+
+# Note: skipped tests are ignored because they make rows too large for BigQuery.
+# Knowing that a given build could have ran a test but didn't for some reason
+# isn't very interesting.
+
+def _parse_result(child_node):
+    time = float(child_node.attrib.get('time') or 0) #time val can be ''
+    failure_text = None
+    for param in child_node.findall('failure'):
+        failure_text = param.text or param.attrib.get('message', 'No Failure Message Found')
+    skipped = child_node.findall('skipped')
+    return time, failure_text, skipped
+
+# pylint: enable=redefined-outer-name
+
+def parse_junit_etree(xml):
     """Generate failed tests as a series of dicts. Ignore skipped tests."""
     # NOTE: this is modified from gubernator/view_build.py
     try:
@@ -169,49 +293,216 @@ def parse_junit(xml):
         yield from [] #return empty itterator to skip results for this test
         return
 
-    # pylint: disable=redefined-outer-name
-
-    def make_result(name, time, failure_text):
-        if failure_text:
-            if time is None:
-                return {'name': name, 'failed': True, 'failure_text': failure_text}
-            return {'name': name, 'time': time, 'failed': True, 'failure_text': failure_text}
-        if time is None:
-            return {'name': name}
-        return {'name': name, 'time': time}
-
-    # Note: skipped tests are ignored because they make rows too large for BigQuery.
-    # Knowing that a given build could have ran a test but didn't for some reason
-    # isn't very interesting.
-
-    def parse_result(child_node):
-        time = float(child_node.attrib.get('time') or 0) #time val can be ''
-        failure_text = None
-        for param in child_node.findall('failure'):
-            failure_text = param.text or param.attrib.get('message', 'No Failure Message Found')
-        skipped = child_node.findall('skipped')
-        return time, failure_text, skipped
-
     if tree.tag == 'testsuite':
         for child in tree.findall('testcase'):
             name = child.attrib.get('name', '<unspecified>')
-            time, failure_text, skipped = parse_result(child)
+            time_, failure_text, skipped = _parse_result(child)
             if skipped:
                 continue
-            yield make_result(name, time, failure_text)
+            yield _make_result(name, time_, failure_text)
     elif tree.tag == 'testsuites':
         for testsuite in tree:
             suite_name = testsuite.attrib.get('name', '<unspecified>')
             for child in testsuite.findall('testcase'):
                 name = '%s %s' % (suite_name, child.attrib.get('name', '<unspecified>'))
-                time, failure_text, skipped = parse_result(child)
+                time_, failure_text, skipped = _parse_result(child)
                 if skipped:
                     continue
-                yield make_result(name, time, failure_text)
+                yield _make_result(name, time_, failure_text)
     else:
         logging.error('unable to find failures, unexpected tag %s', tree.tag)
 
-def row_for_build(path, started, finished, results):
+class _JunitEvents:
+    """
+    Collect failed tests like parse_junit_etree from (event, element) pairs of an iterparse.
+
+    Each testcase is dropped from the tree once it's read, so memory stays
+    bounded by the largest testcase rather than the whole document.
+    """
+
+    def __init__(self):
+        self.results = []
+        self.stack = []  # open elements, root first
+        self.root_tag = None
+        self.case_depth = None  # how deep testcases of interest are
+
+    def handle(self, events):
+        stack = self.stack
+        for event, elem in events:
+            if event == 'start':
+                if not stack:
+                    self.root_tag = elem.tag
+                    self.case_depth = {'testsuite': 1, 'testsuites': 2}.get(elem.tag)
+                stack.append(elem)
+                continue
+            stack.pop()
+            depth = len(stack)
+            if self.case_depth is None or depth == 0 or depth > self.case_depth:
+                continue  # a nested element; its testcase or suite still needs it
+            if depth == self.case_depth and elem.tag == 'testcase':
+                name = elem.attrib.get('name', '<unspecified>')
+                if self.case_depth == 2:
+                    name = '%s %s' % (stack[1].attrib.get('name', '<unspecified>'), name)
+                time_, failure_text, skipped = _parse_result(elem)
+                if not skipped:
+                    self.results.append(_make_result(name, time_, failure_text))
+            elem.clear()
+            stack[-1].remove(elem)
+
+    def finish(self):
+        if self.case_depth is None:
+            logging.error('unable to find failures, unexpected tag %s', self.root_tag)
+        return self.results
+
+def _parse_junit_events(events, parse_error):
+    """Like parse_junit_etree, but over (event, element) pairs from an iterparse."""
+    junit_events = _JunitEvents()
+    try:
+        junit_events.handle(events)
+    except parse_error:
+        print("Malformed xml, skipping")
+        return []
+    return junit_events.finish()
+
+class JunitParser:
+    """
+    Parse a junit fed in chunks of bytes, giving what parse_junit_iterparse would.
+
+    Only the testcase being read is held, not the document, so make_db can
+    parse junits as they stream by. Errors are raised by close().
+    """
+
+    def __init__(self):
+        self.parser = XMLPullParser(events=('start', 'end'))
+        self.events = _JunitEvents()
+        self.error = None
+
+    def feed(self, data):
+        if self.error is not None:
+            return
+        try:
+            self.parser.feed(data)
+            self.events.handle(self.parser.read_events())
+        except Exception as err:  # pylint: disable=broad-except
+            self.error = err
+
+    def close(self):
+        """Return the failed tests as a list of dicts."""
+        if self.error is None:
+            try:
+                self.parser.close()
+                self.events.handle(self.parser.read_events())
+            except Exception as err:  # pylint: disable=broad-except
+                self.error = err
+        if isinstance(self.error, ET.ParseError):
+            print("Malformed xml, skipping")
+            return []
+        if self.error is not None:
+            raise self.error
+        return self.events.finish()
+
+def parse_junit_iterparse(xml):
+    """Generate failed tests like parse_junit_etree, with a streaming parse."""
+    yield from _parse_junit_events(
+        ET.iterparse(io.StringIO(xml), events=('start', 'end')), ET.ParseError)
+
+def parse_junit_lxml(xml):
+    """Generate failed tests like parse_junit_etree, with a streaming parse by lxml."""
+    # pylint: disable=import-outside-toplevel
+    from lxml import etree
+    yield from _parse_junit_events(
+        etree.iterparse(io.BytesIO(xml.encode('utf-8')), events=('start', 'end'),
+                        resolve_entities=False, no_network=True, huge_tree=True),
+        etree.XMLSyntaxError)
+
+JUNIT_PARSERS = {
+    'etree': parse_junit_etree,
+    'iterparse': parse_junit_iterparse,
+    'lxml': parse_junit_lxml,
+}
+JUNIT_PARSER = 'etree'
+
+def parse_junit(xml):
+    """Generate failed tests as a series of dicts with the JUNIT_PARSER engine."""
+    return JUNIT_PARSERS[JUNIT_PARSER](xml)
+
+def test_size(test):
+    """Estimate the size of a test's JSON, counting characters as bytes."""
+    return TEST_OVERHEAD + len(test['name']) + len(test.get('failure_text') or '')
+
+def _truncate_text(text, limit):
+    return text[:limit] + TRUNCATED_TEXT % (len(text) - limit)
+
+def _failure_text_limit(lengths, excess):
+    """
+    Return the longest limit on failure texts that saves excess characters,
+    or MIN_FAILURE_TEXT if none does.
+    """
+    lengths = sorted(lengths, reverse=True)
+    marker = len(TRUNCATED_TEXT % 0) + 8
+    total = 0
+    for count, length in enumerate(lengths, 1):
+        total += length
+        # Cutting the count longest texts to limit saves total - count * (limit + marker).
+        limit = (total - count * marker - excess) // count
+        shortest = lengths[count] if count < len(lengths) else 0
+        if limit >= max(shortest, MIN_FAILURE_TEXT):
+            return limit
+    return MIN_FAILURE_TEXT
+
+def trim_tests(tests, budget, size=None):
+    """
+    Shrink tests in place until their estimated size (see test_size) fits in budget.
+
+    Failure texts longer than a common limit are truncated first, with the
+    limit as long as the budget allows. If that isn't enough, passing tests
+    are dropped from the end, and then failed ones. Returns True if tests
+    were changed.
+    """
+    if size is None:
+        size = sum(test_size(test) for test in tests)
+    if size <= budget:
+        return False
+    limit = _failure_text_limit(
+        [len(test['failure_text']) for test in tests if test.get('failure_text')], size - budget)
+    for test in tests:
+        text = test.get('failure_text')
+        if text and len(text) > limit + len(TRUNCATED_TEXT % len(text)):
+            before = test_size(test)
+            test['failure_text'] = _truncate_text(text, limit)
+            size += test_size(test) - before
+    for failed in (False, True):
+        keep = []
+        for test in reversed(tests):
+            if size > budget and bool(test.get('failed')) == failed:
+                size -= test_size(test)
+            else:
+                keep.append(test)
+        tests[:] = reversed(keep)
+    return True
+
+def parse_tests(results):
+    """
+    Return the tests in a build's junits, as row_for_build includes them.
+
+    results are junit texts, or JunitParsers that have been fed a junit. The
+    database caches this per build (see TESTS_VERSION), so each junit is parsed
+    once rather than on every make_json run.
+    """
+    tests = []
+    for result in results:
+        parsed = result.close() if isinstance(result, JunitParser) else parse_junit(result)
+        for test in parsed:
+            if '#' in test['name'] and not test.get('failed'):
+                continue  # skip successful repeated tests
+            text = test.get('failure_text')
+            if text and len(text) > MAX_TESTS_SIZE:
+                # could never fit, so don't hold on to all of it
+                test['failure_text'] = _truncate_text(text, MAX_TESTS_SIZE)
+            tests.append(test)
+    return tests
+
+def row_for_build(path, started, finished, results, tests=None):
     """
     Generate an dictionary that represents a build as described by TestGrid's
     job schema. See link for reference.
@@ -222,17 +513,16 @@ def row_for_build(path, started, finished, results):
         started (dict): Values pulled from started.json for a build
         finsihed (dict): Values pulled from finsihed.json for a build
         results (array): List of file data that exits under path
+        tests (list, optional): parse_tests(results), if already known
 
     Return:
         Dict holding metadata and information pertinent to a build
-        to be stored in BigQuery
+        to be stored in BigQuery. If its tests would exceed MAX_TESTS_SIZE,
+        they're trimmed by trim_tests and the row is marked truncated.
     """
-    tests = []
-    for result in results:
-        for test in parse_junit(result):
-            if '#' in test['name'] and not test.get('failed'):
-                continue  # skip successful repeated tests
-            tests.append(test)
+    if tests is None:
+        tests = parse_tests(results)
+    size = sum(test_size(test) for test in tests)
 
     def get_metadata():
         metadata = None
@@ -263,6 +553,9 @@ def row_for_build(path, started, finished, results):
 
     metadata, repos = get_metadata()
     build = Build.generate(path, tests, started, finished, metadata, repos)
+    # tests_run and tests_failed still count every test.
+    if size > MAX_TESTS_SIZE and trim_tests(build.test, MAX_TESTS_SIZE, size):
+        build.truncated = True
     return build.as_dict()
 
 
@@ -272,6 +565,17 @@ def get_table(days):
     return 'build_emitted'
 
 
+def parse_output(spec):
+    days, _, path = spec.partition(':')
+    try:
+        days = float(days)
+    except ValueError:
+        days = None
+    if days is None or not path:
+        raise argparse.ArgumentTypeError('expected DAYS:PATH, got %r' % spec)
+    return days, path
+
+
 def parse_args(args):
     parser = argparse.ArgumentParser()
     parser.add_argument('--days', type=float, default=0,
@@ -280,27 +584,214 @@ def parse_args(args):
                         help='Exit nonzero if a build older than X days was emitted previously.')
     parser.add_argument('--reset-emitted', action='store_true',
                         help='Clear list of already-emitted builds.')
+    parser.add_argument('--junit-parser', choices=sorted(JUNIT_PARSERS), default=JUNIT_PARSER,
+                        help='Engine used to parse junit XML.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Generate rows with N processes, each reading the DB separately.')
+    parser.add_argument('--output', type=parse_output, action='append', default=[],
+                        metavar='DAYS:PATH',
+                        help='Write gzipped rows for builds within DAYS (0 for all) to PATH.'
+                        ' May be repeated to write several tables in one pass.')
+    parser.add_argument('--reset-days', type=float, action='append', default=[],
+                        metavar='DAYS',
+                        help='Clear already-emitted builds for the --output with these DAYS.')
+    parser.add_argument('--compress-level', type=int, default=6, choices=range(10),
+                        metavar='0-9', help='gzip (or Avro deflate) level for --output files.')
+    parser.add_argument('--format', choices=['json', 'avro'], default='json',
+                        help='Write newline-delimited JSON, or Avro blocks (needs fastavro).')
     parser.add_argument('paths', nargs='*',
                         help='Options list of gs:// paths to dump rows for.')
     return parser.parse_args(args)
 
 
 def make_rows(db, builds):
+    """
+    Generate (rowid, row) for builds.
+
+    A build that row_for_build fails on will fail the same way every time, so
+    its row is None: it's skipped for good, and should be recorded as emitted
+    without a row so the emitted watermark can pass it. An IOError or database
+    error stops the rows short instead, leaving the rest for the next run.
+    """
     for rowid, path, started, finished in builds:
         try:
-            results = db.test_results_for_build(path)
-            yield rowid, row_for_build(path, started, finished, results)
-        except IOError:
+            tests = db.get_build_tests(rowid, TESTS_VERSION)
+            results = db.test_results_for_build(path) if tests is None else []
+            row = row_for_build(path, started, finished, results, tests)
+        except (IOError, sqlite3.Error):
+            logging.exception('error reading %s', path)
             return
         except:  # pylint: disable=bare-except
             logging.exception('error on %s', path)
+            row = None
+        yield rowid, row
+
+def serialize_row(row):
+    """
+    Serialise a row as JSON with sorted keys, using orjson when it's available.
+
+    Returns (size in bytes, UTF-8 JSON bytes).
+    """
+    if orjson is not None:
+        try:
+            data = orjson.dumps(row, option=orjson.OPT_SORT_KEYS)
+            return len(data), data
+        except orjson.JSONEncodeError:
+            pass  # e.g. integers over 64 bits
+    data = json.dumps(row, sort_keys=True).encode('ascii')
+    return len(data), data
+
+def emit_rows(db, builds, fmt='json'):
+    """
+    Generate (rowid, data) for each build that made a row.
+
+    data is newline-terminated JSON bytes, or the row itself for the avro format.
+    Rows are measured as JSON either way. A row that's still too large after
+    row_for_build's estimate has its tests trimmed further, in proportion to
+    the excess, until it fits or has no tests left. If it still doesn't fit
+    BigQuery, data is None: the build is skipped for good, and should be
+    recorded as emitted without a row, as should builds make_rows couldn't
+    make a row for.
+    """
+    for rowid, row in make_rows(db, builds):
+        if row is None:
+            yield rowid, None
+            continue
+        size, data = serialize_row(row)
+        while size > MAX_ROW_SIZE and row.get('test'):
+            estimate = sum(test_size(test) for test in row['test'])
+            trim_tests(row['test'], int(estimate * MAX_ROW_SIZE / size * 0.9), estimate)
+            row['truncated'] = True
+            size, data = serialize_row(row)
+        if size > MAX_ROW_SIZE:
+            print('row for %s exceeds maximum for bigquery %d > %d' %
+                  (row['path'], size, MAX_ROW_SIZE))
+            yield rowid, None
+            continue
+        yield rowid, row if fmt == 'avro' else data + b'\n'
+
+def mp_init_worker(db_path, junit_parser, fmt='json', shard_count=1):
+    """
+    Initialize the environment for multiprocessing-based row generation.
+    """
+    global WORKER_DB, WORKER_FORMAT, JUNIT_PARSER  # pylint: disable=global-statement
+    WORKER_DB = model.connect(db_path, readonly=True, shard_count=shard_count)
+    WORKER_FORMAT = fmt
+    JUNIT_PARSER = junit_parser
+    # stdout carries the parent's rows; keep diagnostics out of it.
+    sys.stdout = sys.stderr
+
+def emit_shard(builds):
+    return list(emit_rows(WORKER_DB, builds, WORKER_FORMAT))
+
+def emit_rows_parallel(db, builds, workers, fmt='json'):
+    """
+    Like emit_rows, but shards builds across worker processes.
+
+    Shards are contiguous runs of builds and are emitted in order, so the
+    output is the same as emit_rows gives.
+    """
+    builds = list(builds)
+    shards = (builds[n:n + SHARD_SIZE] for n in range(0, len(builds), SHARD_SIZE))
+    pool = multiprocessing.Pool(workers, mp_init_worker,
+                                (db.path, JUNIT_PARSER, fmt, db.shard_count))
+    try:
+        for shard in pool.imap(emit_shard, shards):
+            yield from shard
+    finally:
+        pool.terminate()
+
+class Output:
+    """A gzipped (or Avro) file of rows for one table, and the builds routed to it."""
+
+    def __init__(self, days, path, compress_level, fmt='json'):
+        self.days = days
+        self.path = path
+        self.incremental_table = get_table(days)
+        self.rowids = set()
+        self.emitted = []
+        self.tmp_path = path + '.tmp'
+        if fmt == 'avro':
+            self.file = open(self.tmp_path, 'wb')
+            self.writer = columnar.AvroRowWriter(self.file, compress_level)
+        else:
+            self.file = self.writer = gzip.open(self.tmp_path, 'wb', compresslevel=compress_level)
+
+    def write(self, rowid, data):
+        if data is not None:
+            self.writer.write(data)
+        self.emitted.append(rowid)
+
+    def close(self):
+        if self.writer is not self.file:
+            self.writer.close()
+        self.file.close()
+
+    def discard(self):
+        """Close the file, deleting it unless it has replaced path."""
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def write_outputs(db, opts):
+    """
+    Write rows for every --output in one pass over the builds.
+
+    Each build's row is made once, and written to each output whose window
+    includes it and that hasn't emitted it yet. Files are replaced only once
+    they're complete.
+    """
+    now = time.time()
+    outputs = []
+    try:
+        builds = {}
+        for days, path in opts.output:
+            output = Output(days, path, opts.compress_level, opts.format)
+            outputs.append(output)
+            if days in opts.reset_days:
+                db.reset_emitted(output.incremental_table)
+            min_started = now - days * SECONDS_PER_DAY if days else 0
+            for build in db.get_builds(min_started=min_started,
+                                       incremental_table=output.incremental_table):
+                builds[build[0]] = build
+                output.rowids.add(build[0])
+        builds = sorted(builds.values(),
+                        key=lambda build: (model.finished_time_key(build[3]), build[0]))
+
+        if opts.workers > 1:
+            # workers read the DB on their own connections, so it must be committed.
+            db.commit()
+            rows = emit_rows_parallel(db, builds, opts.workers, opts.format)
+        else:
+            rows = emit_rows(db, builds, opts.format)
+
+        for rowid, data in rows:
+            for output in outputs:
+                if rowid in output.rowids:
+                    output.write(rowid, data)
+
+        for output in outputs:
+            output.close()
+            os.replace(output.tmp_path, output.path)
+    finally:
+        for output in outputs:
+            output.discard()
+
+    for output in outputs:
+        if output.emitted:
+            gen = db.insert_emitted(output.emitted, incremental_table=output.incremental_table)
+            print('%s: %d builds, incremental progress gen #%d' %
+                  (output.path, len(output.emitted), gen), file=sys.stderr)
+        else:
+            print('%s: no rows emitted' % output.path, file=sys.stderr)
+    return 0
 
-def json_size(row):
-    meterfile = MeterFile()
-    json.dump(row, meterfile)
-    return meterfile.size
 
 def main(db, opts, outfile):
+    global JUNIT_PARSER  # pylint: disable=global-statement
+    JUNIT_PARSER = opts.junit_parser
+
     min_started = 0
     if opts.days:
         min_started = time.time() - (opts.days or 1) * SECONDS_PER_DAY
@@ -314,27 +805,40 @@ def main(db, opts, outfile):
             return 1 # if table is outdated, allow cycle
         return 0
 
+    if opts.output:
+        return write_outputs(db, opts)
+
     if opts.reset_emitted:
         db.reset_emitted(incremental_table)
 
     if opts.paths:
         # When asking for rows for specific builds, use a dummy table and clear it first.
-        incremental_table = 'incremental_manual'
+        incremental_table = model.MANUAL_INCREMENTAL_TABLE
         db.reset_emitted(incremental_table)
         builds = list(db.get_builds_from_paths(opts.paths, incremental_table))
     else:
-        builds = db.get_builds(min_started=min_started, incremental_table=incremental_table)
+        builds = list(db.get_builds(min_started=min_started, incremental_table=incremental_table))
 
-    rows_emitted = set()
-    for rowid, row in make_rows(db, builds):
-        size = json_size(row)
-        if size > MAX_ROW_SIZE:
-            print('row for %s exceeds maximum for bigquery %d > %d' %
-                  (row['path'], size, MAX_ROW_SIZE))
-            continue
-        json.dump(row, outfile, sort_keys=True)
-        outfile.write('\n')
-        rows_emitted.add(rowid)
+    if opts.workers > 1:
+        # workers read the DB on their own connections, so it must be committed.
+        db.commit()
+        rows = emit_rows_parallel(db, builds, opts.workers, opts.format)
+    else:
+        rows = emit_rows(db, builds, opts.format)
+
+    outfile = getattr(outfile, 'buffer', outfile)  # rows are bytes
+    if opts.format == 'avro':
+        writer = columnar.AvroRowWriter(outfile, opts.compress_level)
+    else:
+        writer = outfile
+
+    rows_emitted = []
+    for rowid, data in rows:
+        if data is not None:
+            writer.write(data)
+        rows_emitted.append(rowid)
+    if writer is not outfile:
+        writer.close()
 
     if rows_emitted:
         gen = db.insert_emitted(rows_emitted, incremental_table=incremental_table)
@@ -345,6 +849,6 @@ def main(db, opts, outfile):
 
 
 if __name__ == '__main__':
-    DB = model.Database()
+    DB = model.connect()
     OPTIONS = parse_args(sys.argv[1:])
     sys.exit(main(DB, OPTIONS, sys.stdout))
@@ -14,13 +14,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import glob
+import gzip
 import io as StringIO
 import json
+import os
+import tempfile
 import time
 import unittest
 
 from parameterized import parameterized
 
+import columnar
 import make_json
 import model
 
@@ -36,6 +41,47 @@ class ValidateBuckets(unittest.TestCase):
             self.assertNotIn(prefix, prefixes, "bucket %s prefix %r isn't unique" % (name, prefix))
             self.assertEqual(prefix[-1], ':', "bucket %s prefix should be %s:" % (name, prefix))
 
+    def test_bucket_index(self):
+        buckets = {
+            'gs://a/logs/': {'prefix': 'a:'},
+            'gs://a/logs/special/': {'prefix': 'special:'},
+            'gs://b/lo': {'prefix': 'b:'},
+            'gs://b/logs/': {'prefix': 'never:'},
+        }
+        index = make_json.BucketIndex(buckets)
+        for path, prefix in [
+                ('gs://a/logs/job/1', 'a:'),
+                ('gs://a/logs/special/job/1', 'a:'),  # first match wins, like a scan
+                ('gs://b/logs/job/2', 'b:'),
+                ('gs://c/logs/job/3', None)]:
+            meta = index.lookup(path)
+            self.assertEqual(meta and meta['prefix'], prefix, path)
+        index = make_json.BucketIndex(make_json.BUCKETS)
+        for bucket, meta in make_json.BUCKETS.items():
+            self.assertIs(index.lookup(bucket + 'some-job/123'), meta)
+
+    def test_cached_buckets_yaml(self):
+        loads = []
+        def load():
+            loads.append(1)
+            return {'gs://a/logs/': {'prefix': 'a:'}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'buckets.yaml')
+            cache_path = path + '.json'
+            with open(path, 'w') as fp:
+                fp.write('gs://a/logs/:\n  prefix: "a:"\n')
+            for _ in range(2):
+                self.assertEqual(make_json.cached_buckets_yaml(path, cache_path, load),
+                                 {'gs://a/logs/': {'prefix': 'a:'}})
+            self.assertEqual(len(loads), 1)
+            os.utime(path, (0, 0))  # same content: rehashed, not reparsed
+            make_json.cached_buckets_yaml(path, cache_path, load)
+            self.assertEqual(len(loads), 1)
+            with open(path, 'a') as fp:
+                fp.write('# edited\n')
+            make_json.cached_buckets_yaml(path, cache_path, load)
+            self.assertEqual(len(loads), 2)
+
 
 class BuildObjectTests(unittest.TestCase):
     @parameterized.expand([
@@ -553,6 +599,95 @@ class MakeJsonTest(unittest.TestCase):
                test=[{'name': 't1', 'time': 1.0, 'failed': True, 'failure_text': 'stacktrace'},
                      {'name': 't2', 'time': 2.0}])
 
+    def test_trim_tests(self):
+        def trim(tests, budget):
+            tests = [dict(test) for test in tests]
+            return make_json.trim_tests(tests, budget), tests
+
+        short, long_ = 'x' * 2000, 'y' * 9000
+        tests = [{'name': 'f1', 'failed': True, 'failure_text': short},
+                 {'name': 'p1'},
+                 {'name': 'f2', 'failed': True, 'failure_text': long_},
+                 {'name': 'p2'}]
+        size = sum(map(make_json.test_size, tests))
+        self.assertEqual(trim(tests, size), (False, tests))
+
+        # only the longest failure text is cut
+        changed, got = trim(tests, size - 5000)
+        self.assertTrue(changed)
+        self.assertEqual(got[0], tests[0])
+        self.assertTrue(got[2]['failure_text'].startswith('y' * 3000))
+        self.assertTrue(got[2]['failure_text'].endswith('characters truncated]'))
+        self.assertLessEqual(sum(map(make_json.test_size, got)), size - 5000)
+
+        # texts stop at MIN_FAILURE_TEXT, then passing tests go from the end
+        budget = 2 * (make_json.MIN_FAILURE_TEXT + make_json.TEST_OVERHEAD) + 100
+        changed, got = trim(tests, budget)
+        self.assertEqual([t['name'] for t in got], ['f1', 'f2'])
+        self.assertTrue(all(len(t['failure_text']) < 1100 for t in got))
+
+        # then failed tests
+        changed, got = trim(tests, make_json.MIN_FAILURE_TEXT + 200)
+        self.assertEqual([t['name'] for t in got], ['f1'])
+        self.assertEqual(trim(tests, 0), (True, []))
+
+    def test_row_for_build_truncated(self):
+        self.addCleanup(setattr, make_json, 'MAX_TESTS_SIZE', make_json.MAX_TESTS_SIZE)
+        make_json.MAX_TESTS_SIZE = 3000
+        cases = ''.join('<testcase name="t%d"/>' % n for n in range(100))
+        xml = '<testsuite>%s<testcase name="f"><failure>%s</failure></testcase></testsuite>' % (
+            cases, 'z' * 5000)
+        row = make_json.row_for_build('gs://kubernetes-jenkins/logs/J/1', None, None, [xml])
+        self.assertTrue(row['truncated'])
+        self.assertEqual((row['tests_run'], row['tests_failed']), (101, 1))
+        self.assertEqual(row['test'][-1]['name'], 'f')
+        self.assertLess(len(row['test'][-1]['failure_text']), 3000)
+        self.assertEqual([t['name'] for t in row['test'][:3]], ['t0', 't1', 't2'])
+        self.assertLessEqual(sum(map(make_json.test_size, row['test'])), 3000)
+
+    def test_schema(self):
+        fields = {field['name']: field for field in columnar.load_schema()}
+        self.addCleanup(setattr, make_json, 'MAX_TESTS_SIZE', make_json.MAX_TESTS_SIZE)
+        make_json.MAX_TESTS_SIZE = 2000
+        xml = ('<testsuite><testcase name="a" time="1"/><testcase name="b">'
+               '<failure>%s</failure></testcase></testsuite>' % ('x' * 5000))
+        row = make_json.row_for_build(
+            'gs://kubernetes-jenkins/logs/J/1',
+            {'timestamp': 10, 'node': 'n', 'repos': {'k': 'v'}, 'repo-version': 'r'},
+            {'timestamp': 20, 'result': 'FAILURE', 'version': 'v1',
+             'metadata': {'repos': {'k': 'v'}, 'infra-commit': 'c'}},
+            [xml])
+        self.assertTrue(row['truncated'])
+        # every attribute a Build can hold, set or not, has a column
+        self.assertLessEqual(set(vars(make_json.Build('gs://kubernetes-jenkins/logs/J/1', []))),
+                             set(fields))
+        self.assertLessEqual(set(row), set(fields))
+        for name in ['test', 'metadata']:
+            self.assertTrue(row[name])
+            subfields = {field['name'] for field in fields[name]['fields']}
+            for item in row[name]:
+                self.assertLessEqual(set(item), subfields)
+
+    def test_make_rows_build_tests(self):
+        path = 'gs://kubernetes-jenkins/logs/some-job/1'
+        junit = '<testsuite><testcase name="t1" time="3.0"/></testsuite>'
+        self.db.insert_build(path, {'timestamp': 1}, {'timestamp': 2, 'result': 'SUCCESS'})
+        self.db.insert_build_junits(1, {path + '/artifacts/junit.xml': junit})
+        builds = list(self.db.get_builds())
+
+        def test_names():
+            return [[test['name'] for test in row['test']]
+                    for _, row in make_json.make_rows(self.db, builds)]
+
+        rows = list(make_json.make_rows(self.db, builds))
+        self.db.insert_build_tests(1, make_json.parse_tests([junit]), make_json.TESTS_VERSION)
+        self.assertEqual(list(make_json.make_rows(self.db, builds)), rows)
+        self.db.insert_build_tests(1, [{'name': 'cached'}], make_json.TESTS_VERSION)
+        self.assertEqual(test_names(), [['cached']])
+        # tests parsed by another version are ignored
+        self.db.insert_build_tests(1, [{'name': 'cached'}], make_json.TESTS_VERSION - 1)
+        self.assertEqual(test_names(), [['t1']])
+
     def test_main(self):
         now = time.time()
         last_month = now - (60 * 60 * 24 * 30)
@@ -569,10 +704,10 @@ class MakeJsonTest(unittest.TestCase):
             self.db.commit()
 
         def expect(args, needles, negneedles, expected_ret=None):
-            buf = StringIO.StringIO()
+            buf = StringIO.BytesIO()
             opts = make_json.parse_args(args)
             ret = make_json.main(self.db, opts, buf)
-            result = buf.getvalue()
+            result = buf.getvalue().decode('utf-8')
 
             if expected_ret is not None:
                 self.assertEqual(ret, expected_ret)
@@ -616,6 +751,145 @@ class MakeJsonTest(unittest.TestCase):
         expect(['--days=30', '--assert-oldest=25'], [], [], 1)
 
 
+    def test_main_outputs(self):
+        now = time.time()
+        for number, finished in [(1, now - 10 * 86400), (2, now - 10), (3, now)]:
+            self.db.insert_build('gs://kubernetes-jenkins/logs/some-job/%d' % number,
+                                 {'timestamp': finished - 5}, {'timestamp': finished})
+        self.db.insert_emitted([3], make_json.get_table(1))
+        self.db.commit()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def expect(args, expected):
+                day, week = os.path.join(tmpdir, 'day.gz'), os.path.join(tmpdir, 'all.gz')
+                opts = make_json.parse_args(
+                    ['--output', '1:' + day, '--output', '0:' + week, '--compress-level=1'] + args)
+                self.assertEqual(make_json.main(self.db, opts, None), 0)
+                got = []
+                for path in [day, week]:
+                    with gzip.open(path, 'rt') as fp:
+                        got.append(sorted(json.loads(line)['number'] for line in fp))
+                self.assertEqual(got, expected)
+                self.assertEqual(glob.glob(os.path.join(tmpdir, '*.tmp')), [])
+
+            expect([], [[2], [1, 2, 3]])
+            expect([], [[], []])
+            expect(['--reset-days', '1'], [[2, 3], []])
+
+    def test_main_outputs_mixed(self):
+        for number, finished in [(1, '2000000000'), (2, 1000), (3, 1000.5)]:
+            self.db.insert_build('gs://kubernetes-jenkins/logs/some-job/%d' % number,
+                                 {'timestamp': 0}, {'timestamp': finished})
+        self.db.commit()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'all.gz')
+            opts = make_json.parse_args(['--output', '0:' + path])
+            emit_rows = make_json.emit_rows
+            self.addCleanup(setattr, make_json, 'emit_rows', emit_rows)
+
+            def failing_emit_rows(*args):
+                yield next(emit_rows(*args))
+                raise IOError('disk full')
+
+            make_json.emit_rows = failing_emit_rows
+            with self.assertRaises(IOError):
+                make_json.main(self.db, opts, None)
+            self.assertEqual(os.listdir(tmpdir), [])
+
+            make_json.emit_rows = emit_rows
+            self.assertEqual(make_json.main(self.db, opts, None), 0)
+            with gzip.open(path, 'rt') as fp:
+                self.assertEqual([json.loads(line)['number'] for line in fp], [2, 3, 1])
+
+    def test_main_skipped(self):
+        for number in [1, 2, 3]:
+            self.db.insert_build('gs://kubernetes-jenkins/logs/some-job/%d' % number,
+                                 {'timestamp': number}, {'timestamp': number + 1})
+        self.db.commit()
+        failing = {'gs://kubernetes-jenkins/logs/some-job/1': ValueError('bad build'),
+                   'gs://kubernetes-jenkins/logs/some-job/3': IOError('flaky read')}
+        row_for_build = make_json.row_for_build
+
+        def fake_row_for_build(path, *args):
+            if path in failing:
+                raise failing[path]
+            row = row_for_build(path, *args)
+            if path.endswith('/2'):
+                row['padding'] = 'x' * make_json.MAX_ROW_SIZE
+            return row
+
+        self.addCleanup(setattr, make_json, 'row_for_build', row_for_build)
+        self.addCleanup(setattr, make_json, 'MAX_ROW_SIZE', make_json.MAX_ROW_SIZE)
+        make_json.row_for_build = fake_row_for_build
+        make_json.MAX_ROW_SIZE = 1000
+
+        def run():
+            buf = StringIO.BytesIO()
+            make_json.main(self.db, make_json.parse_args([]), buf)
+            return [json.loads(line)['number'] for line in buf.getvalue().splitlines()]
+
+        # The bad and oversize builds are skipped for good, the IOError is retried.
+        self.assertEqual(run(), [])
+        self.assertEqual([path for _, path, _, _ in self.db.get_builds()],
+                         ['gs://kubernetes-jenkins/logs/some-job/3'])
+        failing.clear()
+        self.assertEqual(run(), [3])
+        self.assertEqual(list(self.db.get_builds()), [])
+
+    def test_main_skipped_passes_watermark(self):
+        # A build that never makes a row doesn't hold back the builds after it.
+        for number in range(50):
+            self.db.insert_build('gs://kubernetes-jenkins/logs/some-job/%d' % number,
+                                 {'timestamp': number}, {'timestamp': number + 1})
+        self.db.commit()
+        row_for_build = make_json.row_for_build
+
+        def fake_row_for_build(path, *args):
+            if path.endswith('/0'):
+                raise ValueError('unknown bucket')
+            return row_for_build(path, *args)
+
+        self.addCleanup(setattr, make_json, 'row_for_build', row_for_build)
+        make_json.row_for_build = fake_row_for_build
+        buf = StringIO.BytesIO()
+        make_json.main(self.db, make_json.parse_args([]), buf)
+        self.assertEqual(len(buf.getvalue().splitlines()), 49)
+        self.assertEqual(list(self.db.get_builds()), [])
+        self.assertEqual(self.db.db.execute('select count(*) from emitted_extra').fetchone(), (0,))
+
+    def test_parse_output(self):
+        self.assertEqual(make_json.parse_output('7:build_week.json.gz'), (7, 'build_week.json.gz'))
+        with self.assertRaises(SystemExit):
+            make_json.parse_args(['--output', 'build_week.json.gz'])
+
+    def test_serialize_row(self):
+        row = {'test': [{'name': 'caf\u00e9', 'time': 2.5}], 'path': 'gs://a/b/1', 'number': 1}
+        size, data = make_json.serialize_row(row)
+        self.assertEqual(json.loads(data), row)
+        self.assertTrue(data.index(b'"number"') < data.index(b'"path"') < data.index(b'"test"'))
+        self.assertEqual(size, len(data))
+
+    def test_main_workers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = model.Database(os.path.join(tmpdir, 'build.db'))
+            for n in range(make_json.SHARD_SIZE + 5):
+                path = 'gs://kubernetes-jenkins/logs/some-job/%d' % n
+                db.insert_build(path, {'timestamp': n}, {'timestamp': n + 1, 'result': 'SUCCESS'})
+                db.insert_build_junits(n, {path + '/artifacts/junit.xml':
+                                           '<testsuite><testcase name="t%d"/></testsuite>' % n})
+
+            def run(args):
+                buf = StringIO.BytesIO()
+                make_json.main(db, make_json.parse_args(args), buf)
+                return buf.getvalue()
+
+            serial = run(['--reset-emitted'])
+            self.assertEqual(serial.count(b'\n'), make_json.SHARD_SIZE + 5)
+            self.assertEqual(run(['--reset-emitted', '--workers=3']), serial)
+            self.assertEqual(run(['--workers=3']), b'')
+
+
 class ParseJsonTest(unittest.TestCase):
     @parameterized.expand([
         ('Green Path',
@@ -681,5 +955,40 @@ class ParseJsonTest(unittest.TestCase):
         failures = make_json.parse_junit(datasource.read())
         self.assertEqual(list(failures), expected)
 
+    def test_parsers_match(self):
+        parsers = ['etree', 'iterparse']
+        try:
+            import lxml  # pylint: disable=import-outside-toplevel,unused-import
+            parsers.append('lxml')
+        except ImportError:
+            pass
+        paths = sorted(glob.glob('kettle/testdata/*.xml'))
+        self.assertTrue(paths, 'no testdata found; run from the repository root')
+        for path in paths + [None]:
+            if path:
+                with open(path) as fp:
+                    xml = fp.read()
+            else:
+                xml = '''<testsuites>
+                    <testsuite name="s">
+                        <testcase name="a" time="1">
+                            <failure message="m"/><failure>t</failure>
+                        </testcase>
+                        <testsuite name="nested"><testcase name="ignored"/></testsuite>
+                        <testcase name="skip"><skipped/></testcase>
+                        <system-out>noise</system-out>
+                    </testsuite>
+                    <testcase name="suite-like"><testcase name="inner"/></testcase>
+                </testsuites>'''
+            expected = list(make_json.JUNIT_PARSERS['etree'](xml))
+            for parser in parsers:
+                self.assertEqual(list(make_json.JUNIT_PARSERS[parser](xml)), expected,
+                                 '%s differs on %s' % (parser, path))
+            pull = make_json.JunitParser()
+            data = xml.encode('utf-8')
+            for n in range(0, len(data), 7):
+                pull.feed(data[n:n + 7])
+            self.assertEqual(pull.close(), expected, 'JunitParser differs on %s' % path)
+
 if __name__ == '__main__':
     unittest.main()
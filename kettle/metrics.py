@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prometheus-style counters and histograms for kettle's ingestion stages.
+
+Metrics are kept in the process that records them. serve() exposes them over
+HTTP in the Prometheus text format, and dump() returns the same text. A forked
+process starts with empty metrics; call_collecting and merging carry a pool
+worker's metrics back to its parent.
+"""
+
+import atexit
+import bisect
+import contextlib
+import http.server
+import os
+import threading
+import time
+
+# Seconds, for request and commit latencies.
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+# Counts, e.g. messages per Pub/Sub pull.
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+REGISTRY = {}  # name: metric, in registration order
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # label values: value
+        REGISTRY[name] = self
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('%s takes labels %s, got %s'
+                             % (self.name, self.labels, sorted(labels)))
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _labels(self, key, *extra):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def text(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self._lines(key, value))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    """A count that only goes up, e.g. requests made."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def _merge(self, values):
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+    def _lines(self, key, value):
+        yield '%s%s %s' % (self.name, self._labels(key), _format(value))
+
+
+class Histogram(_Metric):
+    """Observations counted into buckets by upper bound, e.g. request latencies."""
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum of observations
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how many seconds the with block takes."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def count(self, **labels):
+        with self.lock:
+            counts = self.values.get(self._key(labels))
+            return sum(counts[:-1]) if counts else 0
+
+    def _merge(self, values):
+        with self.lock:
+            for key, counts in values.items():
+                mine = self.values.setdefault(key, [0] * len(counts))
+                for n, count in enumerate(counts):
+                    mine[n] += count
+
+    def _lines(self, key, counts):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            total += count
+            yield '%s_bucket%s %d' % (self.name, self._labels(key, ('le', bound)), total)
+        yield '%s_sum%s %s' % (self.name, self._labels(key), _format(counts[-1]))
+        yield '%s_count%s %d' % (self.name, self._labels(key), total)
+
+
+def dump():
+    """Return every metric in the Prometheus text format."""
+    return ''.join(metric.text() for metric in list(REGISTRY.values()))
+
+
+def write(path):
+    with open(path, 'w') as fp:
+        fp.write(dump())
+
+
+def reset():
+    for metric in list(REGISTRY.values()):
+        metric._reset()  # pylint: disable=protected-access
+
+
+if hasattr(os, 'register_at_fork'):
+    # Otherwise a forked worker would report its parent's metrics again.
+    os.register_at_fork(after_in_child=reset)
+
+
+def take():
+    """Return this process's metric values and reset them, for merge() elsewhere."""
+    values = {}
+    for name, metric in list(REGISTRY.items()):
+        with metric.lock:
+            if metric.values:
+                values[name], metric.values = metric.values, {}
+    return values
+
+
+def merge(values):
+    """Add metric values returned by take() to this process's metrics."""
+    for name, metric_values in values.items():
+        REGISTRY[name]._merge(metric_values)  # pylint: disable=protected-access
+
+
+def call_collecting(func, arg):
+    """Return (func(arg), take()), for a process pool worker to run func."""
+    return func(arg), take()
+
+
+def merging(results):
+    """Merge the metrics from call_collecting results, generating the results of func."""
+    for result, values in results:
+        merge(values)
+        yield result
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = dump().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass  # scraped every few seconds; not worth logging
+
+
+def serve(port, host=''):
+    """Serve metrics at http://host:port/metrics on a daemon thread, returning the server."""
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        help='Serve Prometheus metrics over HTTP on this port.',
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Write metrics in the Prometheus text format to this file at exit.',
+    )
+
+
+def setup(opts):
+    """Start serving or arrange to write metrics, as add_arguments' options ask."""
+    if opts.metrics_port:
+        serve(opts.metrics_port)
+    if opts.metrics_file:
+        atexit.register(write, opts.metrics_file)
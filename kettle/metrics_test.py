@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import functools
+import multiprocessing
+import unittest
+import urllib.request
+
+import metrics
+import model
+
+
+def double(value):
+    DOUBLED.inc()
+    return value * 2
+
+
+DOUBLED = metrics.Counter('test_doubled_total', 'Values doubled.')
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_text(self):
+        counter = metrics.Counter('test_requests_total', 'Requests "made".', ['code'])
+        counter.inc(code=200)
+        counter.inc(2, code=200)
+        counter.inc(code='error')
+        hist = metrics.Histogram('test_seconds', 'Seconds.', buckets=(1, 5))
+        for value in [0.5, 1, 3, 10]:
+            hist.observe(value)
+        self.assertEqual(counter.value(code=200), 3)
+        self.assertEqual(hist.count(), 4)
+        with self.assertRaises(ValueError):
+            counter.inc()
+        text = metrics.dump()
+        self.assertIn('# HELP test_requests_total Requests "made".\n'
+                      '# TYPE test_requests_total counter\n'
+                      'test_requests_total{code="200"} 3\n'
+                      'test_requests_total{code="error"} 1\n', text)
+        self.assertIn('# TYPE test_seconds histogram\n'
+                      'test_seconds_bucket{le="1"} 2\n'
+                      'test_seconds_bucket{le="5"} 3\n'
+                      'test_seconds_bucket{le="+Inf"} 4\n'
+                      'test_seconds_sum 14.5\n'
+                      'test_seconds_count 4\n', text)
+
+    def test_take_merge(self):
+        hist = metrics.Histogram('test_take_seconds', 'Seconds.', buckets=(1,))
+        hist.observe(2)
+        taken = metrics.take()
+        self.assertEqual(hist.count(), 0)
+        metrics.merge(taken)
+        metrics.merge(taken)
+        self.assertEqual(hist.count(), 2)
+
+    def test_process_pool(self):
+        DOUBLED.inc(10)  # not seen again from the forked workers
+        with multiprocessing.Pool(2) as pool:
+            results = metrics.merging(pool.imap_unordered(
+                functools.partial(metrics.call_collecting, double), range(5)))
+            self.assertEqual(sorted(results), [0, 2, 4, 6, 8])
+        self.assertEqual(DOUBLED.value(), 15)
+
+    def test_serve(self):
+        db = model.Database(':memory:')
+        db.insert_build('gs://kubernetes-jenkins/logs/job/1', {'timestamp': 1}, None)
+        db.commit()
+        server = metrics.serve(0, 'localhost')
+        try:
+            url = 'http://localhost:%d/metrics' % server.server_address[1]
+            with urllib.request.urlopen(url) as resp:
+                text = resp.read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('kettle_builds_inserted_total 1\n', text)
+        self.assertIn('kettle_sqlite_commit_seconds_count 1\n', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,12 +13,183 @@
 # limitations under the License.
 
 
+import array
+import bisect
+import collections
+import hashlib
+import heapq
 import json
 import os
 import sqlite3
+import sys
 import time
 import zlib
 
+import metrics
+
+# sqlite limits a statement to 999 variables by default.
+MAX_QUERY_PARAMS = 500
+# Page cache size, in KiB.
+CACHE_SIZE_KIB = 256 * 1024
+
+# A junit preset dictionary is trained from this many junits, using at most
+# DICT_SAMPLE_SIZE bytes of each. zlib only uses the last 32KB of a dictionary.
+DICT_SAMPLES = 500
+DICT_SAMPLE_SIZE = 1 << 16
+DICT_SIZE = 1 << 15
+
+# Builds whose junits are deleted per transaction when compacting, and free
+# pages returned to the filesystem per incremental vacuum step.
+COMPACT_BATCH = 200
+VACUUM_PAGES = 2000
+
+# make_json's table for --paths runs, whose emission state is cleared every run.
+MANUAL_INCREMENTAL_TABLE = 'incremental_manual'
+
+BUILDS_INSERTED = metrics.Counter(
+    'kettle_builds_inserted_total', 'Builds added to or updated in the database.')
+COMMIT_SECONDS = metrics.Histogram(
+    'kettle_sqlite_commit_seconds', 'Time taken by Database.commit.')
+
+
+def train_junit_dict(samples, size=DICT_SIZE):
+    """
+    Build a zlib preset dictionary from sample junits.
+
+    Lines are scored by how many samples contain them times their length, and
+    the best are packed into the dictionary with the most valuable last, where
+    zlib can reach them with the shortest distances.
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update(set(sample.splitlines(True)))
+    chosen = []
+    total = 0
+    for line, count in sorted(counts.items(), key=lambda lc: (-lc[1] * len(lc[0]), lc[0])):
+        if count < 2:
+            break
+        if total + len(line) > size:
+            continue
+        chosen.append(line)
+        total += len(line)
+    return b''.join(reversed(chosen))
+
+
+class JunitEncoder:
+    """
+    Incrementally compress a junit for the blob table.
+
+    finish() returns (hash, format, dict_id, data), where hash is the sha256 of
+    the uncompressed junit and format is 'zlib' or 'zlib-dict' for data
+    compressed with the preset dictionary (dict_id, bytes) given as junit_dict.
+    """
+
+    def __init__(self, junit_dict=None):
+        self.hash = hashlib.sha256()
+        self.dict_id = None
+        self.format = 'zlib'
+        if junit_dict:
+            self.dict_id, zdict = junit_dict
+            self.format = 'zlib-dict'
+            self.compressor = zlib.compressobj(9, zdict=zdict)
+        else:
+            self.compressor = zlib.compressobj(9)
+        self.out = []
+
+    def write(self, data):
+        self.hash.update(data)
+        self.out.append(self.compressor.compress(data))
+
+    def finish(self):
+        self.out.append(self.compressor.flush())
+        return self.hash.digest(), self.format, self.dict_id, b''.join(self.out)
+
+
+def encode_junit(data, junit_dict=None):
+    encoder = JunitEncoder(junit_dict)
+    encoder.write(data.encode('utf-8'))
+    return encoder.finish()
+
+
+class BuildSet:
+    """
+    A set of (job, build) string pairs, e.g. the builds get_existing_builds finds.
+
+    Each job's build numbers are kept in a sorted array of 64-bit integers
+    rather than as tuples of strings, which takes a tenth of the memory for
+    millions of builds. Builds that aren't plain numbers go in a set.
+    """
+
+    def __init__(self, pairs=()):
+        self.jobs = {}  # job: sorted array of build numbers
+        self.other = set()  # (job, build) pairs for other builds
+        self.update(pairs)
+
+    @staticmethod
+    def _number(build):
+        """Return build as an int, or None if it wouldn't convert back to the same string."""
+        try:
+            number = int(build)
+        except ValueError:
+            return None
+        if str(number) != build or not -1 << 63 <= number < 1 << 63:
+            return None
+        return number
+
+    def _extend(self, job, numbers):
+        """Add a sorted array of distinct build numbers to a job."""
+        have = self.jobs.get(job)
+        if have:
+            numbers = array.array('q', sorted(set(have).union(numbers)))
+        self.jobs[sys.intern(job)] = numbers
+
+    def update(self, pairs):
+        if isinstance(pairs, BuildSet):
+            for job, numbers in pairs.jobs.items():
+                self._extend(job, array.array('q', numbers))
+            self.other |= pairs.other
+            return
+        added = collections.defaultdict(lambda: array.array('q'))
+        for job, build in pairs:
+            number = self._number(build)
+            if number is None:
+                self.other.add((job, build))
+            else:
+                added[job].append(number)
+        for job, numbers in added.items():
+            self._extend(job, array.array('q', sorted(set(numbers))))
+
+    def add(self, pair):
+        self.update([pair])
+
+    def __contains__(self, pair):
+        job, build = pair
+        number = self._number(build)
+        if number is None:
+            return pair in self.other
+        numbers = self.jobs.get(job, ())
+        n = bisect.bisect_left(numbers, number)
+        return n < len(numbers) and numbers[n] == number
+
+    def __iter__(self):
+        for job, numbers in self.jobs.items():
+            for number in numbers:
+                yield job, str(number)
+        yield from self.other
+
+    def __len__(self):
+        return sum(len(numbers) for numbers in self.jobs.values()) + len(self.other)
+
+    def __eq__(self, other):
+        if not isinstance(other, (BuildSet, set, frozenset)):
+            return NotImplemented
+        return len(self) == len(other) and all(pair in self for pair in other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'BuildSet(%r)' % sorted(self)
+
 
 class Database:
     """
@@ -27,23 +198,74 @@ class Database:
 
     DEFAULT_INCREMENTAL_TABLE = 'build_emitted'
 
-    def __init__(self, path=None):
+    shard_count = 1
+    # Whether junits inserted without a preset dictionary are sampled to train one.
+    trains_dict = True
+
+    def __init__(self, path=None, readonly=False):
         if path is None:
             path = os.getenv('KETTLE_DB') or 'build.db'
+        self.path = path
+        self.dict_samples = []
+        if readonly:
+            self.db = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+            self.junit_dicts = dict(self.db.execute('select id, data from junit_dict'))
+            return
         self.db = sqlite3.connect(path)
+        # Only takes effect in a new database; see enable_incremental_vacuum.
+        self.db.execute('pragma auto_vacuum=incremental')
+        # WAL lets make_json and stream read while make_db writes, and with
+        # synchronous=normal a commit no longer waits on fsync.
+        self.db.execute('pragma journal_mode=wal')
+        self.db.execute('pragma synchronous=normal')
+        self.db.execute('pragma cache_size=-%d' % CACHE_SIZE_KIB)
         self.db.executescript('''
             create table if not exists build(gcs_path primary key, started_json, finished_json, finished_time);
-            create table if not exists file(path string primary key, data);
+            create table if not exists file(path string primary key, data, hash);
+            create table if not exists blob(hash primary key, format, dict_id, data);
+            create table if not exists junit_dict(id integer primary key, data);
             create table if not exists build_junit_missing(build_id integer primary key);
-            create index if not exists build_finished_time_idx on build(finished_time)
+            create index if not exists build_finished_time_idx on build(finished_time);
+            create index if not exists build_unfinished_idx
+                on build(gcs_path, started_json, finished_json) where finished_json is null;
+            create table if not exists listing(
+                job_dir, build, primary key(job_dir, build)) without rowid;
+            create table if not exists listing_state(job_dir primary key, listed_time);
+            create table if not exists backfill(
+                jobs_dir, job, done_time, primary key(jobs_dir, job)) without rowid;
+            create table if not exists emitted_state(
+                tbl primary key, finished_time, build_id, min_started, min_finished, gen);
+            create table if not exists emitted_late(
+                tbl text, build_id integer, primary key(tbl, build_id)) without rowid;
+            create table if not exists emitted_extra(
+                tbl text, build_id integer, primary key(tbl, build_id)) without rowid;
+            create table if not exists build_compacted(build_id integer primary key);
+            create table if not exists build_tests(build_id integer primary key, version, data)
             ''')
+        self._add_column('file', 'hash')
+        self.junit_dicts = dict(self.db.execute('select id, data from junit_dict'))
+
+    def _add_column(self, table, column):
+        """Add a column to a table created by an older version of this schema."""
+        columns = [row[1] for row in self.db.execute('pragma table_info(%s)' % table)]
+        if column not in columns:
+            self.db.execute('alter table %s add column %s' % (table, column))
+
+    @property
+    def junit_dict(self):
+        """The (id, bytes) preset dictionary new junits are compressed with, if trained."""
+        if not self.junit_dicts:
+            return None
+        dict_id = max(self.junit_dicts)
+        return dict_id, self.junit_dicts[dict_id]
 
     def commit(self):
-        self.db.commit()
+        with COMMIT_SECONDS.time():
+            self.db.commit()
 
     def get_existing_builds(self, jobs_dir):
         """
-        Return a set of (job, number) tuples indicating already present builds.
+        Return a BuildSet of (job, number) tuples indicating already present builds.
 
         A build is already present if it has a finished.json, or if it's older than
         five days with no finished.json.
@@ -53,9 +275,10 @@ class Database:
             ' where gcs_path between ? and ?'
             ' and finished_json IS NOT NULL'
             ,
-            (jobs_dir + '\x00', jobs_dir + '\x7f')).fetchall()
+            (jobs_dir + '\x00', jobs_dir + '\x7f'))
         path_tuple = lambda path: tuple(path[len(jobs_dir):].split('/')[-2:])
-        builds_have = {path_tuple(path) for (path,) in builds_have_paths}
+        builds_have = BuildSet(path_tuple(path) for (path,) in builds_have_paths)
+        old_unfinished = []
         for path, started_json in self.db.execute(
                 'select gcs_path, started_json from build'
                 ' where gcs_path between ? and ?'
@@ -66,57 +289,278 @@ class Database:
                 continue # malformed started
             if int(started['timestamp']) < time.time() - 60*60*24*5:
                 # over 5 days old, no need to try looking for finished any more.
-                builds_have.add(path_tuple(path))
+                old_unfinished.append(path_tuple(path))
+        builds_have.update(old_unfinished)
         return builds_have
 
     ### make_db
 
+    def get_listings(self, jobs_dir):
+        """
+        Return {job_dir: (builds, listed_time)} cached by set_listing under jobs_dir.
+
+        listed_time is when the job was last listed in full.
+        """
+        listings = {}
+        for job_dir, listed_time in self.db.execute(
+                'select job_dir, listed_time from listing_state where job_dir between ? and ?',
+                (jobs_dir, jobs_dir + '\x7f')):
+            listings[job_dir] = ([], listed_time)
+        for job_dir, build in self.db.execute(
+                'select job_dir, build from listing where job_dir between ? and ?',
+                (jobs_dir, jobs_dir + '\x7f')):
+            if job_dir in listings:
+                listings[job_dir][0].append(build)
+        return listings
+
+    def set_listing(self, job_dir, builds, full):
+        """
+        Record builds seen under a job directory.
+
+        A full listing replaces what was cached before, a partial one adds to it.
+        """
+        if full:
+            self.db.execute('delete from listing where job_dir=?', (job_dir,))
+            self.db.execute('replace into listing_state values(?,?)', (job_dir, time.time()))
+        self.db.executemany('insert or ignore into listing values(?,?)',
+                            ((job_dir, build) for build in builds))
+
+    def get_backfilled(self, jobs_dir, since=0):
+        """
+        Return the jobs under jobs_dir that make_db's current pass has finished since then.
+
+        A job of '' stands for the whole of jobs_dir.
+        """
+        return {job for job, in self.db.execute(
+            'select job from backfill where jobs_dir=? and done_time >= ?', (jobs_dir, since))}
+
+    def set_backfilled(self, jobs_dir, jobs):
+        """Record that every build of these jobs under jobs_dir has been inserted."""
+        now = time.time()
+        self.db.executemany('replace into backfill values(?,?,?)',
+                            ((jobs_dir, job, now) for job in jobs))
+
+    def reset_backfill(self):
+        """Start a new make_db pass, which goes through every bucket and job again."""
+        self.db.execute('delete from backfill')
+
     def insert_build(self, build_dir, started, finished):
         """
         Add a build with optional started and finished dictionaries to the database.
         """
         started_json = started and json.dumps(started, sort_keys=True)
         finished_json = finished and json.dumps(finished, sort_keys=True)
+        finished_time = finished and finished.get('timestamp', None)
         if not self.db.execute(
                 'select 1 from build where gcs_path=? '
                 'and started_json=? and finished_json=?',
                 (build_dir, started_json, finished_json)).fetchone():
             rowid = self.db.execute(
                 'insert or replace into build values(?,?,?,?)',
-                (build_dir, started_json, finished_json,
-                 finished and finished.get('timestamp', None))).lastrowid
+                (build_dir, started_json, finished_json, finished_time)).lastrowid
             self.db.execute('insert into build_junit_missing values(?)', (rowid,))
+            self.db.execute(
+                'insert or ignore into emitted_late select tbl, ? from emitted_state'
+                ' where ? >= min_started and ? < finished_time',
+                (rowid, finished_time, finished_time))
+            BUILDS_INSERTED.inc()
             return True
         return False
 
+    def insert_builds_bulk(self, rows):
+        """
+        Add many (build_dir, started, finished) builds to the database in one transaction.
+
+        Builds whose stored started and finished JSON are unchanged are skipped.
+        Returns the number of builds written.
+        """
+        builds = {}
+        for build_dir, started, finished in rows:
+            builds[build_dir] = (
+                started and json.dumps(started, sort_keys=True),
+                finished and json.dumps(finished, sort_keys=True),
+                finished and finished.get('timestamp', None))
+        paths = list(builds)
+        for n in range(0, len(paths), MAX_QUERY_PARAMS):
+            chunk = paths[n:n + MAX_QUERY_PARAMS]
+            for path, started_json, finished_json in self.db.execute(
+                    'select gcs_path, started_json, finished_json from build'
+                    ' where gcs_path in (%s)' % ','.join('?' * len(chunk)), chunk):
+                if builds[path][:2] == (started_json, finished_json):
+                    del builds[path]
+        with self.db:
+            self.db.executemany(
+                'insert or replace into build values(?,?,?,?)',
+                ((path,) + values for path, values in builds.items()))
+            self.db.executemany(
+                'insert or ignore into build_junit_missing'
+                ' select rowid from build where gcs_path=?',
+                ((path,) for path in builds))
+            self.db.executemany(
+                'insert or ignore into emitted_late select tbl, build.rowid'
+                ' from emitted_state, build where gcs_path=?'
+                ' and build.finished_time >= emitted_state.min_started'
+                ' and build.finished_time < emitted_state.finished_time',
+                ((path,) for path in builds))
+        BUILDS_INSERTED.inc(len(builds))
+        return len(builds)
+
     def get_builds_missing_junit(self):
         """
         Return (rowid, path) for each build that hasn't enumerated junit files.
         """
-        # cleanup
-        self.db.execute('delete from build_junit_missing'
-                        ' where build_id not in (select rowid from build)')
-        return self.db.execute(
-            'select rowid, gcs_path from build'
-            ' where rowid in (select build_id from build_junit_missing)'
-        ).fetchall()
+        missing = []
+        orphans = []
+        for build_id, path in self.db.execute(
+                'select build_id, gcs_path from build_junit_missing'
+                ' left join build on build.rowid = build_id order by build_id'):
+            if path is None:  # the build was since replaced
+                orphans.append((build_id,))
+            else:
+                missing.append((build_id, path))
+        if orphans:
+            self.db.executemany('delete from build_junit_missing where build_id=?', orphans)
+        return missing
+
+    def add_dict_sample(self, junit, encoded=False):
+        """
+        Collect a junit to train the preset dictionary with, training once there are enough.
+
+        If encoded is set, junit is a JunitEncoder.finish() result, not text.
+        """
+        data = self._decode_blob(*junit[1:]) if encoded else junit.encode('utf-8')
+        self.dict_samples.append(data[:DICT_SAMPLE_SIZE])
+        if len(self.dict_samples) < DICT_SAMPLES:
+            return
+        zdict = train_junit_dict(self.dict_samples)
+        self.dict_samples = []
+        if zdict:
+            dict_id = self.db.execute('insert into junit_dict(data) values(?)',
+                                      (zdict,)).lastrowid
+            self.junit_dicts[dict_id] = zdict
+
+    def add_junit_dict(self, dict_id, zdict):
+        """Store a preset dictionary trained elsewhere under the same id."""
+        self.db.execute('insert or ignore into junit_dict values(?,?)', (dict_id, zdict))
+        self.junit_dicts[dict_id] = zdict
+
+    def _decode_blob(self, blob_format, dict_id, data):
+        if blob_format == 'zlib-dict':
+            decompressor = zlib.decompressobj(zdict=self.junit_dicts[dict_id])
+            return decompressor.decompress(data) + decompressor.flush()
+        return zlib.decompress(data)
 
-    def insert_build_junits(self, build_id, junits):
+    def insert_build_junits(self, build_id, junits, encoded=False):
         """
         Insert a junit dictionary {gcs_path: contents} for a given build's rowid.
+
+        Contents are stored once per distinct junit in the blob table. If encoded
+        is set, contents are already JunitEncoder.finish() results.
         """
         for path, data in junits.items():
-            self.db.execute('replace into file values(?,?)',
-                            (path, memoryview(zlib.compress(data.encode('utf-8'), 9))))
+            if not self.junit_dicts and self.trains_dict:
+                self.add_dict_sample(data, encoded)
+            if not encoded:
+                data = encode_junit(data, self.junit_dict)
+            digest, blob_format, dict_id, blob = data
+            self.db.execute('insert or ignore into blob values(?,?,?,?)',
+                            (digest, blob_format, dict_id, memoryview(blob)))
+            self.db.execute('replace into file values(?,NULL,?)', (path, digest))
         self.db.execute('delete from build_junit_missing where build_id=?', (build_id,))
 
+    def decode_junit(self, data):
+        """Return the text of a junit encoded by encode_junit or JunitEncoder."""
+        return self._decode_blob(*data[1:]).decode('utf-8', 'replace')
+
+    def insert_build_tests(self, build_id, tests, version):
+        """
+        Store the tests parsed from a build's junits, so make_json needn't parse them again.
+
+        version identifies how they were parsed; get_build_tests ignores others.
+        """
+        self.db.execute('replace into build_tests values(?,?,?)',
+                        (build_id, version, zlib.compress(json.dumps(tests).encode('utf-8'))))
+
+    def get_build_tests(self, build_id, version):
+        """Return the tests stored for a build with this version, or None."""
+        row = self.db.execute('select data from build_tests where build_id=? and version=?',
+                              (build_id, version)).fetchone()
+        return row and json.loads(zlib.decompress(row[0]))
+
     ### make_json
 
     def _init_incremental(self, table):
         """
-        Create tables necessary for storing incremental emission state.
+        Return the (finished_time, build_id, min_started) emission state of a table.
+
+        Every build that finished at or after min_started, and that sorts at or
+        before the (finished_time, build_id) watermark by (finished_time, rowid),
+        has been emitted, except for the late arrivals in emitted_late. Builds
+        emitted beyond the watermark are in emitted_extra until it passes them.
+
+        Tables from before watermarks listed every emitted build_id, and are
+        converted on first use.
         """
-        self.db.execute('create table if not exists %s(build_id integer primary key, gen)' % table)
+        state = self.db.execute(
+            'select finished_time, build_id, min_started from emitted_state where tbl=?',
+            (table,)).fetchone()
+        if state:
+            return state
+        self.db.execute('insert into emitted_state values(?,0,-1,0,NULL,-1)', (table,))
+        if self.db.execute("select 1 from sqlite_master where type='table' and name=?",
+                           (table,)).fetchone():
+            min_finished, gen = self.db.execute(
+                'select min(finished_time), max(gen) from build, %s where build.rowid=build_id'
+                % table).fetchone()
+            self.db.execute('insert or ignore into emitted_extra select ?, build_id from %s'
+                            % table, (table,))
+            self.db.execute(
+                'update emitted_state set finished_time=?, min_started=?, min_finished=?, gen=?'
+                ' where tbl=?',
+                (min_finished or 0, min_finished or 0, min_finished,
+                 -1 if gen is None else gen, table))
+            self.db.execute('drop table %s' % table)
+            self._advance_emitted(table)
+        return self._init_incremental(table)
+
+    def _advance_emitted(self, table):
+        """Move a table's watermark past emitted_extra builds that directly follow it."""
+        finished_time, build_id, min_started = self._init_incremental(table)
+        passed = []
+        for rowid, build_finished, extra in self.db.execute(
+                'select rowid, finished_time,'
+                ' exists(select 1 from emitted_extra where tbl=? and build_id=build.rowid)'
+                ' from build where (finished_time, rowid) > (?, ?)'
+                ' order by finished_time, rowid',
+                (table, finished_time, build_id)):
+            if not extra:
+                break
+            passed.append((table, rowid))
+            finished_time, build_id = build_finished, rowid
+        self.db.executemany('delete from emitted_extra where tbl=? and build_id=?', passed)
+        self.db.execute('update emitted_state set finished_time=?, build_id=? where tbl=?',
+                        (finished_time, build_id, table))
+        # Builds emitted out of order that are now under the watermark.
+        self.db.execute(
+            'delete from emitted_extra where tbl=? and build_id in ('
+            ' select build.rowid from emitted_extra, build'
+            ' where tbl=? and build.rowid=build_id and finished_time >= ?'
+            ' and (finished_time < ? or (finished_time = ? and build.rowid <= ?)))',
+            (table, table, min_started, finished_time, finished_time, build_id))
+
+    def _set_min_started(self, table, min_started):
+        """Forget emission state for builds finished before min_started."""
+        self.db.execute(
+            'update emitted_state set min_started=?,'
+            ' build_id=case when finished_time < ? then -1 else build_id end,'
+            ' finished_time=max(finished_time, ?) where tbl=?',
+            (min_started, min_started, min_started, table))
+        for side_table in ('emitted_late', 'emitted_extra'):
+            self.db.execute(
+                'delete from %s where tbl=? and build_id not in ('
+                ' select build.rowid from %s, build where tbl=? and build.rowid=build_id'
+                ' and (finished_time >= ? or finished_time is null))' % (side_table, side_table),
+                (table, table, min_started))
 
     @staticmethod
     def _get_builds(results):
@@ -138,37 +582,59 @@ class Database:
         Returns:
             Generator containing rowID, path, and dicts representing the started and finished json
         """
-        self._init_incremental(incremental_table)
+        if self._init_incremental(incremental_table)[2] < min_started:
+            self._set_min_started(incremental_table, min_started)
+        finished_time, build_id, emitted_since = self._init_incremental(incremental_table)
+        where, params = 'build.finished_time >= ?', [min_started]
+        if path:
+            where += ' and gcs_path between ? and ?'
+            params += [path, path + '\x7f']
         results = self.db.execute(
-            'select rowid, gcs_path, started_json, finished_json from build '
-            'where gcs_path like ?'
-            ' and finished_time >= ?' +
-            ' and rowid not in (select build_id from %s)'
-            ' order by finished_time' % incremental_table
-            , (path + '%', min_started)).fetchall()
-        return self._get_builds(results)
+            'select rowid, gcs_path, started_json, finished_json, finished_time from build'
+            ' where %s'
+            ' and (finished_time > ? or (finished_time = ? and rowid > ?) or finished_time < ?)'
+            ' and not exists (select 1 from emitted_extra where tbl=? and build_id=build.rowid)'
+            ' union all'
+            ' select build.rowid, gcs_path, started_json, finished_json, finished_time'
+            ' from emitted_late, build where tbl=? and build.rowid=build_id and %s'
+            ' order by 5, 1' % (where, where),
+            params + [finished_time, finished_time, build_id, emitted_since, incremental_table,
+                      incremental_table] + params).fetchall()
+        return self._get_builds(row[:4] for row in results)
 
     def get_builds_from_paths(self, paths, incremental_table=DEFAULT_INCREMENTAL_TABLE):
-        self._init_incremental(incremental_table)
+        finished_time, build_id, min_started = self._init_incremental(incremental_table)
         results = self.db.execute(
             'select rowid, gcs_path, started_json, finished_json from build '
             'where gcs_path in (%s)'
-            ' and rowid not in (select build_id from %s)'
-            ' order by finished_time' % (','.join(['?'] * len(paths)), incremental_table)
-            , paths).fetchall()
+            ' and not exists (select 1 from emitted_extra where tbl=? and build_id=build.rowid)'
+            ' and not ifnull(finished_time >= ?'
+            ' and (finished_time < ? or (finished_time = ? and rowid <= ?))'
+            ' and not exists (select 1 from emitted_late where tbl=? and build_id=build.rowid), 0)'
+            ' order by finished_time' % ','.join(['?'] * len(paths)),
+            list(paths) + [incremental_table, min_started, finished_time, finished_time,
+                           build_id, incremental_table]).fetchall()
         return self._get_builds(results)
 
     def test_results_for_build(self, path):
         """
         Return a list of file data under the given path. Intended for JUnit artifacts.
         """
+        if not path.endswith('/'):
+            path += '/'  # not the files of a build whose number it prefixes
         results = []
         try:
-            for dataz, in self.db.execute(
-                    'select data from file where path between ? and ?',
+            for dataz, blob_format, dict_id, blob in self.db.execute(
+                    'select file.data, blob.format, blob.dict_id, blob.data'
+                    ' from file left join blob on file.hash = blob.hash'
+                    ' where path between ? and ?',
                     (path, path + '\x7F')):
                 try:
-                    data = zlib.decompress(dataz).decode('utf-8', 'replace')
+                    if dataz is None:
+                        data = self._decode_blob(blob_format, dict_id, blob)
+                    else:  # written before the blob table
+                        data = zlib.decompress(dataz)
+                    data = data.decode('utf-8', 'replace')
                     if data:
                         results.append(data)
                 except UnicodeDecodeError:
@@ -179,20 +645,362 @@ class Database:
         return results
 
     def get_oldest_emitted(self, incremental_table):
-        return self.db.execute('select min(finished_time) from build '
-                               'where rowid in (select build_id from %s)'
-                               % incremental_table).fetchone()[0]
+        self._init_incremental(incremental_table)
+        return self.db.execute('select min_finished from emitted_state where tbl=?',
+                               (incremental_table,)).fetchone()[0]
 
     def reset_emitted(self, incremental_table=DEFAULT_INCREMENTAL_TABLE):
+        for table in ('emitted_state', 'emitted_late', 'emitted_extra'):
+            self.db.execute('delete from %s where tbl=?' % table, (incremental_table,))
         self.db.execute('drop table if exists %s' % incremental_table)
 
     def insert_emitted(self, rows_emitted, incremental_table=DEFAULT_INCREMENTAL_TABLE):
         self._init_incremental(incremental_table)
-        gen, = self.db.execute('select max(gen)+1 from %s' % incremental_table).fetchone()
-        if not gen:
-            gen = 0
-        self.db.executemany(
-            'insert into %s values(?,?)' % incremental_table,
-            ((row, gen) for row in rows_emitted))
+        rows = [(incremental_table, row) for row in rows_emitted]
+        self.db.executemany('delete from emitted_late where tbl=? and build_id=?', rows)
+        self.db.executemany('insert or ignore into emitted_extra values(?,?)', rows)
+        min_finished, gen = self.db.execute(
+            'select min_finished, gen+1 from emitted_state where tbl=?',
+            (incremental_table,)).fetchone()
+        for n in range(0, len(rows), MAX_QUERY_PARAMS):
+            chunk = [row for _, row in rows[n:n + MAX_QUERY_PARAMS]]
+            oldest, = self.db.execute(
+                'select min(finished_time) from build where rowid in (%s)'
+                % ','.join('?' * len(chunk)), chunk).fetchone()
+            if oldest is not None and (min_finished is None or oldest < min_finished):
+                min_finished = oldest
+        self.db.execute('update emitted_state set min_finished=?, gen=? where tbl=?',
+                        (min_finished, gen, incremental_table))
+        self._advance_emitted(incremental_table)
         self.db.commit()
         return gen
+
+    ### retention
+
+    def _settled_tables(self, tables):
+        if tables is None:
+            tables = [tbl for tbl, in self.db.execute('select tbl from emitted_state')
+                      if tbl != MANUAL_INCREMENTAL_TABLE]
+        for table in tables:
+            self._init_incremental(table)
+        return tables
+
+    def compact_junits(self, before, tables=None, archive=None,
+                       deadline=None, batch=COMPACT_BATCH):
+        """
+        Delete the junits of builds that finished before `before` and are settled in every table.
+
+        A build is settled in an incremental table once the table has emitted it
+        or the table's window has moved past it, so make_json won't read its
+        junits again. Tables default to every table with emission state. If
+        archive is set, junits are copied to that SQLite file before they're
+        deleted. Work is committed every `batch` builds, and stops early at the
+        deadline (epoch seconds).
+
+        Returns:
+            (builds, files, blobs) deleted.
+        """
+        tables = self._settled_tables(tables)
+        if not tables:
+            return 0, 0, 0  # nothing has been emitted yet
+        self.db.execute('create index if not exists file_hash_idx on file(hash)')
+        # Tests of builds since replaced by a newer started or finished.json.
+        self.db.execute('delete from build_tests'
+                        ' where not exists (select 1 from build where rowid=build_id)')
+        self.db.commit()
+        if archive:
+            self.db.execute('attach database ? as archive', (archive,))
+            self.db.executescript('''
+                create table if not exists archive.file(path string primary key, data, hash);
+                create table if not exists archive.blob(hash primary key, format, dict_id, data);
+                create table if not exists archive.junit_dict(id integer primary key, data);
+                insert or ignore into archive.junit_dict select * from junit_dict;
+                ''')
+        settled = (
+            'not exists (select 1 from emitted_state s where tbl in (%s) and not ('
+            ' build.finished_time < s.min_started'
+            ' or ((build.finished_time, build.rowid) <= (s.finished_time, s.build_id)'
+            '  and not exists (select 1 from emitted_late l'
+            '   where l.tbl=s.tbl and l.build_id=build.rowid))'
+            ' or exists (select 1 from emitted_extra x'
+            '  where x.tbl=s.tbl and x.build_id=build.rowid)))' % ','.join('?' * len(tables)))
+        builds_done = files_done = blobs_done = 0
+        cursor = (-1, -1)  # (finished_time, rowid) of the last build compacted
+        try:
+            while deadline is None or time.time() < deadline:
+                builds = self.db.execute(
+                    'select finished_time, rowid, gcs_path from build'
+                    ' where finished_time < ? and (finished_time, rowid) > (?, ?)'
+                    ' and not exists (select 1 from build_compacted where build_id=build.rowid)'
+                    ' and %s order by finished_time, rowid limit ?' % settled,
+                    [before, cursor[0], cursor[1]] + tables + [batch]).fetchall()
+                if not builds:
+                    break
+                cursor = builds[-1][:2]
+                hashes = set()
+                for _, rowid, path in builds:
+                    paths = (path + '/', path + '/\x7f')
+                    if archive:
+                        self.db.execute('insert or ignore into archive.blob select blob.*'
+                                        ' from file, blob on file.hash = blob.hash'
+                                        ' where path between ? and ?', paths)
+                        self.db.execute('insert or ignore into archive.file select * from file'
+                                        ' where path between ? and ?', paths)
+                    hashes.update(digest for digest, in self.db.execute(
+                        'select hash from file where path between ? and ? and hash is not null',
+                        paths))
+                    files_done += self.db.execute(
+                        'delete from file where path between ? and ?', paths).rowcount
+                    self.db.execute('delete from build_tests where build_id=?', (rowid,))
+                    self.db.execute('insert into build_compacted values(?)', (rowid,))
+                for digest in hashes:
+                    # Identical junits share a blob, which may belong to newer builds too.
+                    blobs_done += self.db.execute(
+                        'delete from blob where hash=?'
+                        ' and not exists (select 1 from file where hash=?)',
+                        (digest, digest)).rowcount
+                builds_done += len(builds)
+                self.commit()
+        finally:
+            self.commit()
+            if archive:
+                self.db.execute('detach database archive')
+        return builds_done, files_done, blobs_done
+
+    def enable_incremental_vacuum(self):
+        """
+        Switch a database created before auto_vacuum=incremental over to it.
+
+        This rewrites the whole file with VACUUM, so it's slow and blocks
+        writers; it's only needed once. Returns whether it was needed.
+        """
+        if self.db.execute('pragma auto_vacuum').fetchone()[0] == 2:
+            return False
+        self.commit()
+        self.db.execute('pragma auto_vacuum=incremental')
+        self.db.execute('vacuum')
+        return True
+
+    def vacuum_step(self, pages=VACUUM_PAGES):
+        """
+        Return up to `pages` free pages to the filesystem, returning how many remain free.
+
+        This does nothing unless auto_vacuum is incremental. Each step is its own
+        short transaction, so make_db and stream can write in between.
+        """
+        if self.db.execute('pragma auto_vacuum').fetchone()[0] == 2:
+            self.db.execute('pragma incremental_vacuum(%d)' % pages).fetchall()
+            self.commit()
+        return self.db.execute('pragma freelist_count').fetchone()[0]
+
+    def checkpoint(self):
+        """Copy the WAL into the database file, without waiting on readers."""
+        self.db.execute('pragma wal_checkpoint(passive)').fetchall()
+
+
+def finished_time_key(finished):
+    """
+    Sort key for a build's finished dict, in the build table's finished_time order.
+
+    The column has no type affinity, so timestamps are stored as given, and
+    SQLite sorts NULL first, then numbers, then strings.
+    """
+    finished_time = finished and finished.get('timestamp')
+    if finished_time is None:
+        return 0, 0
+    if isinstance(finished_time, str):
+        return 2, finished_time
+    return 1, finished_time
+
+
+def shard_for(build_path, shards):
+    """Return the shard holding a build: a hash of its job directory."""
+    return zlib.crc32(build_path.rpartition('/')[0].encode('utf-8')) % shards
+
+
+class ShardedDatabase:
+    """
+    A Database split by job across several SQLite files, with the same API.
+
+    Each shard is a complete Database at '<path>.shard<n>' holding the builds of
+    the jobs hashed to it, their junits and their emission state, so shards
+    lock, commit and vacuum independently. Bucket listings are kept in shard 0.
+    Build ids are global: rowid * shard_count + shard. Queries over many builds fan out to every
+    shard and merge the results in the order one Database would give.
+
+    Shard 0 trains the junit preset dictionaries, which are copied to the other
+    shards as they're used there.
+    """
+
+    def __init__(self, path=None, shard_count=2, readonly=False):
+        if path is None:
+            path = os.getenv('KETTLE_DB') or 'build.db'
+        self.path = path
+        self.shard_count = shard_count
+        self.shards = []
+        for shard in range(shard_count):
+            db = Database('%s.shard%d' % (path, shard), readonly=readonly)
+            db.trains_dict = False  # insert_build_junits samples for shard 0
+            if not readonly:
+                db.db.execute('create table if not exists shard_info(shard, shard_count)')
+                if not db.db.execute('select 1 from shard_info').fetchone():
+                    db.db.execute('insert into shard_info values(?,?)', (shard, shard_count))
+            info = db.db.execute('select shard, shard_count from shard_info').fetchone()
+            if info != (shard, shard_count):
+                raise ValueError('%s is shard %s of %s, not %d of %d'
+                                 % (db.path, info and info[0], info and info[1],
+                                    shard, shard_count))
+            self.shards.append(db)
+
+    def _shard(self, path):
+        return self.shards[shard_for(path, self.shard_count)]
+
+    def _split(self, build_id):
+        """Return (shard Database, local rowid) for a global build id."""
+        return self.shards[build_id % self.shard_count], build_id // self.shard_count
+
+    def _global(self, shard, rows):
+        """Generate rows with their leading local rowid made global."""
+        for row in rows:
+            yield (row[0] * self.shard_count + shard,) + tuple(row[1:])
+
+    @property
+    def junit_dict(self):
+        return self.shards[0].junit_dict
+
+    def commit(self):
+        for db in self.shards:
+            db.commit()
+
+    def get_existing_builds(self, jobs_dir):
+        builds_have = BuildSet()
+        for db in self.shards:
+            builds_have.update(db.get_existing_builds(jobs_dir))
+        return builds_have
+
+    def get_listings(self, jobs_dir):
+        return self.shards[0].get_listings(jobs_dir)
+
+    def set_listing(self, job_dir, builds, full):
+        self.shards[0].set_listing(job_dir, builds, full)
+
+    def get_backfilled(self, jobs_dir, since=0):
+        return self.shards[0].get_backfilled(jobs_dir, since)
+
+    def set_backfilled(self, jobs_dir, jobs):
+        self.shards[0].set_backfilled(jobs_dir, jobs)
+
+    def reset_backfill(self):
+        self.shards[0].reset_backfill()
+
+    def insert_build(self, build_dir, started, finished):
+        return self._shard(build_dir).insert_build(build_dir, started, finished)
+
+    def insert_builds_bulk(self, rows):
+        by_shard = collections.defaultdict(list)
+        for row in rows:
+            by_shard[shard_for(row[0], self.shard_count)].append(row)
+        return sum(self.shards[shard].insert_builds_bulk(shard_rows)
+                   for shard, shard_rows in sorted(by_shard.items()))
+
+    def get_builds_missing_junit(self):
+        missing = []
+        for shard, db in enumerate(self.shards):
+            missing.extend(self._global(shard, db.get_builds_missing_junit()))
+        missing.sort()  # oldest first, as from one Database
+        return missing
+
+    def insert_build_junits(self, build_id, junits, encoded=False):
+        db, rowid = self._split(build_id)
+        primary = self.shards[0]
+        for data in junits.values():
+            if not primary.junit_dicts:
+                primary.add_dict_sample(data, encoded)
+        if not encoded:
+            junits = {path: encode_junit(data, primary.junit_dict)
+                      for path, data in junits.items()}
+        for data in junits.values():
+            dict_id = data[2]
+            if dict_id is not None and dict_id not in db.junit_dicts:
+                db.add_junit_dict(dict_id, primary.junit_dicts[dict_id])
+        db.insert_build_junits(rowid, junits, encoded=True)
+
+    def decode_junit(self, data):
+        return self.shards[0].decode_junit(data)
+
+    def insert_build_tests(self, build_id, tests, version):
+        db, rowid = self._split(build_id)
+        db.insert_build_tests(rowid, tests, version)
+
+    def get_build_tests(self, build_id, version):
+        db, rowid = self._split(build_id)
+        return db.get_build_tests(rowid, version)
+
+    def _merge(self, results):
+        """Merge per-shard (rowid, path, started, finished) by finished time, then global id."""
+        return heapq.merge(*results, key=lambda row: (finished_time_key(row[3]), row[0]))
+
+    def get_builds(self, path='', min_started=0,
+                   incremental_table=Database.DEFAULT_INCREMENTAL_TABLE):
+        return self._merge(
+            self._global(shard, db.get_builds(path, min_started, incremental_table))
+            for shard, db in enumerate(self.shards))
+
+    def get_builds_from_paths(self, paths, incremental_table=Database.DEFAULT_INCREMENTAL_TABLE):
+        by_shard = collections.defaultdict(list)
+        for path in paths:
+            by_shard[shard_for(path, self.shard_count)].append(path)
+        return self._merge(
+            self._global(shard, self.shards[shard].get_builds_from_paths(
+                shard_paths, incremental_table))
+            for shard, shard_paths in sorted(by_shard.items()))
+
+    def test_results_for_build(self, path):
+        return self._shard(path).test_results_for_build(path)
+
+    def get_oldest_emitted(self, incremental_table):
+        oldest = [db.get_oldest_emitted(incremental_table) for db in self.shards]
+        oldest = [value for value in oldest if value is not None]
+        return min(oldest) if oldest else None
+
+    def reset_emitted(self, incremental_table=Database.DEFAULT_INCREMENTAL_TABLE):
+        for db in self.shards:
+            db.reset_emitted(incremental_table)
+
+    def insert_emitted(self, rows_emitted, incremental_table=Database.DEFAULT_INCREMENTAL_TABLE):
+        by_shard = collections.defaultdict(list)
+        for build_id in rows_emitted:
+            by_shard[build_id % self.shard_count].append(build_id // self.shard_count)
+        # Every shard advances its generation, so they stay in step.
+        return max(db.insert_emitted(by_shard[shard], incremental_table)
+                   for shard, db in enumerate(self.shards))
+
+    def compact_junits(self, before, tables=None, archive=None,
+                       deadline=None, batch=COMPACT_BATCH):
+        done = [0, 0, 0]
+        for db in self.shards:
+            for n, count in enumerate(db.compact_junits(before, tables, archive,
+                                                        deadline, batch)):
+                done[n] += count
+        return tuple(done)
+
+    def enable_incremental_vacuum(self):
+        return any([db.enable_incremental_vacuum() for db in self.shards])
+
+    def vacuum_step(self, pages=VACUUM_PAGES):
+        return sum(db.vacuum_step(pages) for db in self.shards)
+
+    def checkpoint(self):
+        for db in self.shards:
+            db.checkpoint()
+
+
+def connect(path=None, readonly=False, shard_count=None):
+    """
+    Open the kettle database at path, sharded in KETTLE_DB_SHARDS files if that's over 1.
+    """
+    if shard_count is None:
+        shard_count = int(os.getenv('KETTLE_DB_SHARDS') or 1)
+    if shard_count > 1:
+        return ShardedDatabase(path, shard_count, readonly)
+    return Database(path, readonly)
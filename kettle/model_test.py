@@ -14,7 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import tempfile
 import unittest
+import zlib
 
 import model
 
@@ -27,6 +30,38 @@ class ModelTest(unittest.TestCase):
         self.db.insert_build('/some/dir/123', {'timestamp': 123}, {'timestamp': 140})
         self.assertEqual(self.db.get_existing_builds('/some/'), {('dir', '123')})
 
+    def test_build_set(self):
+        pairs = {('a', '3'), ('a', '1'), ('b', '1580000000000000000'), ('a', '012'),
+                 ('a', '123asdf'), ('b', '99999999999999999999'), ('c', '-0')}
+        builds = model.BuildSet(pairs)
+        self.assertEqual(builds, pairs)
+        self.assertEqual(len(builds), 7)
+        self.assertEqual(sorted(builds), sorted(pairs))
+        self.assertEqual(len(builds.other), 4)  # not numbers that round-trip as int64
+        self.assertNotIn(('a', '2'), builds)
+        self.assertNotIn(('a', '12'), builds)
+        self.assertNotIn(('c', '0'), builds)
+        builds.add(('a', '2'))
+        builds.update(model.BuildSet([('a', '3'), ('a', '0'), ('d', '5')]))
+        self.assertEqual(builds, pairs | {('a', '0'), ('a', '2'), ('d', '5')})
+        self.assertEqual(list(builds.jobs['a']), [0, 1, 2, 3])
+        self.assertNotEqual(builds, pairs)
+
+    def test_insert_builds_bulk(self):
+        builds = [('/some/dir/%d' % n, {'timestamp': n}, {'timestamp': n + 10})
+                  for n in range(1, 4)]
+        self.assertEqual(self.db.insert_builds_bulk(builds), 3)
+        self.assertEqual(self.db.get_existing_builds('/some/'),
+                         {('dir', '1'), ('dir', '2'), ('dir', '3')})
+        self.assertEqual(len(self.db.get_builds_missing_junit()), 3)
+
+        # unchanged builds are skipped, changed ones replaced
+        builds[1] = ('/some/dir/2', {'timestamp': 2}, {'timestamp': 20, 'result': 'SUCCESS'})
+        self.assertEqual(self.db.insert_builds_bulk(builds), 1)
+        self.assertEqual(
+            [(path, finished) for _, path, _, finished in self.db.get_builds('/some/dir/2')],
+            [('/some/dir/2', {'timestamp': 20, 'result': 'SUCCESS'})])
+
     def test_insert_junits(self):
         self.db.insert_build('/some/dir/123', {'timestamp': 123}, {'timestamp': 140})
         self.assertEqual(self.db.get_builds_missing_junit(), [(1, '/some/dir/123')])
@@ -34,6 +69,41 @@ class ModelTest(unittest.TestCase):
         self.db.insert_build_junits(1, {'/some/dir/123/foo.txt': 'example'})
         self.assertEqual(self.db.test_results_for_build('/some/dir/123/'), ['example'])
 
+    def test_junit_blobs(self):
+        junit = '<testsuite><testcase name="a"/></testsuite>'
+        self.db.insert_build_junits(1, {'/some/dir/1/junit.xml': junit})
+        self.db.insert_build_junits(2, {'/some/dir/2/junit.xml': junit})
+        # identical junits share a blob
+        self.assertEqual(self.db.db.execute('select count(*) from blob').fetchone(), (1,))
+        self.assertEqual(self.db.test_results_for_build('/some/dir/2/'), [junit])
+
+        # rows written before the blob table are still readable
+        self.db.db.execute('insert into file(path, data) values(?,?)',
+                           ('/some/dir/3/junit.xml', zlib.compress(b'legacy')))
+        self.assertEqual(self.db.test_results_for_build('/some/dir/3/'), ['legacy'])
+
+    def test_junit_dict(self):
+        junits = ['<testsuite>\n<testcase name="common" time="1"/>\n'
+                  '<testcase name="test-%d" time="2"/>\n</testsuite>' % n
+                  for n in range(model.DICT_SAMPLES + 1)]
+        for n, junit in enumerate(junits):
+            self.db.insert_build_junits(n, {'/some/dir/%d/junit.xml' % n: junit})
+        dict_id, zdict = self.db.junit_dict
+        self.assertIn(b'<testcase name="common" time="1"/>\n', zdict)
+        self.assertNotIn(b'test-1"', zdict)
+
+        last = model.DICT_SAMPLES
+        self.assertEqual(
+            self.db.db.execute('select format, dict_id from blob order by rowid desc').fetchone(),
+            ('zlib-dict', dict_id))
+        self.assertEqual(self.db.test_results_for_build('/some/dir/%d/' % last), [junits[last]])
+        self.assertEqual(self.db.test_results_for_build('/some/dir/0/'), [junits[0]])
+
+    def test_train_junit_dict(self):
+        self.assertEqual(model.train_junit_dict([b'a\nbb\n', b'a\nbb\nc\n', b'c\n']),
+                         b'c\na\nbb\n')
+        self.assertEqual(model.train_junit_dict([b'a\nbb\n', b'a\nbb\n'], size=3), b'bb\n')
+
     def test_incremental(self):
         def add_build(num):
             self.db.insert_build(
@@ -64,6 +134,272 @@ class ModelTest(unittest.TestCase):
         expect({1, 2, 3})
         expect(set())
 
+    def test_emitted_watermark(self):
+        def add_build(num, finished):
+            self.db.insert_build('/some/dir/%d' % num, {'timestamp': 1}, {'timestamp': finished})
+
+        def emit(min_started=0):
+            rows = [rowid for rowid, _path, _started, _finished
+                    in self.db.get_builds(min_started=min_started)]
+            self.db.insert_emitted(rows)
+            return rows
+
+        def state_size():
+            return sum(self.db.db.execute('select count(*) from %s' % table).fetchone()[0]
+                       for table in ('emitted_late', 'emitted_extra'))
+
+        for num in range(1, 6):
+            add_build(num, 10 * num)
+        self.assertEqual(emit(), [1, 2, 3, 4, 5])
+        self.assertEqual(state_size(), 0)
+
+        add_build(6, 15)  # finished before the watermark, but not emitted yet
+        add_build(7, 60)
+        self.assertEqual(state_size(), 1)
+        self.assertEqual(emit(), [6, 7])
+        self.assertEqual(state_size(), 0)
+        self.assertEqual(emit(), [])
+
+        # builds emitted out of order are remembered until the watermark passes them
+        add_build(8, 70)
+        add_build(9, 80)
+        self.assertEqual([row[0] for row in self.db.get_builds_from_paths(['/some/dir/9'])], [9])
+        self.db.insert_emitted([9])
+        self.assertEqual(state_size(), 1)
+        self.assertEqual(list(self.db.get_builds_from_paths(['/some/dir/9'])), [])
+        self.assertEqual(emit(), [8])
+        self.assertEqual(state_size(), 0)
+
+        # late builds finished before min_started are forgotten
+        add_build(10, 5)
+        self.assertEqual(state_size(), 1)
+        self.assertEqual(emit(min_started=50), [])
+        self.assertEqual(state_size(), 0)
+        self.assertEqual(self.db.get_oldest_emitted('build_emitted'), 10)
+
+    def test_emitted_migration(self):
+        for num in range(1, 5):
+            self.db.insert_build('/some/dir/%d' % num, {'timestamp': 1}, {'timestamp': num})
+        self.db.db.execute('create table build_emitted_1(build_id integer primary key, gen)')
+        self.db.db.executemany('insert into build_emitted_1 values(?,?)', [(2, 0), (3, 1)])
+        self.assertEqual(self.db.get_oldest_emitted('build_emitted_1'), 2)
+        builds = self.db.get_builds(incremental_table='build_emitted_1')
+        self.assertEqual([row[0] for row in builds], [1, 4])
+        self.assertEqual(self.db.insert_emitted([4], 'build_emitted_1'), 2)
+        self.assertEqual(
+            self.db.db.execute("select name from sqlite_master where name='build_emitted_1'")
+            .fetchall(), [])
+
+    def test_build_tests(self):
+        tests = [{'name': 'a', 'time': 1.5},
+                 {'name': 'b\u00e9', 'failed': True, 'failure_text': 'x'}]
+        self.db.insert_build_tests(1, tests, 3)
+        self.assertEqual(self.db.get_build_tests(1, 3), tests)
+        self.assertIsNone(self.db.get_build_tests(1, 2))
+        self.assertIsNone(self.db.get_build_tests(2, 3))
+
+    def test_compact_junits(self):
+        shared = '<testsuite><testcase name="shared"/></testsuite>'
+        for num in range(1, 5):
+            path = '/some/dir/%d' % num
+            self.db.insert_build(path, {'timestamp': 1}, {'timestamp': num * 10})
+            junit = shared if num in (2, 4) else 'junit %d' % num
+            self.db.insert_build_junits(num, {path + '/junit.xml': junit})
+        self.assertEqual(self.db.compact_junits(35), (0, 0, 0))  # nothing emitted yet
+        self.db.insert_build_tests(1, [], 1)
+        self.db.insert_build_tests(10, [], 1)  # a build since replaced
+        self.db.insert_emitted([1, 2])
+        # builds 1 and 2 finished before the day table's window, so it never needs them
+        self.assertEqual([row[0] for row in self.db.get_builds(
+            min_started=25, incremental_table='build_emitted_1')], [3, 4])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = os.path.join(tmp, 'archive.db')
+            # build 3 isn't emitted, and build 2's blob is still used by build 4
+            self.assertEqual(self.db.compact_junits(35, archive=archive), (2, 2, 1))
+            self.assertEqual(self.db.compact_junits(35, archive=archive), (0, 0, 0))
+            self.assertEqual(model.Database(archive).test_results_for_build('/some/dir/2/'),
+                             [shared])
+        self.assertEqual(self.db.test_results_for_build('/some/dir/1/'), [])
+        self.assertEqual(self.db.db.execute('select count(*) from build_tests').fetchone(), (0,))
+        self.assertEqual(self.db.test_results_for_build('/some/dir/2/'), [])
+        self.assertEqual(self.db.test_results_for_build('/some/dir/3/'), ['junit 3'])
+        self.assertEqual(self.db.test_results_for_build('/some/dir/4/'), [shared])
+
+        # a build emitted out of order is settled, though build 3 still isn't
+        self.db.insert_emitted([4])
+        self.assertEqual(self.db.compact_junits(50, tables=['build_emitted']), (1, 1, 1))
+        self.assertEqual(self.db.test_results_for_build('/some/dir/3/'), ['junit 3'])
+
+    def test_vacuum(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = model.Database(os.path.join(tmp, 'build.db'))
+            for num in range(1, 101):
+                path = '/some/dir/%d' % num
+                db.insert_build(path, {'timestamp': 1}, {'timestamp': num})
+                db.insert_build_junits(num, {path + '/junit.xml': os.urandom(10000).hex()})
+            db.insert_emitted(range(1, 101))
+            pages = db.db.execute('pragma page_count').fetchone()[0]
+            self.assertEqual(db.compact_junits(1000, batch=30), (100, 100, 100))
+            self.assertGreater(db.vacuum_step(pages=100), 0)
+            while db.vacuum_step(pages=100):
+                pass
+            self.assertLess(db.db.execute('pragma page_count').fetchone()[0], pages / 10)
+            self.assertFalse(db.enable_incremental_vacuum())
+
+
+class QueryPlanTest(unittest.TestCase):
+    """Make sure the queries run on every make_json and stream pass stay indexed."""
+
+    def setUp(self):
+        self.db = model.Database(':memory:')
+        self.db.insert_build('gs://b/logs/job/1', {'timestamp': 1}, {'timestamp': 2})
+        self.db.insert_build('gs://b/logs/job/2', {'timestamp': 3}, None)
+        self.db.commit()
+
+    def plans(self, func, *args):
+        """Call func and return the query plan of each select it executed."""
+        statements = []
+        self.db.db.set_trace_callback(statements.append)
+        try:
+            result = func(*args)
+            if hasattr(result, '__next__'):
+                list(result)
+        finally:
+            self.db.db.set_trace_callback(None)
+        plans = []
+        for sql in statements:
+            if sql.lower().startswith('select'):
+                plans.append([row[3] for row in self.db.db.execute('explain query plan ' + sql)])
+        self.assertTrue(plans)
+        for plan in plans:
+            for step in plan:
+                self.assertNotRegex(step, r'^SCAN build( |$)', plan)
+        return plans
+
+    def test_get_existing_builds(self):
+        finished, unfinished = self.plans(self.db.get_existing_builds, 'gs://b/logs/')
+        self.assertIn('gcs_path>? AND gcs_path<?', finished[0])
+        self.assertIn('USING COVERING INDEX build_unfinished_idx', unfinished[0])
+
+    def test_get_builds(self):
+        plan = self.plans(self.db.get_builds)[-1]
+        self.assertIn('SEARCH build USING INDEX build_finished_time_idx (finished_time>?)', plan)
+        self.assertIn('SEARCH emitted_extra USING PRIMARY KEY (tbl=? AND build_id=?)', plan)
+        self.assertIn('SEARCH emitted_late USING PRIMARY KEY (tbl=?)', plan)
+        plan = self.plans(self.db.get_builds, 'gs://b/logs/', 2)[-1]
+        self.assertIn('SEARCH emitted_extra USING PRIMARY KEY (tbl=? AND build_id=?)', plan)
+
+    def test_get_builds_from_paths(self):
+        plan = self.plans(self.db.get_builds_from_paths, ['gs://b/logs/job/1'])[-1]
+        self.assertIn('(gcs_path=?)', plan[0])
+        self.assertIn('SEARCH emitted_late USING PRIMARY KEY (tbl=? AND build_id=?)', plan)
+
+    def test_insert_emitted(self):
+        self.db.insert_emitted([1])
+        plans = self.plans(self.db.insert_emitted, [2])
+        self.assertIn('SEARCH build USING COVERING INDEX build_finished_time_idx (finished_time>?)',
+                      [step for plan in plans for step in plan])
+
+    def test_get_builds_missing_junit(self):
+        self.db.db.execute('insert into build_junit_missing values(100)')  # orphan
+        plan, = self.plans(self.db.get_builds_missing_junit)
+        self.assertEqual(plan, [
+            'SCAN build_junit_missing',
+            'SEARCH build USING INTEGER PRIMARY KEY (rowid=?) LEFT-JOIN'])
+        self.assertEqual([path for _, path in self.db.get_builds_missing_junit()],
+                         ['gs://b/logs/job/1', 'gs://b/logs/job/2'])
+        self.assertEqual(
+            self.db.db.execute('select count(*) from build_junit_missing').fetchone(), (2,))
+
+    def test_get_builds_path_prefix(self):
+        self.db.insert_build('gs://b/logs2/job/3', {'timestamp': 1}, {'timestamp': 2})
+        self.assertEqual([path for _, path, _, _ in self.db.get_builds('gs://b/logs/')],
+                         ['gs://b/logs/job/1'])
+
+
+class ShardedDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'build.db')
+        self.db = model.ShardedDatabase(self.path, 3)
+        self.paths = ['gs://kubernetes-jenkins/logs/job%d/%d' % (n % 5, n + 100) for n in range(30)]
+        for n, path in enumerate(self.paths):
+            # finished times out of insertion order, with ties
+            self.db.insert_build(path, {'timestamp': n}, {'timestamp': 100 + (n * 7) % 10})
+        self.db.commit()
+
+    def test_shards(self):
+        self.assertEqual(sorted(name for name in os.listdir(os.path.dirname(self.path))
+                                if name.startswith('build.db') and '-' not in name),
+                         ['build.db.shard0', 'build.db.shard1', 'build.db.shard2'])
+        counts = [db.db.execute('select count(*) from build').fetchone()[0]
+                  for db in self.db.shards]
+        self.assertEqual(sum(counts), 30)
+        self.assertEqual(sorted(counts)[0], 6)  # whole jobs of 6 builds each
+        with self.assertRaises(ValueError):
+            model.ShardedDatabase(self.path, 2)
+        self.assertEqual(self.db.get_existing_builds('gs://kubernetes-jenkins/logs/'),
+                         {('job%d' % (n % 5), str(n + 100)) for n in range(30)})
+
+    def test_get_builds(self):
+        single = model.Database(':memory:')
+        for n, path in enumerate(self.paths):
+            single.insert_build(path, {'timestamp': n}, {'timestamp': 100 + (n * 7) % 10})
+        builds = list(self.db.get_builds())
+        self.assertEqual([b[3]['timestamp'] for b in builds],
+                         [b[3]['timestamp'] for b in single.get_builds()])
+        self.assertEqual(sorted(b[1] for b in builds), sorted(self.paths))
+        self.assertEqual(len({b[0] for b in builds}), 30)
+
+        self.db.insert_emitted([b[0] for b in builds[:20]])
+        self.assertEqual(list(self.db.get_builds()), builds[20:])
+        self.assertEqual(self.db.get_oldest_emitted('build_emitted'), 100)
+        self.assertEqual(
+            [b[1] for b in self.db.get_builds_from_paths(self.paths[:3] + self.paths[-3:])],
+            [b[1] for b in builds[20:] if b[1] in self.paths[:3] + self.paths[-3:]])
+        self.db.reset_emitted()
+        self.assertEqual(list(self.db.get_builds()), builds)
+
+    def test_get_builds_mixed_timestamps(self):
+        # SQLite sorts numbers before strings, and the merge has to agree
+        single = model.Database(':memory:')
+        for db in [self.db, single]:
+            db.reset_emitted()
+            for n, finished in enumerate(['150', 99, '0', 100.5, '98'] * 2):
+                db.insert_build('gs://kubernetes-jenkins/logs/mixed%d/1' % n,
+                                {'timestamp': 0}, {'timestamp': finished})
+        self.assertEqual([b[3] for b in self.db.get_builds() if 'mixed' in b[1]],
+                         [b[3] for b in single.get_builds()])
+
+    def test_junits(self):
+        self.addCleanup(setattr, model, 'DICT_SAMPLES', model.DICT_SAMPLES)
+        model.DICT_SAMPLES = 4
+        missing = self.db.get_builds_missing_junit()
+        self.assertEqual(sorted(path for _, path in missing), sorted(self.paths))
+        junit = ('<testsuite name="e2e" tests="1" failures="0" time="1.0">\n'
+                 '<testcase name="%s" time="1.0"/>\n</testsuite>\n')
+        missing.sort(key=lambda build: build[0] % 3)  # shard 0's builds first
+        for n, (build_id, path) in enumerate(missing):
+            self.db.insert_build_junits(build_id, {path + '/artifacts/junit.xml': junit % path})
+            if n < 3:  # each junit is sampled once
+                self.assertEqual(len(self.db.shards[0].dict_samples), n + 1)
+        self.assertEqual(self.db.get_builds_missing_junit(), [])
+        # shard 0 trained a dictionary, and the others use it
+        self.assertEqual([len(db.junit_dicts) for db in self.db.shards], [1, 1, 1])
+        for path in self.paths:
+            self.assertEqual(self.db.test_results_for_build(path), [junit % path])
+
+    def test_connect(self):
+        self.assertIsInstance(model.connect(':memory:'), model.Database)
+        for build_id, path in self.db.get_builds_missing_junit():
+            self.db.insert_build_junits(build_id, {path + '/artifacts/junit.xml': path})
+        self.db.commit()
+        reopened = model.connect(self.path, readonly=True, shard_count=3)
+        self.assertEqual([reopened.test_results_for_build(path) for path in self.paths],
+                         [[path] for path in self.paths])
+
 
 if __name__ == '__main__':
     unittest.main()
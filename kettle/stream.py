@@ -21,8 +21,10 @@ import argparse
 import json
 import os
 import pprint
+import queue
 import socket
 import sys
+import threading
 import traceback
 import time
 
@@ -38,12 +40,44 @@ except ImportError:
     print('WARNING: unable to load google cloud (test environment?)')
     traceback.print_exc()
 
+import metrics
 import model
 import make_db
 import make_json
 
 
-MAX_ROW_UPLOAD = 10 # See https://github.com/googleapis/google-cloud-go/issues/2855
+# Streaming inserts are packed up to these limits, measured on the serialised rows.
+# The byte budget leaves headroom under BigQuery's 10MB request limit; requests
+# rejected for their size anyway are split and retried.
+# See https://github.com/googleapis/google-cloud-go/issues/2855
+MAX_ROW_UPLOAD = 500
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+
+# --pipeline tuning: threads per fetch stage, builds queued between stages,
+# and the most builds (or seconds waited for them) per batch of rows uploaded.
+PIPELINE_FETCH_THREADS = 16
+PIPELINE_JUNIT_THREADS = 16
+PIPELINE_QUEUE_SIZE = 1000
+PIPELINE_UPLOAD_QUEUE_SIZE = 4
+PIPELINE_BATCH_SIZE = 100
+PIPELINE_BATCH_WAIT = 1
+PIPELINE_PULL_IDLE = 1
+# Pulled messages wait in the pipeline's queues, so their ack deadlines are
+# extended to PIPELINE_ACK_DEADLINE seconds every PIPELINE_LEASE_RENEW seconds
+# until they're acknowledged, or for at most PIPELINE_MAX_LEASE seconds.
+PIPELINE_ACK_DEADLINE = 60 * 3
+PIPELINE_LEASE_RENEW = 60
+PIPELINE_MAX_LEASE = 60 * 60
+
+_STOP = object()  # follows the last item through each pipeline queue
+
+PUBSUB_PULL_MESSAGES = metrics.Histogram(
+    'kettle_pubsub_pull_messages', 'Messages received per Pub/Sub pull batch.',
+    buckets=metrics.SIZE_BUCKETS)
+BQ_INSERT_SECONDS = metrics.Histogram(
+    'kettle_bq_insert_seconds', 'Time taken by each BigQuery streaming insert, with retries.')
+BQ_ROWS_INSERTED = metrics.Counter(
+    'kettle_bq_rows_inserted_total', 'Rows streamed into BigQuery without errors.', ['table'])
 
 
 def should_exclude(object_id, bucket_id, buckets):
@@ -71,6 +105,16 @@ def process_changes(results, buckets):
     return ack_ids, todo
 
 
+def insert_build(db, build_dir, started, finished):
+    """Add a finished build to the database, logging it."""
+    if not db.insert_build(build_dir, started, finished):
+        print('build dir already present in db: ', build_dir)
+    start = time.localtime(started.get('timestamp', 0) if started else 0)
+    print((build_dir, bool(started), bool(finished),
+           time.strftime('%F %T %Z', start),
+           finished and finished.get('result')))
+
+
 def get_started_finished(gcs_client, db, todo):
     """Download started/finished.json from build dirs in todo."""
     ack_ids = []
@@ -82,12 +126,7 @@ def get_started_finished(gcs_client, db, todo):
                     ack_id_job_build[1], ack_id_job_build[2])),
                 todo):
             if finished:
-                if not db.insert_build(build_dir, started, finished):
-                    print('build dir already present in db: ', build_dir)
-                start = time.localtime(started.get('timestamp', 0) if started else 0)
-                print((build_dir, bool(started), bool(finished),
-                       time.strftime('%F %T %Z', start),
-                       finished and finished.get('result')))
+                insert_build(db, build_dir, started, finished)
                 build_dirs.append(build_dir)
                 ack_ids.append(ack_id)
             else:
@@ -117,45 +156,105 @@ def retry(func, *args, **kwargs):
     return func(*args, **kwargs)  # one last attempt
 
 
+def acknowledge(subscriber, subscription_path, ack_ids):
+    for n in range(0, len(ack_ids), 1000):
+        retry(
+            subscriber.acknowledge,
+            subscription=subscription_path,
+            ack_ids=ack_ids[n: n + 1000])
+
+
+class RequestTooLarge(Exception):
+    """BigQuery rejected an insert request for its size."""
+
+
+def pack_rows(rows, max_rows=MAX_ROW_UPLOAD, max_bytes=MAX_UPLOAD_BYTES):
+    """Generate chunks of rows with at most max_rows rows and max_bytes of JSON.
+
+    A row over max_bytes is a chunk by itself.
+    """
+    chunk, chunk_bytes = [], 0
+    for row in rows:
+        size, _ = make_json.serialize_row(row)
+        if chunk and (len(chunk) >= max_rows or chunk_bytes + size > max_bytes):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(row)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def _insert_rows(bq_client, table, chunk):
+    """Return bq_client.insert_rows errors, or RequestTooLarge instead of raising it."""
+    try:
+        return bq_client.insert_rows(table, chunk, skip_invalid_rows=True)
+    except Exception as err:  # pylint: disable=broad-except
+        # 413 Request Entity Too Large, or 400 "Request payload size exceeds the limit"
+        if getattr(err, 'code', None) == 413 or 'payload size exceeds' in str(err):
+            return RequestTooLarge(str(err))
+        raise
+
+
+def insert_chunk(bq_client, table, chunk):
+    """Insert rows with one request, splitting it in half while it's too large."""
+    # Insert rows with row_ids into table, retrying as necessary.
+    with BQ_INSERT_SECONDS.time():
+        errors = retry(_insert_rows, bq_client, table, chunk)
+    if isinstance(errors, RequestTooLarge):
+        if len(chunk) == 1:
+            print(f'Skipping row too large for {table.full_table_id}: {errors}')
+            return
+        half = len(chunk) // 2
+        insert_chunk(bq_client, table, chunk[:half])
+        insert_chunk(bq_client, table, chunk[half:])
+        return
+    if not errors:
+        BQ_ROWS_INSERTED.inc(len(chunk), table=table.full_table_id)
+        print(f'Loaded {len(chunk)} builds into {table.full_table_id}')
+    else:
+        print(f'Errors on Chunk: {chunk}')
+        pprint.pprint(errors)
+        pprint.pprint(table.schema)
+
+
 def insert_data(bq_client, table, rows_iter):
     """Upload rows from rows_iter into bigquery table table.
 
     rows_iter should return a series of (row_id, row dictionary) tuples.
-    The row dictionary must match the table's schema.
+    The row dictionary must match the table's schema, or be None for a build
+    make_json.make_rows skipped for good.
 
     Args:
         bq_client: Client connection to BigQuery
         table: bigquery.Table object that points to a specific table
         rows_iter: row_id, dict representing a make_json.Build
-    Returns the row_ids that were inserted.
+    Returns the row_ids that were inserted or skipped.
     """
-    def divide_chunks(l, bin_size=MAX_ROW_UPLOAD):
-        # break up rows to not hit data limits
-        for i in range(0, len(l), bin_size):
-            yield l[i:i + bin_size]
-
     emitted, rows = [], []
 
     for row_id, build in rows_iter:
         emitted.append(row_id)
-        rows.append(build)
+        if build is not None:
+            rows.append(build)
 
-    if not rows:  # nothing to do
-        return []
-
-    for chunk in divide_chunks(rows):
-        # Insert rows with row_ids into table, retrying as necessary.
-        errors = retry(bq_client.insert_rows, table, chunk, skip_invalid_rows=True)
-        if not errors:
-            print(f'Loaded {len(chunk)} builds into {table.full_table_id}')
-        else:
-            print(f'Errors on Chunk: {chunk}')
-            pprint.pprint(errors)
-            pprint.pprint(table.schema)
+    for chunk in pack_rows(rows):
+        insert_chunk(bq_client, table, chunk)
 
     return emitted
 
 
+def insert_tables(bq_client, tables, table_rows, pool):
+    """Upload {name: [(row_id, row)]} to each named table concurrently on pool.
+
+    Returns {name: row_ids inserted}.
+    """
+    names = list(table_rows)
+    emitted = pool.map(
+        lambda name: insert_data(bq_client, tables[name][0], table_rows[name]), names)
+    return dict(zip(names, emitted))
+
+
 def main(
         db,
         subscriber,
@@ -170,6 +269,7 @@ def main(
     gcs_client = client_class('', {})
     if stop is None:
         stop = lambda: False
+    upload_pool = multiprocessing.pool.ThreadPool(len(tables) or 1)
 
     results = [0] * 1000  # don't sleep on first loop
     while not stop():
@@ -192,16 +292,13 @@ def main(
             results.extend(results_more)
 
         print('PULLED', len(results))
+        PUBSUB_PULL_MESSAGES.observe(len(results))
 
         ack_ids, todo = process_changes(results, buckets)
 
         if ack_ids:
             print('ACK irrelevant', len(ack_ids))
-            for n in range(0, len(ack_ids), 1000):
-                retry(
-                    subscriber.acknowledge,
-                    subscription=subscription_path,
-                    ack_ids=ack_ids[n: n + 1000])
+            acknowledge(subscriber, subscription_path, ack_ids)
 
         if todo:
             print('EXTEND-ACK ', len(todo))
@@ -224,10 +321,276 @@ def main(
 
         # stream new rows to tables
         if build_dirs and tables:
-            for table, incremental_table in tables.values():
+            table_rows = {}
+            for name, (_table, incremental_table) in tables.items():
                 builds = db.get_builds_from_paths(build_dirs, incremental_table)
-                emitted = insert_data(bq_client, table, make_json.make_rows(db, builds))
-                db.insert_emitted(emitted, incremental_table)
+                table_rows[name] = list(make_json.make_rows(db, builds))
+            emitted = insert_tables(bq_client, tables, table_rows, upload_pool)
+            for name, row_ids in emitted.items():
+                db.insert_emitted(row_ids, tables[name][1])
+
+    upload_pool.close()
+    upload_pool.join()
+
+
+class Leases:
+    """Keep extending the ack deadlines of pulled messages until they're acknowledged.
+
+    Builds can wait in the pipeline's queues for longer than one ack deadline
+    while later stages are behind, and Pub/Sub would redeliver them, so a
+    thread renews every lease held. A message that a stage dropped is given up
+    after PIPELINE_MAX_LEASE, so Pub/Sub redelivers it.
+    """
+
+    def __init__(self, subscriber, subscription_path, renew_every=PIPELINE_LEASE_RENEW):
+        self.subscriber = subscriber
+        self.subscription_path = subscription_path
+        self.lock = threading.Lock()
+        self.leased = {}  # ack_id: time pulled
+        self.closed = threading.Event()
+        threading.Thread(target=self._run, args=(renew_every,), daemon=True).start()
+
+    def add(self, ack_ids):
+        with self.lock:
+            now = time.time()
+            for ack_id in ack_ids:
+                self.leased[ack_id] = now
+        self._extend(ack_ids)
+
+    def remove(self, ack_ids):
+        with self.lock:
+            for ack_id in ack_ids:
+                self.leased.pop(ack_id, None)
+
+    def renew(self):
+        expired = time.time() - PIPELINE_MAX_LEASE
+        with self.lock:
+            for ack_id, pulled in list(self.leased.items()):
+                if pulled < expired:
+                    del self.leased[ack_id]
+            ack_ids = list(self.leased)
+        if ack_ids:
+            print('RENEW-ACK', len(ack_ids))
+            self._extend(ack_ids)
+
+    def close(self):
+        self.closed.set()
+
+    def _extend(self, ack_ids):
+        for n in range(0, len(ack_ids), 1000):
+            retry(
+                self.subscriber.modify_ack_deadline,
+                subscription=self.subscription_path,
+                ack_ids=ack_ids[n: n + 1000],
+                ack_deadline_seconds=PIPELINE_ACK_DEADLINE)
+
+    def _run(self, renew_every):
+        while not self.closed.wait(renew_every):
+            try:
+                self.renew()
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()  # the messages are redelivered
+
+
+class Stage:
+    """Apply func to each item from inq on long-lived worker threads.
+
+    Results other than None are put on outq. An item that raises is logged and
+    dropped, leaving its message unacknowledged so Pub/Sub redelivers it. Once
+    every worker has taken _STOP from inq, _STOP is put on outq.
+    """
+
+    def __init__(self, func, inq, outq, workers):
+        self.func = func
+        self.inq = inq
+        self.outq = outq
+        self.lock = threading.Lock()
+        self.running = workers
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _work(self):
+        while True:
+            item = self.inq.get()
+            if item is _STOP:
+                self.inq.put(_STOP)  # for the next worker
+                with self.lock:
+                    self.running -= 1
+                    if not self.running:
+                        self.outq.put(_STOP)
+                return
+            try:
+                result = self.func(item)
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+                continue
+            if result is not None:
+                self.outq.put(result)
+
+
+def pull_changes(subscriber, subscription_path, buckets, outq, stopping, errors, leases):
+    """Pull GCS change events until stopping is set, putting builds to grab on outq.
+
+    Irrelevant events are acknowledged right away, and builds are added to
+    leases. Any error is appended to errors, and _STOP is put on outq however
+    this returns.
+    """
+    try:
+        while not stopping.is_set():
+            results = retry(subscriber.pull, subscription=subscription_path, max_messages=1000)
+            results = list(results.received_messages)
+            if not results:
+                stopping.wait(PIPELINE_PULL_IDLE)
+                continue
+            print('PULLED', len(results))
+            PUBSUB_PULL_MESSAGES.observe(len(results))
+            ack_ids, todo = process_changes(results, buckets)
+            if ack_ids:
+                print('ACK irrelevant', len(ack_ids))
+                acknowledge(subscriber, subscription_path, ack_ids)
+            if todo:
+                print('EXTEND-ACK ', len(todo))
+                leases.add([i for i, _j, _b in todo])
+            for item in todo:
+                outq.put(item)  # blocks while the later stages are behind
+    except Exception as err:  # pylint: disable=broad-except
+        traceback.print_exc()
+        errors.append(err)
+    finally:
+        outq.put(_STOP)
+
+
+def take_batch(inq, size=PIPELINE_BATCH_SIZE, wait=PIPELINE_BATCH_WAIT):
+    """Return up to size items from inq within wait seconds, and whether _STOP is yet to come."""
+    batch = []
+    deadline = time.time() + wait
+    while len(batch) < size:
+        try:
+            item = inq.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            break
+        if item is _STOP:
+            return batch, False
+        batch.append(item)
+    return batch, True
+
+
+def pipeline_main(
+        db,
+        subscriber,
+        subscription_path,
+        bq_client,
+        tables,
+        buckets,
+        client_class=make_db.GCSClient,
+        stop=None,
+    ):
+    """Like main, but with pulling, fetching, and uploading overlapped.
+
+    Builds flow through bounded queues: pull -> started/finished fetch ->
+    junit fetch -> database and rows (on this thread, which owns db) -> BigQuery
+    upload. A build's message is acknowledged only after its rows are uploaded,
+    and its lease is renewed until then. A build notified again while its rows
+    are queued gets no second row; batches upload in order, so the duplicate is
+    acknowledged after them. Once stop() is true, pulling ends and what was
+    already pulled is drained.
+    """
+    # pylint: disable=too-many-locals
+    gcs_client = client_class('', {})
+    if stop is None:
+        stop = lambda: False
+
+    def fetch_started_finished(item):
+        ack_id, job, build = item
+        build_dir, started, finished = gcs_client.get_started_finished(job, build)
+        if not finished:
+            print('finished.json missing?', build_dir, started, finished)
+            leases.remove([ack_id])  # let Pub/Sub redeliver it
+            return None
+        return ack_id, build_dir, started, finished
+
+    def fetch_junits(item):
+        parsers = []
+        junits = gcs_client.get_compressed_junits_from_build(item[1], db.junit_dict, parsers)
+        return item + (junits, make_db.parse_junits(item[1], parsers))
+
+    upload_pool = multiprocessing.pool.ThreadPool(len(tables) or 1)
+
+    def upload(item):
+        ack_ids, table_rows = item
+        return ack_ids, insert_tables(bq_client, tables, table_rows, upload_pool)
+
+    todo_q = queue.Queue(PIPELINE_QUEUE_SIZE)
+    build_q = queue.Queue(PIPELINE_QUEUE_SIZE)
+    junit_q = queue.Queue(PIPELINE_QUEUE_SIZE)
+    upload_q = queue.Queue(PIPELINE_UPLOAD_QUEUE_SIZE)
+    done_q = queue.Queue()  # unbounded, as only this thread drains it
+
+    stopping = threading.Event()
+    errors = []
+    leases = Leases(subscriber, subscription_path)
+    threading.Thread(
+        target=pull_changes,
+        args=(subscriber, subscription_path, buckets, todo_q, stopping, errors, leases),
+        daemon=True).start()
+    Stage(fetch_started_finished, todo_q, build_q, PIPELINE_FETCH_THREADS)
+    Stage(fetch_junits, build_q, junit_q, PIPELINE_JUNIT_THREADS)
+    Stage(upload, upload_q, done_q, 1)
+
+    # Builds with rows queued for upload, by table. They aren't in the emitted
+    # table until their upload is done, so a second notification for one of them
+    # would otherwise make its rows again.
+    uploading = {name: set() for name in tables}
+
+    pulling = True
+    while True:
+        if not stopping.is_set() and stop():
+            stopping.set()
+
+        if pulling:
+            batch, pulling = take_batch(junit_q)
+            if batch:
+                build_dirs = []
+                for _ack_id, build_dir, started, finished, _junits, _tests in batch:
+                    insert_build(db, build_dir, started, finished)
+                    build_dirs.append(build_dir)
+                missing = {path: rowid for rowid, path in db.get_builds_missing_junit()}
+                for _ack_id, build_dir, _started, _finished, junits, tests in batch:
+                    if build_dir in missing:
+                        make_db.insert_junits(db, missing.pop(build_dir), junits, tests,
+                                              encoded=True)
+                db.commit()
+                table_rows = {}
+                for name, (_table, incremental_table) in tables.items():
+                    builds = [build for build in
+                              db.get_builds_from_paths(build_dirs, incremental_table)
+                              if build[0] not in uploading[name]]
+                    table_rows[name] = list(make_json.make_rows(db, builds))
+                    uploading[name].update(rowid for rowid, _row in table_rows[name])
+                upload_q.put(([ack_id for ack_id, *_ in batch], table_rows))
+            if not pulling:
+                upload_q.put(_STOP)
+
+        while True:
+            try:
+                item = done_q.get(block=not pulling)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                leases.close()
+                upload_pool.close()
+                upload_pool.join()
+                if errors:
+                    raise errors[0]
+                return
+            ack_ids, emitted = item
+            for name, row_ids in emitted.items():
+                db.insert_emitted(row_ids, tables[name][1])
+                uploading[name].difference_update(row_ids)
+            # notify pubsub queue that we've handled the finished.json messages
+            print('ACK "finished.json"', len(ack_ids))
+            acknowledge(subscriber, subscription_path, ack_ids)
+            leases.remove(ack_ids)
 
 
 def load_sub(poll):
@@ -339,12 +702,31 @@ def get_options(argv):
         default='buckets.yaml',
         help='Path to bucket configuration.'
     )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Overlap pulling, fetching and uploading, acknowledging builds once uploaded.'
+    )
+    parser.add_argument(
+        '--gcs-qps',
+        type=float,
+        default=make_db.GCS_MAX_QPS,
+        help='Most GCS requests per second, backing off on 429s and 5xxs; 0 for no limit.'
+    )
+    make_db.add_cache_arguments(parser)
+    metrics.add_arguments(parser)
     return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
     OPTIONS = get_options(sys.argv[1:])
-    main(model.Database(),
+    metrics.setup(OPTIONS)
+    if OPTIONS.gcs_qps:
+        make_db.THROTTLE = make_db.Throttle(OPTIONS.gcs_qps)
+    if OPTIONS.gcs_cache:
+        make_db.OBJECT_CACHE = make_db.ObjectCache(OPTIONS.gcs_cache, OPTIONS.gcs_cache_size)
+    (pipeline_main if OPTIONS.pipeline else main)(
+         model.connect(),
          *load_sub(OPTIONS.poll),
          *load_tables(OPTIONS.dataset, OPTIONS.tables),
          _make_bucket_map(OPTIONS.buckets),
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark stream.py against fake Pub/Sub, BigQuery and GCS.
+
+Publishes finished.json events for synthetic builds (plus irrelevant events),
+runs stream.main or stream.pipeline_main until every event is acknowledged,
+and reports builds/sec, p50/p99 latency from publish to ack, and peak RSS.
+"""
+
+import argparse
+import functools
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import fakes
+import model
+import stream
+
+BUCKETS = {'kubernetes-jenkins': {'prefix': ''}}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(opts, db_path):
+    """Stream opts.builds builds into a database at db_path, returning a result dict."""
+    subscriber = fakes.FakeSubscriber(latency=opts.pubsub_latency)
+    bq_client = fakes.FakeBigQueryClient(latency=opts.bq_latency)
+    tables = {name: (fakes.FakeTable(name), 'build_emitted_bench_%s' % name)
+              for name in opts.tables}
+    client_class = functools.partial(
+        fakes.SyntheticGCSClient, latency=opts.gcs_latency, tests=opts.tests)
+
+    start = time.time()
+    finished_ids = []
+    for n in range(opts.builds):
+        publish_time = start + (n / opts.rate if opts.rate else 0)
+        build_dir = 'logs/bench-job-%d/%d' % (n % opts.jobs, n)
+        for _ in range(opts.irrelevant):
+            subscriber.publish({'bucketId': 'kubernetes-jenkins',
+                                'objectId': build_dir + '/artifacts/build-log.txt'},
+                               publish_time=publish_time)
+        finished_ids.append(subscriber.publish(
+            {'bucketId': 'kubernetes-jenkins', 'objectId': build_dir + '/finished.json'},
+            publish_time=publish_time))
+
+    main = stream.pipeline_main if opts.pipeline else stream.main
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')  # stream.py logs every build
+    try:
+        main(model.Database(db_path), subscriber, 'projects/bench/subscriptions/bench',
+             bq_client, tables, BUCKETS, client_class, lambda: not subscriber.pending())
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    latencies = [subscriber.acked[i] - subscriber.published[i] for i in finished_ids]
+    elapsed = max(subscriber.acked.values()) - start
+    return {
+        'builds': opts.builds,
+        'seconds': elapsed,
+        'builds_per_sec': opts.builds / elapsed,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'rows': {name: len(rows) for name, rows in bq_client.rows.items()},
+        'insert_requests': bq_client.requests,
+        'deliveries': subscriber.deliveries,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--builds', type=int, default=2000,
+                        help='Number of finished builds to publish.')
+    parser.add_argument('--jobs', type=int, default=50,
+                        help='Number of jobs the builds are spread over.')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Builds published per second, or 0 to publish all at once.')
+    parser.add_argument('--irrelevant', type=int, default=2,
+                        help='Irrelevant events published per build.')
+    parser.add_argument('--tests', type=int, default=20,
+                        help='Testcases in each build\'s junit.')
+    parser.add_argument('--tables', nargs='+', default=['day', 'week', 'all'],
+                        help='Names of the BigQuery tables rows are inserted into.')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Run stream.pipeline_main instead of stream.main.')
+    parser.add_argument('--gcs-latency', type=float, default=0.02,
+                        help='Seconds per GCS request.')
+    parser.add_argument('--bq-latency', type=float, default=0.2,
+                        help='Seconds per BigQuery insert request.')
+    parser.add_argument('--pubsub-latency', type=float, default=0.02,
+                        help='Seconds per Pub/Sub request.')
+    opts = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        result = run(opts, os.path.join(tmpdir, 'build.db'))
+    print('%(builds)d builds in %(seconds).1fs: %(builds_per_sec).1f builds/sec, '
+          'latency p50 %(p50).2fs p99 %(p99).2fs, peak RSS %(peak_rss_mb).1f MB' % result)
+    print('%(insert_requests)d insert requests, %(deliveries)d deliveries, rows %(rows)s'
+          % result)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import argparse
+import os
+import tempfile
+import time
+import unittest
+
+import fakes
+import stream_bench
+
+
+class FakesTest(unittest.TestCase):
+    def test_subscriber_redelivers(self):
+        sub = fakes.FakeSubscriber(ack_deadline=0, pull_timeout=0)
+        sub.publish({'objectId': 'a'})
+        first, = sub.pull('sub').received_messages
+        time.sleep(0.01)
+        second, = sub.pull('sub').received_messages  # deadline passed
+        self.assertNotEqual(first.ack_id, second.ack_id)
+        self.assertEqual(sub.pending(), 1)
+        sub.acknowledge('sub', [second.ack_id])
+        self.assertEqual(sub.pending(), 0)
+        self.assertEqual(sub.pull('sub').received_messages, [])
+
+    def test_synthetic_gcs(self):
+        client = fakes.SyntheticGCSClient('')
+        build_dir, started, finished = client.get_started_finished(
+            'gs://kubernetes-jenkins/logs/job', '12')
+        self.assertEqual(build_dir, 'gs://kubernetes-jenkins/logs/job/12')
+        self.assertLess(started['timestamp'], finished['timestamp'])
+        junits = client.get_junits_from_build(build_dir)
+        self.assertEqual(list(junits), [build_dir + '/artifacts/junit_01.xml'])
+        self.assertEqual(junits, client.get_junits_from_build(build_dir))
+
+
+class StreamBenchTest(unittest.TestCase):
+    def test_run(self):
+        for pipeline in [False, True]:
+            opts = argparse.Namespace(
+                builds=20, jobs=3, rate=0, irrelevant=1, tests=5, tables=['day', 'all'],
+                pipeline=pipeline, gcs_latency=0, bq_latency=0, pubsub_latency=0)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                result = stream_bench.run(opts, os.path.join(tmpdir, 'build.db'))
+            self.assertEqual(result['rows'], {'fake.build.day': 20, 'fake.build.all': 20})
+            self.assertEqual(result['deliveries'], 40)
+            self.assertLessEqual(result['p50'], result['p99'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,6 +16,8 @@
 
 # pylint: disable=missing-docstring, line-too-long
 
+import threading
+import time
 import unittest
 
 import stream
@@ -195,6 +197,44 @@ class StreamTest(unittest.TestCase):
         result = stream.process_changes(results, self.fake_buckets)
         self.assertEqual(result, expected)
 
+    def test_pack_rows(self):
+        rows = [{'path': 'x' * size} for size in [10, 10, 10, 100, 10]]
+        sizes = lambda chunks: [[len(row['path']) for row in chunk] for chunk in chunks]
+        self.assertEqual(sizes(stream.pack_rows(rows, max_rows=2, max_bytes=1000)),
+                         [[10, 10], [10, 100], [10]])
+        self.assertEqual(sizes(stream.pack_rows(rows, max_rows=10, max_bytes=50)),
+                         [[10, 10], [10], [100], [10]])
+
+    def test_insert_data_splits_large_requests(self):
+        class TooLarge(Exception):
+            code = 413
+
+        class SizeLimitedClient(FakeClient):
+            def insert_rows(self, _, *args, **kwargs):
+                if len(args[0]) > 2 or any('huge' in row for row in args[0]):
+                    self.trace.append(['too-large', len(args[0])])
+                    raise TooLarge('Request Entity Too Large')
+                return super().insert_rows(_, *args, **kwargs)
+
+        client = SizeLimitedClient()
+        rows = [(n, {'n': n}) for n in range(5)] + [(5, {'huge': True})]
+        emitted = stream.insert_data(client, FakeTable('day', []), rows)
+        self.assertEqual(emitted, list(range(6)))
+        self.assertEqual(
+            [entry[1] if entry[0] == 'too-large' else [r['n'] for r in entry[1][0]]
+             for entry in client.trace],
+            [6, 3, [0], [1, 2], 3, [3], 2, [4], 1])
+
+    def test_insert_data_skipped(self):
+        client = FakeClient()
+        emitted = stream.insert_data(client, FakeTable('day', []), [(1, None), (2, {'n': 2})])
+        self.assertEqual(emitted, [1, 2])
+        self.assertEqual([[r['n'] for r in entry[1][0]] for entry in client.trace], [[2]])
+        # builds that were all skipped are still recorded, without a request
+        client = FakeClient()
+        emitted = stream.insert_data(client, FakeTable('day', []), [(3, None)])
+        self.assertEqual((emitted, client.trace), ([3], []))
+
     def test_main(self):
         # It's easier to run a full integration test with stubbed-out
         # external interfaces and validate the trace than it is to test
@@ -288,6 +328,124 @@ class StreamTest(unittest.TestCase):
                  'tests_run': 2}],),
               {'skip_invalid_rows': True}]])
 
+    def test_leases(self):
+        fake_sub = FakeSub([])
+        leases = stream.Leases(fake_sub, 'sub', renew_every=0.01)
+        self.addCleanup(leases.close)
+        leases.add(['a', 'b'])
+        leases.remove(['a'])
+        deadline = time.time() + 5
+        while len(fake_sub.trace) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        leases.close()
+        self.assertEqual(fake_sub.trace[:3], [['modify-ack', 'sub', ['a', 'b'], 180],
+                                              ['modify-ack', 'sub', ['b'], 180],
+                                              ['modify-ack', 'sub', ['b'], 180]])
+
+    def test_leases_expire(self):
+        # leases held for too long are given up, so Pub/Sub redelivers the message
+        fake_sub = FakeSub([])
+        leases = stream.Leases(fake_sub, 'sub', renew_every=3600)
+        self.addCleanup(leases.close)
+        leases.add(['a'])
+        self.addCleanup(setattr, stream, 'PIPELINE_MAX_LEASE', stream.PIPELINE_MAX_LEASE)
+        stream.PIPELINE_MAX_LEASE = -1
+        leases.renew()
+        self.assertEqual(fake_sub.trace, [['modify-ack', 'sub', ['a'], 180]])
+
+    def test_pipeline_main(self):
+        db = model.Database(':memory:')
+        messages = [
+            FakeReceivedMessage(ack_id, FakePubSubMessage('no_data', {
+                'eventType': 'OBJECT_FINALIZE',
+                'objectId': object_id,
+                'bucketId': 'kubernetes-jenkins'}))
+            for ack_id, object_id in [
+                ('b', 'logs/fake/123/finished.json'),
+                ('c', 'logs/fake/123/finished.json'),
+                ('d', 'logs/fake/124/started.json'),
+                ('e', 'logs/fake/125/finished.json')]]  # no such build
+        fake_sub = FakeSub([FakePullResponse(messages[:2]), FakePullResponse(messages[2:])])
+        pull = fake_sub.pull
+        fake_sub.pull = lambda *args, **kwargs: pull(*args, **kwargs) if fake_sub.fake_pr \
+            else FakePullResponse([])
+        fake_client = FakeClient(fake_sub.trace)
+        fake_table = FakeTable('day', stream.load_schema(FakeSchemaField))
+        fake_sub_path = 'projects/{project_id}/subscriptions/{sub}'
+        stream.pipeline_main(
+            db,
+            fake_sub, fake_sub_path,
+            fake_client, {'day': (fake_table, 'incr')}, self.fake_buckets,
+            make_db_test.MockedClient, lambda: not fake_sub.fake_pr)
+
+        trace = [entry for entry in fake_sub.trace if entry[0] != 'pull']
+        acked = [ack_id for entry in trace if entry[0] == 'ack' for ack_id in entry[2]]
+        self.assertEqual(sorted(acked), ['b', 'c', 'd'])  # e is redelivered
+        self.assertIn(['modify-ack', fake_sub_path, ['b', 'c'], 180], trace)
+        inserts = [n for n, entry in enumerate(trace) if entry[0] == 'insert-rows']
+        self.assertEqual(len(inserts), 1)
+        rows, = trace[inserts[0]][1]
+        self.assertEqual([(row['path'], row['tests_run']) for row in rows],
+                         [('gs://kubernetes-jenkins/logs/fake/123', 2)])
+        # finished builds are only acknowledged once their rows are uploaded
+        first_ack = min(n for n, entry in enumerate(trace)
+                        if entry[0] == 'ack' and 'b' in entry[2])
+        self.assertLess(inserts[0], first_ack)
+        self.assertEqual(len(list(db.get_builds_from_paths(
+            ['gs://kubernetes-jenkins/logs/fake/123'], 'incr'))), 0)
+
+    def test_pipeline_main_duplicates_in_flight(self):
+        # Two notifications for one build land in consecutive batches, and the
+        # second batch's rows are made before the first batch is uploaded.
+        self.addCleanup(setattr, stream, 'take_batch', stream.take_batch)
+        take_batch = stream.take_batch
+        stream.take_batch = lambda inq: take_batch(inq, size=1)
+        self.addCleanup(setattr, stream.make_json, 'make_rows', stream.make_json.make_rows)
+        make_rows = stream.make_json.make_rows
+        batches = []
+        second_batch = threading.Event()
+
+        def counting_make_rows(db, builds):
+            batches.append(builds)
+            if len(batches) == 2:
+                second_batch.set()
+            return make_rows(db, builds)
+
+        stream.make_json.make_rows = counting_make_rows
+
+        db = model.Database(':memory:')
+        messages = [
+            FakeReceivedMessage(ack_id, FakePubSubMessage('no_data', {
+                'eventType': 'OBJECT_FINALIZE',
+                'objectId': 'logs/fake/123/finished.json',
+                'bucketId': 'kubernetes-jenkins'}))
+            for ack_id in ['b', 'c']]
+        fake_sub = FakeSub([FakePullResponse(messages)])
+        pull = fake_sub.pull
+        fake_sub.pull = lambda *args, **kwargs: pull(*args, **kwargs) if fake_sub.fake_pr \
+            else FakePullResponse([])
+        fake_client = FakeClient(fake_sub.trace)
+        insert_rows = fake_client.insert_rows
+
+        def slow_insert_rows(*args, **kwargs):
+            second_batch.wait(5)
+            return insert_rows(*args, **kwargs)
+
+        fake_client.insert_rows = slow_insert_rows
+        fake_table = FakeTable('day', stream.load_schema(FakeSchemaField))
+        fake_sub_path = 'projects/{project_id}/subscriptions/{sub}'
+        stream.pipeline_main(
+            db,
+            fake_sub, fake_sub_path,
+            fake_client, {'day': (fake_table, 'incr')}, self.fake_buckets,
+            make_db_test.MockedClient, lambda: not fake_sub.fake_pr)
+
+        self.assertTrue(second_batch.is_set())
+        inserts = [entry for entry in fake_sub.trace if entry[0] == 'insert-rows']
+        self.assertEqual(len(inserts), 1)
+        acked = [ack_id for entry in fake_sub.trace if entry[0] == 'ack' for ack_id in entry[2]]
+        self.assertEqual(sorted(acked), ['b', 'c'])
+
 
 if __name__ == '__main__':
     unittest.main()
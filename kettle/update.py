@@ -20,12 +20,16 @@ import os
 
 DUMP = 'dump.txt'
 THREADS = 32
+MJ_WORKERS = os.cpu_count() or 1
 MAX_BAD_RECORDS = 1000
 DAYS_OLD = 1.9
 DAY = 1
 WEEK = 7
 MONTH = 30
 SUB_PATH = os.environ.get('SUBSCRIPTION_PATH')
+# If set, make_db and stream serve Prometheus metrics on this port while they run.
+METRICS_PORT = os.environ.get('METRICS_PORT')
+COMPACT_SECONDS = 300
 
 def print_dump(file):
     if os.path.exists(file):
@@ -47,39 +51,44 @@ def call(cmd):
 def main():
     if SUB_PATH is None:
         raise Exception('Env var "SUBSCRIPTION_PATH" must be set, see deployment*.yaml')
-    call(f'time python3 make_db.py --buckets buckets.yaml --junit --threads {THREADS}')
+    metrics_ext = f' --metrics-port {METRICS_PORT}' if METRICS_PORT else ''
+    call(f'time python3 make_db.py --buckets buckets.yaml --junit --stream-junit'
+         f' --threads {THREADS}{metrics_ext}')
 
     bq_cmd = f'bq load --source_format=NEWLINE_DELIMITED_JSON --max_bad_records={MAX_BAD_RECORDS}'
-    mj_cmd = 'pypy3 make_json.py'
+    mj_cmd = f'pypy3 make_json.py --workers {MJ_WORKERS}'
 
     mj_ext = ''
-    bq_ext = ''
+    # Appending loads may add new NULLABLE columns from schema.json, e.g. truncated.
+    bq_add = ' --schema_update_option=ALLOW_FIELD_ADDITION'
+    bq_ext = bq_add
     try:
         call(f'{mj_cmd} --days 1 --assert-oldest {DAYS_OLD}')
     except OSError:
         # cycle daily/weekly tables
         bq_ext = ' --replace'
-        mj_ext = ' --reset-emitted'
+        mj_ext = f' --reset-days {DAY} --reset-days {WEEK}'
 
     if os.getenv('DEPLOYMENT', 'staging') == "prod":
-        call(f'{mj_cmd} {mj_ext} --days {DAY} | pv | gzip > build_day.json.gz')
+        # One pass over the builds writes all three tables' rows.
+        # TODO: (MushuEE) #20024, remove 30 day limit once issue with all uploads is found
+        call(f'{mj_cmd} {mj_ext} --output {DAY}:build_day.json.gz'
+             f' --output {WEEK}:build_week.json.gz --output {MONTH}:build_all.json.gz')
         call(f'{bq_cmd} {bq_ext} k8s-gubernator:build.day build_day.json.gz schema.json')
-
-        call(f'{mj_cmd} {mj_ext} --days {WEEK} | pv | gzip > build_week.json.gz')
         call(f'{bq_cmd} {bq_ext} k8s-gubernator:build.week build_week.json.gz schema.json')
+        call(f'{bq_cmd} {bq_add} k8s-gubernator:build.all build_all.json.gz schema.json')
 
-        # TODO: (MushuEE) #20024, remove 30 day limit once issue with all uploads is found
-        call(f'{mj_cmd} --days {MONTH} | pv | gzip > build_all.json.gz')
-        call(f'{bq_cmd} k8s-gubernator:build.all build_all.json.gz schema.json')
-
-        call(f'python3 stream.py --poll {SUB_PATH} ' \
+        call(f'python3 stream.py --pipeline --poll {SUB_PATH} ' \
              f'--dataset k8s-gubernator:build ' \
-             f'--tables all:{MONTH} day:{DAY} week:{WEEK} --stop_at=1')
+             f'--tables all:{MONTH} day:{DAY} week:{WEEK} --stop_at=1{metrics_ext}')
     else:
-        call(f'{mj_cmd} | pv | gzip > build_staging.json.gz')
-        call(f'{bq_cmd} k8s-gubernator:build.staging build_staging.json.gz schema.json')
-        call(f'python3 stream.py --poll {SUB_PATH} ' \
-             f'--dataset k8s-gubernator:build --tables staging:0 --stop_at=1')
+        call(f'{mj_cmd} --output 0:build_staging.json.gz')
+        call(f'{bq_cmd} {bq_add} k8s-gubernator:build.staging build_staging.json.gz schema.json')
+        call(f'python3 stream.py --pipeline --poll {SUB_PATH} ' \
+             f'--dataset k8s-gubernator:build --tables staging:0 --stop_at=1{metrics_ext}')
+
+    # Drop junits that every table has emitted, a few minutes at a time.
+    call(f'python3 compact.py --time-limit {COMPACT_SECONDS}')
 
 if __name__ == '__main__':
     os.chdir(os.path.dirname(__file__))